@@ -0,0 +1,298 @@
+"""
+Benchmark suite for the scheduler models.
+
+Measures model construction, solver and result extraction time of the Optimization for the bess,
+tess and hybrid systems over several window lengths, the Hot5 baseline over growing history sizes,
+rebuilt in full and with one hour added to the incremental baseline, the vectorized chiller power
+conversion, and the startup latency: module import times in a fresh interpreter and the first plan of a
+cold and of a pre-warmed solve worker. The fixtures are synthetic and generated from the forecasts and
+parameters of `config` or `config_test`.
+
+Results are written as JSON and compared against a stored baseline, reporting every timing that
+regressed by more than the tolerance:
+
+    python benchmarks/benchmark.py --output bench_output.json --baseline benchmarks/baseline.json
+    python benchmarks/benchmark.py --save-baseline benchmarks/baseline.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'control'))
+
+from matrix_model import MatrixOptimization, create_optimization
+from dp_dispatch import DynamicProgrammingOptimization
+from fleet import normalize_config
+from model.hot5 import Hot5, IncrementalHot5
+from model.chiller_model import ChillerModel
+from solve_worker import SolveWorker
+
+WINDOW_LENGTHS = [24, 48, 96, 168]
+SYSTEMS = ['bess', 'tess', 'hybrid']
+HISTORY_DAYS = [30, 90, 180, 365]
+CHILLER_ROWS = [8760, 87600]
+IMPORT_MODULES = ['solve_worker', 'mpc', 'optimization', 'matrix_model', 'dp_dispatch']
+
+
+def load_config(name):
+    """
+    Load a scheduler configuration in the layout used by Optimization.
+    """
+    with open(os.path.join(ROOT, name)) as json_data_file:
+        return normalize_config(json.load(json_data_file))
+
+
+def tile(values, length):
+    repeat = -(-length // len(values))
+    return (list(values) * repeat)[:length]
+
+
+def make_forecast(config, window_length):
+    forecast_config = config['forecast_config']
+    return (tile(forecast_config['predicted_load'], window_length),
+            tile(forecast_config['predicted_uncontrollable_load'], window_length),
+            tile(forecast_config['predicted_price'], window_length))
+
+
+def make_optimization_config(config, system, window_length, formulation, time_limit, engine='pyomo'):
+    config = json.loads(json.dumps(config))
+    config['energy_storage_system'] = system
+    config['window_length'] = window_length
+    config['tess_config']['formulation'] = formulation
+    config['solver_config'] = dict(config.get('solver_config', {}), time_limit=time_limit)
+    config['engine'] = engine
+    return config
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    # Solver and model output is not part of the benchmark
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def engine_prefix(engine):
+    """
+    Prefix of the names of the engine dependent timings; the default pyomo engine has none.
+    """
+    return '' if engine == 'pyomo' else f"{engine}."
+
+
+def bench_optimization(config, systems, window_lengths, formulation, time_limit, results, status, engine='pyomo'):
+    for system in systems:
+        for window_length in window_lengths:
+            name = f"optimization.{engine_prefix(engine)}{system}.w{window_length}"
+            load, uncontrollable_load, price = make_forecast(config, window_length)
+            opt_config = make_optimization_config(config, system, window_length, formulation, time_limit, engine)
+            try:
+                optimizer, results[name + ".build"] = timed(create_optimization, load, uncontrollable_load, price,
+                                                            opt_config)
+                if isinstance(optimizer, DynamicProgrammingOptimization):
+                    _, results[name + ".solve"] = timed(optimizer.run_opt)
+                    solver_name = 'dp'
+                elif isinstance(optimizer, MatrixOptimization):
+                    arrays, results[name + ".assemble"] = timed(optimizer.assemble)
+                    _, results[name + ".solve"] = timed(optimizer.solve_matrix, *arrays)
+                    solver_name = 'highs'
+                else:
+                    solver_name, results[name + ".solve"] = timed(optimizer.solver.solve, optimizer.model)
+            except Exception as e:
+                status[name] = f"failed: {e}"
+                continue
+            _, results[name + ".extract"] = timed(optimizer.get_results, solver_name)
+            status[name] = "{}: {}".format(solver_name, optimizer.solver.attempts[-1]['status'])
+
+
+def make_history(days, seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('2023-01-02', periods=24 * days, freq='60min', tz='UTC')
+    hour_angle = np.arange(len(index)) / 24 * 2 * np.pi
+    oat = np.round(20 + 10 * np.sin(hour_angle) + rng.normal(0, 3, len(index)))
+    power = np.abs(50 + 30 * np.sin(hour_angle) + rng.normal(0, 5, len(index)))
+    return pd.DataFrame({'OAT': oat, 'CoolingLoad': power}, index=index)
+
+
+def bench_hot5(config, history_days, results):
+    chiller_config = config['tess_config']['chiller_config']
+    hot5_config = {'parameters': {'COP': chiller_config.get('COP'), 't_cw_norm': chiller_config.get('t_cw_norm')},
+                   'units': {'t_cw_norm': 'f'},
+                   'timezone': 'US/Pacific',
+                   'point_mapping': {}}
+    for days in history_days:
+        history = make_history(days)
+        hot5 = Hot5(hot5_config, history.index[-1])
+        _, results[f"hot5.d{days}.baseline"] = timed(hot5.calculate_baseline_logic, history)
+        # Incremental baseline filled with the history but its last hour, which is then added
+        rows = history.reset_index().rename(columns={'index': 'Time'})
+        incremental = IncrementalHot5(hot5_config, history.index[-1], keep_days=days)
+        incremental.ingest(rows.iloc[:-1])
+        _, results[f"hot5.d{days}.incremental_hour"] = timed(incremental.ingest, rows.iloc[-1:])
+
+
+def bench_chiller(config, chiller_rows, results):
+    chiller_config = config['tess_config']['chiller_config']
+    parameters = config['tess_config']['parameters']
+    chiller = ChillerModel({'parameters': dict(parameters,
+                                               COP=chiller_config.get('COP'),
+                                               t_cw_norm=chiller_config.get('t_cw_norm'),
+                                               Q_nom=chiller_config.get('Q_norm'))}, None)
+    rng = np.random.default_rng(0)
+    for rows in chiller_rows:
+        df = pd.DataFrame({'Predict': rng.uniform(5, 40, rows), 'OAT': rng.uniform(10, 35, rows)})
+        _, results[f"chiller.r{rows}.adjust"] = timed(chiller.adjust_chiller_model, df, 1)
+
+
+def import_time(module):
+    # A fresh interpreter, so nothing is imported yet
+    code = ("import sys, time; sys.path.insert(0, sys.argv[1]); start = time.perf_counter(); "
+            f"import {module}; print(time.perf_counter() - start)")
+    output = subprocess.run([sys.executable, '-c', code, os.path.join(ROOT, 'control')],
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.split()[-1])
+
+
+def first_plan(worker, load, uncontrollable_load, price):
+    start = time.perf_counter()
+    worker.submit(load, uncontrollable_load, price, {})
+    worker.collect()
+    return time.perf_counter() - start
+
+
+def bench_startup(config, system, formulation, time_limit, results, engine='pyomo'):
+    for module in IMPORT_MODULES:
+        results[f"startup.import.{module}"] = import_time(module)
+    window_length = 24
+    load, uncontrollable_load, price = make_forecast(config, window_length)
+    opt_config = make_optimization_config(config, system, window_length, formulation, time_limit, engine)
+    worker = SolveWorker(opt_config)
+    try:
+        cold = first_plan(worker, load, uncontrollable_load, price)
+    finally:
+        worker.close()
+    name = f"startup.{engine_prefix(engine)}{system}.first_plan"
+    results[name + ".cold"] = cold
+    worker = SolveWorker(opt_config)
+    try:
+        worker.prewarm()
+        # Give the worker the time of a whole cold plan to load its modules, as the agent does while it
+        # waits for forecasts
+        time.sleep(cold)
+        results[name + ".prewarmed"] = first_plan(worker, load, uncontrollable_load, price)
+    finally:
+        worker.close()
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Compare the timings with the baseline ones. The timings without a baseline entry are listed too, since
+    they cannot be checked until the baseline is recorded again.
+
+    Returns:
+        list: The (name, baseline, current) timings that regressed by more than the tolerance.
+    """
+    regressions = []
+    missing = []
+    for name, seconds in sorted(results.items()):
+        if name not in baseline:
+            missing.append(name)
+            print(f"{name:40s} {'-':>10s} {seconds:10.4f}  NO BASELINE")
+            continue
+        reference = baseline[name]
+        flag = ''
+        if seconds > reference * (1 + tolerance) and seconds - reference > min_seconds:
+            regressions.append((name, reference, seconds))
+            flag = '  REGRESSION'
+        print(f"{name:40s} {reference:10.4f} {seconds:10.4f} {seconds / max(reference, 1e-9):7.2f}x{flag}")
+    if missing:
+        print(f"{len(missing)} benchmark(s) have no baseline entry, record them with --save-baseline")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='config', help='configuration the fixtures are generated from')
+    parser.add_argument('--systems', nargs='+', default=SYSTEMS)
+    parser.add_argument('--windows', nargs='+', type=int, default=WINDOW_LENGTHS)
+    parser.add_argument('--history-days', nargs='+', type=int, default=HISTORY_DAYS)
+    parser.add_argument('--chiller-rows', nargs='+', type=int, default=CHILLER_ROWS)
+    parser.add_argument('--formulation', default='piecewise', help="TESS formulation, 'piecewise' or 'polynomial'")
+    parser.add_argument('--engine', default='pyomo', help="optimization engine, 'pyomo', 'matrix' or 'dp'")
+    parser.add_argument('--no-startup', action='store_true', help='skip the import and first plan benchmarks')
+    parser.add_argument('--time-limit', type=float, default=60, help='solver time limit in seconds')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per benchmark, the fastest is kept')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', help='write the results into the baseline, keeping the entries of '
+                                                'other benchmarks, e.g. of another engine')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument('--min-seconds', type=float, default=0.005, help='ignore slowdowns smaller than this')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    results = {}
+    status = {}
+    for _ in range(args.repeat):
+        run = {}
+        bench_optimization(config, args.systems, args.windows, args.formulation, args.time_limit, run, status,
+                           args.engine)
+        bench_hot5(config, args.history_days, run)
+        bench_chiller(config, args.chiller_rows, run)
+        if not args.no_startup:
+            bench_startup(config, args.systems[0], args.formulation, args.time_limit, run, args.engine)
+        for name, seconds in run.items():
+            results[name] = min(seconds, results.get(name, seconds))
+
+    report = {
+        'metadata': {'date': datetime.now().isoformat(timespec='seconds'),
+                     'python': platform.python_version(),
+                     'machine': platform.machine(),
+                     'config': args.config,
+                     'formulation': args.formulation,
+                     'engine': args.engine},
+        'results': results,
+        'status': status
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+    if args.save_baseline:
+        previous = {}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline) as baseline_file:
+                previous = json.load(baseline_file)
+        # The timings of the benchmarks not run this time, e.g. of the other engines, are kept
+        engines = set(previous.get('metadata', {}).get('engines', [])) | {args.engine}
+        metadata = {key: value for key, value in report['metadata'].items() if key != 'engine'}
+        saved = {'metadata': dict(metadata, engines=sorted(engines)),
+                 'results': dict(previous.get('results', {}), **results),
+                 'status': dict(previous.get('status', {}), **status)}
+        with open(args.save_baseline, 'w') as output_file:
+            json.dump(saved, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}")
+            return 1
+    else:
+        for name, seconds in sorted(results.items()):
+            print(f"{name:40s} {seconds:10.4f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
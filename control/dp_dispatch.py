@@ -0,0 +1,502 @@
+"""
+Dynamic programming engine for the dispatch of a single storage.
+
+The SOC is discretized on a grid of `soc_step` percent that goes through the initial SOC, and the plan is
+found by backward induction over the moves between grid points, vectorized over the grid with NumPy. No
+solver is involved, so the run time only depends on the window length, the grid and the number of moves.
+The demand charges couple the time steps through the peak power; they are handled by an outer search over
+peak caps: for given caps the DP minimizes the energy cost with the total power capped, and a golden-section
+search on each cap minimizes the energy cost plus the demand charges of the resulting plan.
+
+The TESS charge and discharge limits are the polynomial envelopes of the SOC evaluated once at the grid
+states, so the nonconvex TESS model is planned exactly up to the grid resolution, where a solver needs
+MINLP outer approximation or piecewise-linear envelopes.
+"""
+import itertools
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from optimization import Optimization
+from matrix_model import MatrixOptimization, create_optimization
+from model.bess import BatteryEnergyStorageSystem
+from model.tess import ThermalEnergyStorageSystem
+
+# Golden ratio used by the peak cap search
+GOLDEN = (np.sqrt(5) - 1) / 2
+# Slack on the power and SOC limits, for the rounding of the grid
+TOLERANCE = 1e-6
+
+
+def backward_induction(stage_cost, final_cost, moves, steps, start):
+    """
+    Find the cheapest path over the SOC grid.
+
+    Args:
+        stage_cost (callable): stage_cost(i) returns the cost of each move at time step i, as an array that
+            broadcasts to (states x moves), inf for infeasible moves.
+        final_cost (np.ndarray): Cost of the remaining time steps from each state after the last move.
+        moves (np.ndarray): Grid offset of each move, consecutive integers including 0.
+        steps (int): Number of moves on the grid.
+        start (int): Grid index of the initial state.
+
+    Returns:
+        tuple: The cost from the initial state and the grid index of the state after each move, starting
+        with the initial state, or None if no path is feasible.
+    """
+    states = len(final_cost)
+    value = np.asarray(final_cost, dtype=float)
+    # The value after each move is read through a sliding window over the values padded with inf for the
+    # moves that leave the grid, so row j, column m is the value of the state j + moves[m]
+    padded = np.full(states + len(moves) - 1, np.inf)
+    offset = -moves[0]
+    reachable = sliding_window_view(padded, len(moves))
+    policy = np.empty((steps, states), dtype=int)
+    rows = np.arange(states)
+    for i in reversed(range(steps)):
+        padded[offset:offset + states] = value
+        cost = stage_cost(i) + reachable
+        policy[i] = np.argmin(cost, axis=1)
+        value = cost[rows, policy[i]]
+    path = [start]
+    if not np.isfinite(value[start]):
+        return value[start], None
+    for i in range(steps):
+        path.append(path[-1] + moves[policy[i, path[-1]]])
+    return value[start], np.array(path)
+
+
+def golden_section(cost, low, high, iterations):
+    """
+    Minimize a unimodal function over an interval. Infeasible points, of infinite cost, are taken to lie
+    on the low side of the interval.
+
+    Returns:
+        tuple: The best point evaluated and its cost.
+    """
+    left, right = high - GOLDEN * (high - low), low + GOLDEN * (high - low)
+    cost_left, cost_right = cost(left), cost(right)
+    best = min((cost_left, left), (cost_right, right))
+    for _ in range(iterations):
+        if cost_left < cost_right or (cost_left == cost_right and np.isfinite(cost_left)):
+            high, right, cost_right = right, left, cost_left
+            left = high - GOLDEN * (high - low)
+            cost_left = cost(left)
+            best = min(best, (cost_left, left))
+        else:
+            low, left, cost_left = left, right, cost_right
+            right = low + GOLDEN * (high - low)
+            cost_right = cost(right)
+            best = min(best, (cost_right, right))
+    return best[1], best[0]
+
+
+def pattern_search(cost, start, start_cost, step, tolerance):
+    """
+    Minimize a function by polling the points one step away along every combination of coordinate moves,
+    moving to the first better point and halving the step when none is better.
+
+    Returns:
+        tuple: The best point and its cost.
+    """
+    directions = [np.array(direction) for direction in itertools.product((-1, 0, 1), repeat=len(start))
+                  if any(direction)]
+    point, point_cost, last = np.asarray(start, dtype=float), start_cost, 0
+    while step > tolerance:
+        for k in range(len(directions)):
+            # Poll the direction of the last move first
+            direction = (last + k) % len(directions)
+            candidate = point + step * directions[direction]
+            candidate_cost = cost(candidate)
+            if candidate_cost < point_cost - TOLERANCE:
+                point, point_cost, last = candidate, candidate_cost, direction
+                break
+        else:
+            step /= 2
+    return point, point_cost
+
+
+class DynamicProgrammingOptimization(Optimization):
+    """
+    Optimization of a BESS or a TESS solved by dynamic programming over a SOC grid. It has the interface
+    of Optimization and is selected with `"engine": "dp"` in the configuration. Its settings are read from
+    `dp_config`: the grid resolution `soc_step` in percent, automatic by default, the `cap_iterations` of
+    the golden-section search of the peak cap, the `cap_tolerance` in kW of the search of the TOU peak caps,
+    and `verify` to also solve the exact model with the `reference_engine` and report the optimality gap.
+    """
+
+    # The demand windows and forecasts are plain arrays, as for the matrix engine
+    set_start_hour = MatrixOptimization.set_start_hour
+    set_forecast = MatrixOptimization.set_forecast
+
+    def build_model(self, config):
+        self.model = None
+        if self.use_bess and self.use_tess:
+            raise ValueError("The dp engine plans a single storage, use the pyomo or matrix engine for hybrid systems")
+        if self.use_bess:
+            self.bess = BatteryEnergyStorageSystem(None, dict(config['bess_config'], window_length=self.window_length,
+                                                              time_step_minutes=self.time_step_minutes))
+        if self.use_tess:
+            self.tess = ThermalEnergyStorageSystem(None, dict(config['tess_config'], window_length=self.window_length,
+                                                              time_step_minutes=self.time_step_minutes))
+        dp_config = config.get('dp_config', {})
+        self.soc_step = dp_config.get('soc_step')
+        self.cap_iterations = dp_config.get('cap_iterations', 20)
+        self.cap_tolerance = dp_config.get('cap_tolerance', 0.05)
+        self.verify = dp_config.get('verify', False)
+        # The reference is solved without MIP gap, so the gap of the DP plan is measured from the optimum
+        self.reference_config = dict(config, engine=dp_config.get('reference_engine', 'matrix'),
+                                     solver_config=dict(config.get('solver_config', {}), mip_gap=0))
+        if self.use_tess and self.reference_config['engine'] == 'matrix':
+            # The matrix engine solves the TESS with the piecewise-linear envelopes
+            self.reference_config['tess_config'] = dict(config['tess_config'], formulation='piecewise')
+        self.reference = None
+        self.set_start_hour(self.start_hour)
+        self.plan = None
+        self.evaluations = 0
+
+    def set_grid(self, initial_soc, min_soc, max_soc, charge, discharge):
+        """
+        Set the SOC grid between the min and max SOC going through the initial SOC, and the moves on it.
+        Without a configured `soc_step`, the step is 0.5 percent or finer, so the largest move of a time
+        step spans at least 20 grid points.
+
+        Args:
+            charge (float): Largest SOC increase over a time step, in percent.
+            discharge (float): Largest SOC decrease over a time step, in percent.
+        """
+        self.grid_step = self.soc_step or min(0.5, max(charge, discharge) / 20) or 0.5
+        initial_soc = min(max(initial_soc, min_soc), max_soc)
+        lowest = int(np.ceil((min_soc - initial_soc) / self.grid_step - TOLERANCE))
+        highest = int(np.floor((max_soc - initial_soc) / self.grid_step + TOLERANCE))
+        self.grid = initial_soc + np.arange(lowest, highest + 1) * self.grid_step
+        self.start = -lowest
+        self.moves = np.arange(-int(discharge / self.grid_step + TOLERANCE), int(charge / self.grid_step + TOLERANCE) + 1)
+
+    def bess_power(self, soc_change):
+        """
+        BESS power, positive when discharging, that changes the SOC by `soc_change` percent over a time step.
+        """
+        bess = self.bess
+        energy = np.asarray(soc_change, dtype=float) * bess.rated_energy_kwh / 100 / bess.dt
+        return np.where(energy > 0, -energy / bess.charging_efficiency, -energy * bess.discharging_efficiency)
+
+    def bess_feasible(self, power):
+        bess = self.bess
+        max_charging = min(bess.max_charging_power, bess.rated_power_kw)
+        max_discharging = min(bess.max_discharging_power, bess.rated_power_kw)
+        return (power >= -max_charging - TOLERANCE) & (power <= max_discharging + TOLERANCE)
+
+    def prepare(self):
+        """
+        Precompute the grid, the moves and the power of each move for the current forecasts and SOCs.
+        """
+        n = self.window_length
+        self.load_array = np.asarray(self.load[:n], dtype=float)
+        self.uncontrollable_load_array = np.asarray(self.uncontrollable_load[:n], dtype=float)
+        self.price_array = np.asarray(self.prices[:n], dtype=float)
+        if self.use_bess:
+            self.prepare_bess()
+        else:
+            self.prepare_tess()
+
+    def prepare_bess(self):
+        bess = self.bess
+        max_charging = min(bess.max_charging_power, bess.rated_power_kw)
+        max_discharging = min(bess.max_discharging_power, bess.rated_power_kw)
+        charge = max_charging * bess.charging_efficiency * bess.dt / bess.rated_energy_kwh * 100
+        discharge = max_discharging / bess.discharging_efficiency * bess.dt / bess.rated_energy_kwh * 100
+        self.set_grid(bess.initial_soc, bess.min_soc, bess.max_soc, charge, discharge)
+        self.move_power = self.bess_power(self.moves * self.grid_step)
+        # The last SOC equals the final SOC and the final SOC constraint with losses keeps the last step idle,
+        # so the last move on the grid is followed by one move to the final SOC and one idle step
+        self.final_power = self.bess_power(bess.target_soc - self.grid)
+        self.lower_total = np.full(self.window_length, max(bess.min_building_power, 0.))
+        self.max_total = self.load_array.max() + max_charging
+        self.min_total = np.maximum(self.load_array - max_discharging, self.lower_total)
+
+    def energy_cost(self, total, caps, first=0):
+        """
+        Energy cost of the total power of each time step, inf where the total power is out of its bounds.
+
+        Args:
+            total (np.ndarray): Total power, one row per time step.
+            caps (np.ndarray): Cap of the total power of each time step.
+            first (int): Time step of the first row.
+        """
+        total = np.asarray(total, dtype=float)
+        caps = np.reshape(caps, (-1,) + (1,) * (total.ndim - 1))
+        prices = np.reshape(self.price_array[first:first + len(total)], caps.shape)
+        lower = np.reshape(self.lower_total[first:first + len(total)], caps.shape)
+        feasible = (total >= lower - TOLERANCE) & (total <= caps + TOLERANCE)
+        return np.where(feasible, prices * total * self.dt, np.inf)
+
+    def plan_bess(self, caps):
+        """
+        Plan the BESS with the total power of each time step capped.
+
+        Args:
+            caps (np.ndarray): Cap of the total power of each time step.
+
+        Returns:
+            dict: The energy cost and the BESS power, SOC and total power schedules, or None if infeasible.
+        """
+        n = self.window_length
+        self.evaluations += 1
+        if n < 2:
+            return self.schedule(np.zeros(n), bess_power=np.zeros(n), soc_prediction_bess=np.full(n, self.bess.initial_soc))
+        costs = self.energy_cost(self.load_array[:, None] - self.move_power[None, :], caps)
+        final_total = self.load_array[n - 2] - self.final_power
+        final_cost = self.energy_cost(final_total[None, :], caps[n - 2:n - 1], n - 2)[0]
+        final_cost = np.where(self.bess_feasible(self.final_power), final_cost, np.inf)
+        final_cost = final_cost + self.energy_cost(self.load_array, caps)[n - 1]
+        cost, path = backward_induction(lambda i: costs[i], final_cost, self.moves, n - 2, self.start)
+        if not np.isfinite(cost):
+            return None
+        soc = np.append(self.grid[path], self.bess.target_soc)
+        soc[0] = self.bess.initial_soc
+        power = np.append(self.bess_power(np.diff(soc)), 0.)
+        return self.schedule(power, bess_power=power, soc_prediction_bess=soc)
+
+    def tess_usage(self, soc_change):
+        """
+        TESS energy usage, positive when discharging, that changes the SOC by `soc_change` percent over a time step.
+        """
+        tess = self.tess
+        return -np.asarray(soc_change, dtype=float) * tess.storage_capacity / 100 / tess.dt
+
+    def prepare_tess(self):
+        tess = self.tess
+        socs = np.linspace(tess.min_soc, tess.max_soc, 101)
+        max_charging = max(max(tess.charging_rate_limit(soc) for soc in socs), 0.)
+        max_discharging = max(max(tess.discharging_rate_limit(soc) for soc in socs), 0.)
+        charge = max_charging * tess.dt / tess.storage_capacity * 100
+        discharge = max_discharging * tess.dt / tess.storage_capacity * 100
+        self.set_grid(tess.initial_soc, tess.min_soc, tess.max_soc, charge, discharge)
+        # Polynomial envelopes at the SOC of each grid state
+        self.charging_limit = np.array([tess.charging_rate_limit(soc) for soc in self.grid])
+        self.discharging_limit = np.array([tess.discharging_rate_limit(soc) for soc in self.grid])
+        usage = self.tess_usage(self.moves * self.grid_step)
+        # Moves within the envelopes at the SOC they start from; staying idle needs one of them to be open
+        within = np.where(usage[None, :] < 0, -usage[None, :] <= self.charging_limit[:, None] + TOLERANCE,
+                          usage[None, :] <= self.discharging_limit[:, None] + TOLERANCE)
+        idle = (self.charging_limit >= -TOLERANCE) | (self.discharging_limit >= -TOLERANCE)
+        within = np.where(usage[None, :] == 0, idle[:, None], within)
+        self.move_feasible = np.where(within, 0., np.inf)
+        self.move_power = usage / tess.cop
+        # The total power stays above the uncontrollable load, i.e. the discharge covers at most the cooling load
+        self.lower_total = np.maximum(self.uncontrollable_load_array, 0.)
+        self.max_total = self.load_array.max() + max_charging / tess.cop
+        self.min_total = np.maximum(self.load_array - max_discharging / tess.cop, self.lower_total)
+
+    def last_usage(self, caps):
+        """
+        Energy usage of the last time step from each grid state. The SOC after it is not part of the model,
+        so it is the cheapest usage within the envelopes and the total power bounds.
+
+        Returns:
+            tuple: The usage and whether it is feasible, for each grid state.
+        """
+        tess = self.tess
+        load, lower, cap = self.load_array[-1], self.lower_total[-1], caps[-1]
+        low = np.maximum(-np.maximum(self.charging_limit, 0.), (load - cap) * tess.cop)
+        high = np.minimum(np.maximum(self.discharging_limit, 0.), (load - lower) * tess.cop)
+        usage = high if self.price_array[-1] >= 0 else low
+        feasible = (low <= high + TOLERANCE) & ((self.charging_limit >= -TOLERANCE) | (self.discharging_limit >= -TOLERANCE))
+        return usage, feasible
+
+    def plan_tess(self, caps):
+        """
+        Plan the TESS with the total power of each time step capped.
+
+        Args:
+            caps (np.ndarray): Cap of the total power of each time step.
+
+        Returns:
+            dict: The energy cost and the TESS schedules of run_opt, or None if infeasible.
+        """
+        tess = self.tess
+        n = self.window_length
+        self.evaluations += 1
+        costs = self.energy_cost(self.load_array[:, None] - self.move_power[None, :], caps)
+        last_usage, feasible = self.last_usage(caps)
+        final_cost = self.price_array[-1] * (self.load_array[-1] - last_usage / tess.cop) * self.dt
+        final_cost = np.where(feasible & (self.grid >= tess.final_soc - TOLERANCE), final_cost, np.inf)
+        cost, path = backward_induction(lambda i: costs[i][None, :] + self.move_feasible, final_cost, self.moves,
+                                        n - 1, self.start)
+        if not np.isfinite(cost):
+            return None
+        soc = self.grid[path]
+        usage = np.append(self.tess_usage(np.diff(soc)), last_usage[path[-1]])
+        return self.schedule(usage / tess.cop,
+                             soc_prediction_tess=soc,
+                             tess_power=-usage / tess.cop,
+                             binary=(usage > TOLERANCE).astype(float),
+                             tess_u_ch=np.maximum(-usage, 0.),
+                             tess_u_dis=np.maximum(usage, 0.),
+                             tess_u=usage)
+
+    def schedule(self, power, **schedules):
+        """
+        Complete the storage schedules of a plan with the total power and the cost.
+
+        Args:
+            power (np.ndarray): Power of the storage, positive when it lowers the total power.
+        """
+        total = self.load_array - power
+        return dict(schedules, total_power=total, cost=self.objective(total))
+
+    def demand_terms(self):
+        """
+        Demand charges of the objective as (daily rate, window, billing peak) terms, the window being 1 for
+        the time steps the peak is taken over and the billing peak the part of the peak already paid for.
+        The narrowest windows come first, so the cap search settles the TOU peaks before the peak of the
+        whole window.
+        """
+        terms = [(self.demand_charge_daily, np.ones(self.window_length), 'peak_power')]
+        if self.type_of_demand_rate.lower() == 'tou':
+            terms += [(self.peak_demand_rate_daily, self.peak_window, 'peak_power_during_peak_demand'),
+                      (self.part_peak_demand_price_daily, self.partial_peak_window,
+                       'peak_power_during_partial_peak_demand')]
+        return sorted([(rate, window, self.billing_peaks.get(name, 0.)) for rate, window, name in terms
+                       if window.any()], key=lambda term: term[1].sum())
+
+    def objective(self, total):
+        cost = float(np.sum(self.price_array * total * self.dt))
+        if self.control_type == 3:
+            cost += sum(rate * max(total[window > 0].max(), billing_peak)
+                        for rate, window, billing_peak in self.demand_terms())
+        return cost
+
+    def search_caps(self, plan):
+        """
+        Search the peak caps that minimize the cost of the plans. With a single demand charge, the cost is
+        minimized by a golden-section search on its cap. The cost is convex but not smooth in the caps, and
+        with TOU demand charges the caps usually have to move together, some up and some down, so the
+        golden-section search on a common cap is followed by a pattern search over every combination of
+        cap moves. Without demand charges, the total power is capped by the peak limit of the control type.
+
+        Args:
+            plan (callable): plan(caps) returns the plan for the caps of the time steps, or None.
+
+        Returns:
+            dict: The cheapest plan found.
+        """
+        n = self.window_length
+        if self.control_type != 3:
+            limit = self.load_array.max() if self.control_type in [1, 2] else self.peak_demand_limit
+            return plan(np.full(n, np.inf if limit is None else float(limit)))
+
+        terms = self.demand_terms()
+        best = {}
+        # The pattern search polls some caps more than once
+        evaluated = {}
+
+        def evaluate(values):
+            key = tuple(np.round(values, 9))
+            if key in evaluated:
+                return evaluated[key]
+            caps = np.full(n, np.inf)
+            for value, (rate, window, billing_peak) in zip(values, terms):
+                # A cap below the billing peak restricts the plan without lowering the demand charge
+                caps = np.where(window > 0, np.minimum(caps, max(value, billing_peak)), caps)
+            outcome = plan(caps)
+            cost = evaluated[key] = np.inf if outcome is None else outcome['cost']
+            if cost < best.get('cost', np.inf):
+                best.update(outcome)
+            return cost
+
+        low = max(self.min_total[window > 0].max() for rate, window, billing_peak in terms)
+        value, cost = golden_section(lambda value: evaluate(np.full(len(terms), value)),
+                                     low, self.max_total, self.cap_iterations)
+        if len(terms) > 1 and np.isfinite(cost):
+            point = np.full(len(terms), value)
+            if any(billing_peak > 0 for rate, window, billing_peak in terms):
+                # Billing peaks set the best caps of the terms far apart. Starting from uncapped terms, each
+                # cap is also searched on its own, the highest demand rate first, and the pattern search
+                # starts from the cheaper of the two points.
+                caps = np.full(len(terms), self.max_total)
+                caps_cost = evaluate(caps)
+                for k in sorted(range(len(terms)), key=lambda k: -terms[k][0]):
+                    def along(value, k=k):
+                        return evaluate(np.concatenate([caps[:k], [value], caps[k + 1:]]))
+                    value, term_cost = golden_section(along, self.min_total[terms[k][1] > 0].max(),
+                                                      self.max_total, self.cap_iterations)
+                    if term_cost < caps_cost:
+                        caps[k], caps_cost = value, term_cost
+                if caps_cost < cost:
+                    point, cost = caps, caps_cost
+            pattern_search(evaluate, point, cost, (self.max_total - low) / 16, self.cap_tolerance)
+        return best or None
+
+    def run_opt(self, warmstart=False):
+        """
+        Plan the storage. The DP does not use a starting point, `warmstart` is accepted for compatibility.
+        """
+        self.solver.attempts = []
+        self.evaluations = 0
+        start = time.time()
+        with self.timer.phase('assemble'):
+            self.prepare()
+        with self.timer.phase('solve'):
+            self.plan = self.search_caps(self.plan_bess if self.use_bess else self.plan_tess)
+        status = 'Optimal' if self.plan else 'Infeasible'
+        self.solver.attempts.append({"solver": "dp", "status": status, "solve_time": time.time() - start,
+                                     "evaluations": self.evaluations})
+        if not self.plan:
+            raise RuntimeError("No feasible plan on the SOC grid")
+        with self.timer.phase('extract'):
+            results = self.get_results('dp')
+        if self.verify:
+            with self.timer.phase('verify'):
+                results['dp'].update(self.optimality_gap(results['cost']))
+        results['timings'] = dict(self.timer.timings)
+        self.timer.reset()
+        return results
+
+    def optimality_gap(self, cost):
+        """
+        Solve the same problem exactly with the reference engine and compare its cost with the DP plan.
+
+        Returns:
+            dict: The reference cost, the gap of the DP plan, the gap relative to the reference cost and the
+            MIP gap the reference was solved to, which is above 0 only if it stopped on the time limit.
+        """
+        if self.reference is None:
+            self.reference = create_optimization(self.load, self.uncontrollable_load, self.prices,
+                                                 self.reference_config)
+        else:
+            self.reference.set_forecast(self.load, self.uncontrollable_load, self.prices)
+        self.reference.set_start_hour(self.start_hour)
+        self.reference.set_billing_peaks(**self.billing_peaks)
+        if self.use_bess:
+            self.reference.bess.update(initial_soc=self.bess.initial_soc, final_soc=self.bess.target_soc)
+        else:
+            self.reference.tess.update(initial_soc=self.tess.initial_soc, final_soc=self.tess.final_soc)
+        reference = self.reference.run_opt()
+        reference_cost = reference['cost']
+        attempts = reference.get('solve_attempts') or [{}]
+        return {'reference_cost': reference_cost,
+                'optimality_gap': cost - reference_cost,
+                'relative_gap': (cost - reference_cost) / abs(reference_cost) if reference_cost else None,
+                'reference_mip_gap': attempts[-1].get('mip_gap')}
+
+    def get_results(self, solver_name=None):
+        plan = self.plan
+        results = {
+            'peak_load_prediction': float(plan['total_power'].max()) if self.control_type == 3 else None,
+            'cost': plan['cost'],
+            'cooling_load': self.cooling_load,
+            'time_step_minutes': self.time_step_minutes,
+            'solver': solver_name,
+            'solve_attempts': self.solver.attempts,
+            'dp': {'soc_step': self.grid_step, 'grid_points': len(self.grid), 'evaluations': self.evaluations}
+        }
+        results.update({key: [float(value) for value in values] for key, values in plan.items() if key != 'cost'})
+        return results
+
+    def shift_solution(self, steps=1):
+        """
+        The DP does not use a starting point, nothing to shift.
+        """
@@ -2,9 +2,9 @@ import pandas as pd
 import math
 from datetime import datetime, timedelta
 import json
-import matplotlib.pyplot as plt
 import os
-from optimization import Optimization
+from matrix_model import create_optimization
+from time_steps import window_steps
 
 # Global constants
 ROUNDING_PRECISION_DEFAULT = 2
@@ -28,6 +28,58 @@ class ConfigLoader:
         return self.config.get(key, default)
 
 
+# Planning cycle class to solve the optimization once per cycle
+class PlanningCycle:
+    """
+    Build and solve the optimization once per planning cycle and serve every
+    hour slot of the window from the stored result.
+
+    The stored result is invalidated, and the model solved again, only when the
+    load, uncontrollable load, price or SOC inputs differ from the ones used for
+    the last solve.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.forecast_config = config.get("forecast_config", {})
+        self.optimizer = None
+        self.results = None
+        self.inputs = None
+
+    def make_inputs(self, load, uncontrollable_load, price, bess_soc, tess_soc):
+        return (tuple(load), tuple(uncontrollable_load), tuple(price), bess_soc, tess_soc)
+
+    def is_valid(self, inputs):
+        return self.results is not None and self.inputs == inputs
+
+    def invalidate(self):
+        self.results = None
+        self.inputs = None
+
+    def solve(self, load, uncontrollable_load, price, bess_soc, tess_soc):
+        # The model is built on the first solve only; later cycles update its parameters in place
+        if self.optimizer is None:
+            self.optimizer = create_optimization(load, uncontrollable_load, price, self.config)
+        else:
+            self.optimizer.set_forecast(load, uncontrollable_load, price)
+        if self.forecast_config.get("data_source") == "info_agent":
+            self.optimizer.update(bess_soc=bess_soc, tess_soc=tess_soc)
+        else:
+            self.optimizer.update(load, bess_soc=bess_soc, tess_soc=tess_soc)
+        return self.optimizer.run_opt()
+
+    def get_results(self, load, uncontrollable_load, price, bess_soc, tess_soc):
+        """
+        Return the optimization results for the current planning cycle, solving
+        the model only if the inputs changed since the last solve.
+        """
+        inputs = self.make_inputs(load, uncontrollable_load, price, bess_soc, tess_soc)
+        if not self.is_valid(inputs):
+            self.results = self.solve(load, uncontrollable_load, price, bess_soc, tess_soc)
+            self.inputs = inputs
+        return self.results
+
+
 # Scheduler class to handle schedule operations
 class Scheduler:
     def __init__(self, config):
@@ -37,7 +89,8 @@ class Scheduler:
         self.hours_to_start = config.get("hours_to_start", 1)
         self.rounding_precision = config.get("rounding_precision", ROUNDING_PRECISION_DEFAULT)
         self.method = config.get("method", "control")
-        self.window_length = config.get("window_length", 24)
+        self.time_step_minutes = config.get("time_step_minutes", 60)
+        self.window_length = window_steps(config)
         self.forecast_config = config.get("forecast_config", {})
         self.price = self.forecast_config.get("predicted_price", [])
         self.load = self.forecast_config.get("predicted_load", [])
@@ -45,6 +98,7 @@ class Scheduler:
         self.bess_soc = SOC_DEFAULT['bess']
         self.tess_soc = SOC_DEFAULT['tess']
         self.cop = config.get("chiller_config", {}).get("COP", COP_DEFAULT)
+        self.planning_cycle = PlanningCycle(config)
 
     def forward_fill_na(self, lst):
         latest_value = None
@@ -65,24 +119,21 @@ class Scheduler:
         return lst
 
     def update_schedule(self, setpoints):
-        _hour = datetime.now().hour
-        return setpoints[_hour:] + setpoints[:_hour]
+        _step = datetime.now().hour * 60 // self.time_step_minutes
+        return setpoints[_step:] + setpoints[:_step]
 
     def get_schedule_from_control(self):
-        optimizer = Optimization(self.load, self.uncontrollable_load, self.price, self.config)
-        if self.forecast_config.get("data_source") == "info_agent":
-            optimizer.update(bess_soc=self.bess_soc, tess_soc=self.tess_soc)
-        else:
-            optimizer.update(self.load, bess_soc=self.bess_soc, tess_soc=self.tess_soc)
-        return optimizer.run_opt()
+        return self.planning_cycle.get_results(self.load, self.uncontrollable_load, self.price,
+                                               self.bess_soc, self.tess_soc)
 
     def schedule_operations(self):
         message_dict = {}
+        ess_results = self.get_schedule_from_control()
+        cooling_load = ess_results.get('cooling_load', [])
+        # The first time step of the optimization starts at the current hour
+        window_start = datetime.now().replace(minute=0, second=0, microsecond=0)
         for i in range(self.window_length):
-            sched_hour = datetime.now() + timedelta(hours=i)
-            run_time = sched_hour.replace(minute=0, second=0, microsecond=0)
-            ess_results = self.get_schedule_from_control()
-            cooling_load = ess_results.get('cooling_load', [])
+            run_time = window_start + timedelta(minutes=i * self.time_step_minutes)
 
             if self.energy_storage_system == "tess":
                 setpoints = round(ess_results['tess_power'][i], self.rounding_precision)
@@ -96,10 +147,10 @@ class Scheduler:
                 bess_setpoints = round(ess_results['bess_power'][i], self.rounding_precision)
                 print(f"{self.energy_storage_system} run time = {run_time} tess setpoints are {tess_setpoints}, bess setpoints are {bess_setpoints}")
             
-            forecast_time = datetime.now().replace(minute=0, second=0, microsecond=0)
+            forecast_time = run_time
 
             if self.method.lower() == "control":
-                message_dict[forecast_time] = {"duration_in_seconds": 3600}
+                message_dict[forecast_time] = {"duration_in_seconds": self.time_step_minutes * 60}
             elif self.method.lower() == "schedule":
                 message_dict[forecast_time] = {f"{self.energy_storage_system}_setpoints": float(setpoints)}
 
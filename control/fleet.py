@@ -0,0 +1,185 @@
+"""
+Fleet runner planning many buildings from one process.
+
+Each building of the fleet directory is either a subdirectory holding its scheduler `config` and an
+optional `forecast.csv` with load, uncontrollable_load and price columns, or a single `<building>.json`
+config. Forecasts missing from the CSV file are taken from the forecast_config of the building config.
+The optimization of each building is built and solved in a worker of a process pool, so the wall-clock
+time of a fleet plan scales with the number of workers rather than the number of buildings:
+
+    python control/fleet.py fleet/ --workers 8 --output fleet_plan.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+FORECAST_COLUMNS = {
+    'load': 'predicted_load',
+    'uncontrollable_load': 'predicted_uncontrollable_load',
+    'price': 'predicted_price'
+}
+
+
+def normalize_config(config):
+    """
+    Bring `config_test` style configurations, which keep the TESS and BESS settings in
+    tess_optimizer_config/bess_optimizer_config, to the layout used by Optimization.
+    """
+    if 'tess_config' not in config and 'tess_optimizer_config' in config:
+        config['tess_config'] = dict(config['tess_optimizer_config'],
+                                     chiller_config=config.get('chiller_config', {}),
+                                     parameters=config.get('parameters', {}))
+    if 'bess_config' not in config and 'bess_optimizer_config' in config:
+        config['bess_config'] = dict(config['bess_optimizer_config'])
+    return config
+
+
+def load_building(config_file, forecast_file=None):
+    """
+    Load the configuration of a building and the forecasts it is planned with.
+
+    Args:
+        config_file (str): Path of the building scheduler configuration.
+        forecast_file (str): Path of a CSV file with load, uncontrollable_load and price columns, if any.
+
+    Returns:
+        dict: The configuration and the load, uncontrollable load and price forecasts.
+    """
+    with open(config_file) as json_data_file:
+        config = normalize_config(json.load(json_data_file))
+    forecast_config = dict(config.get('forecast_config', {}))
+    if forecast_file is not None and os.path.exists(forecast_file):
+        forecast = pd.read_csv(forecast_file)
+        for column, key in FORECAST_COLUMNS.items():
+            if column in forecast:
+                forecast_config[key] = forecast[column].tolist()
+    return {
+        'config': config,
+        'load': forecast_config.get('predicted_load', []),
+        'uncontrollable_load': forecast_config.get('predicted_uncontrollable_load', []),
+        'price': forecast_config.get('predicted_price', [])
+    }
+
+
+def discover_buildings(fleet_dir):
+    """
+    Find the buildings of a fleet directory.
+
+    Returns:
+        dict: The (config file, forecast file) of each building, keyed by building name.
+    """
+    buildings = {}
+    for entry in sorted(os.listdir(fleet_dir)):
+        path = os.path.join(fleet_dir, entry)
+        if os.path.isdir(path) and os.path.isfile(os.path.join(path, 'config')):
+            buildings[entry] = (os.path.join(path, 'config'), os.path.join(path, 'forecast.csv'))
+        elif os.path.isfile(path) and entry.endswith('.json'):
+            buildings[os.path.splitext(entry)[0]] = (path, None)
+    return buildings
+
+
+def plan_building(name, config_file, forecast_file=None):
+    """
+    Build and solve the optimization of one building. Failures are returned, not raised, so one
+    building cannot stop the plan of the rest of the fleet.
+
+    Returns:
+        dict: The building name, status, results or error and the load, build and solve times.
+    """
+    # Imported here so the agent reads normalize_config through policy_table without loading Pyomo
+    from matrix_model import create_optimization
+
+    timing = {}
+    start = time.perf_counter()
+    try:
+        building = load_building(config_file, forecast_file)
+        timing['load'] = time.perf_counter() - start
+        step = time.perf_counter()
+        optimizer = create_optimization(building['load'], building['uncontrollable_load'], building['price'],
+                                         building['config'])
+        timing['build'] = time.perf_counter() - step
+        step = time.perf_counter()
+        results = optimizer.run_opt()
+        timing['solve'] = time.perf_counter() - step
+        status, error = 'ok', None
+    except Exception as e:
+        results = None
+        status, error = 'failed', f"{e}\n{traceback.format_exc()}"
+    timing['total'] = time.perf_counter() - start
+    return {'building': name, 'status': status, 'results': results, 'error': error, 'timing': timing}
+
+
+class FleetRunner:
+    """
+    Plan every building of a fleet directory over a pool of worker processes.
+    """
+
+    def __init__(self, fleet_dir, workers=None):
+        """
+        Args:
+            fleet_dir (str): Directory holding the building configurations and forecasts.
+            workers (int): Number of worker processes. Defaults to the number of CPUs.
+        """
+        self.fleet_dir = fleet_dir
+        self.workers = workers or os.cpu_count()
+        self.buildings = discover_buildings(fleet_dir)
+
+    def run(self):
+        """
+        Plan all buildings and collect the results.
+
+        Returns:
+            dict: Fleet metadata and the result of each building keyed by building name.
+        """
+        start = time.perf_counter()
+        plans = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(plan_building, name, config_file, forecast_file): name
+                       for name, (config_file, forecast_file) in self.buildings.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    plans[name] = future.result()
+                except Exception as e:
+                    # The worker itself died, e.g. a crash inside a solver library
+                    plans[name] = {'building': name, 'status': 'failed', 'results': None,
+                                   'error': f"worker failed: {e!r}", 'timing': {}}
+                print(f"{name}: {plans[name]['status']}")
+        return {
+            'metadata': {'date': datetime.now().isoformat(timespec='seconds'),
+                         'fleet_dir': self.fleet_dir,
+                         'workers': self.workers,
+                         'buildings': len(plans),
+                         'failed': sorted(name for name, plan in plans.items() if plan['status'] != 'ok'),
+                         'wall_time': time.perf_counter() - start},
+            'buildings': {name: plans[name] for name in sorted(plans)}
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('fleet_dir', help='directory of building configurations and forecasts')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the CPU count')
+    parser.add_argument('--output', default='fleet_plan.json')
+    args = parser.parse_args(argv)
+
+    report = FleetRunner(args.fleet_dir, args.workers).run()
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2, default=str)
+    metadata = report['metadata']
+    print(f"Planned {metadata['buildings']} buildings in {metadata['wall_time']:.1f} s, "
+          f"{len(metadata['failed'])} failed")
+    return 1 if metadata['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+
+class ForecastBuffer:
+    """
+    Fixed-capacity ring buffer of forecast values keyed by time step.
+
+    Each value is stored in the slot of the time step its timestamp falls in, so a late or repeated
+    message overwrites the value of its own step and memory stays constant however long the agent runs.
+    The values are written twice, at slot and slot + capacity, so any horizon of up to capacity steps
+    is a contiguous view of the storage and is read without copying.
+    """
+
+    def __init__(self, capacity, time_step_minutes=60):
+        """
+        Args:
+            capacity (int): Number of time steps kept, at least the planning horizon.
+            time_step_minutes (int): Length of a time step in minutes.
+        """
+        self.capacity = capacity
+        self.step_seconds = time_step_minutes * 60
+        self.values = np.full(2 * capacity, np.nan)
+        # Absolute time step held by each slot, -1 for an empty slot
+        self.steps = np.full(capacity, -1, dtype=np.int64)
+
+    def step_of(self, timestamp):
+        return int(pd.Timestamp(timestamp).timestamp() // self.step_seconds)
+
+    def put(self, timestamp, value):
+        """
+        Store the value of the time step the timestamp falls in.
+
+        Args:
+            timestamp (datetime): Aware time the value applies to.
+            value (float): The forecast value.
+        """
+        step = self.step_of(timestamp)
+        slot = step % self.capacity
+        self.values[slot] = self.values[slot + self.capacity] = value
+        self.steps[slot] = step
+
+    def horizon(self, start, length, fill=None):
+        """
+        Return the values of the `length` time steps from the one `start` falls in.
+
+        Slots holding another time step than the requested one are cleared. With fill='forward' missing
+        values take the previous value of the horizon, with fill='both' the leading ones also take the
+        first available value. Filled values are stored in the buffer, so the cost of a call only depends
+        on the horizon length.
+
+        Args:
+            start (datetime): Aware start time of the horizon.
+            length (int): Number of time steps, at most the capacity.
+            fill (str): None, 'forward' or 'both'.
+
+        Returns:
+            np.ndarray: Read-only view of the horizon values.
+        """
+        if length > self.capacity:
+            raise ValueError(f"Horizon of {length} steps exceeds the buffer capacity of {self.capacity}")
+        first_step = self.step_of(start)
+        wanted = first_step + np.arange(length)
+        slots = wanted % self.capacity
+        horizon = self.values[slots]
+        horizon[self.steps[slots] != wanted] = np.nan
+        if fill is not None:
+            present = ~np.isnan(horizon)
+            if present.any():
+                previous = np.maximum.accumulate(np.where(present, np.arange(length), -1))
+                if fill == 'both':
+                    previous[previous < 0] = np.argmax(present)
+                filled = previous >= 0
+                horizon[filled] = horizon[previous[filled]]
+        self.values[slots] = self.values[slots + self.capacity] = horizon
+        self.steps[slots] = np.where(np.isnan(horizon), -1, wanted)
+        view = self.values[slots[0]:slots[0] + length]
+        view.flags.writeable = False
+        return view
@@ -0,0 +1,212 @@
+"""
+Planning over a week or the rest of a billing month.
+
+The demand charges are billed on the peak of the month, which a daily window can only price as a
+fraction of the monthly rate. A single model over the whole horizon prices it right, but its size, and
+for the MILP formulations its solve time, grows quickly with the horizon. The horizon is instead split
+into blocks of a day (by default) solved in turn, each with a lookahead window ending at the latest at
+the end of the horizon, where the last block reaches the final SOC. The blocks are linked to the previous
+ones by the SOC and the billing peaks: the peaks already reached are lower bounds of the peak variables
+of the next block, which pays the full monthly demand rate only for raising them. The solve time grows
+linearly with the horizon.
+
+A block does not know whether a later block will need a higher peak anyway, so further passes repeat the
+blocks with the peaks of the previous pass as billing peaks from the start, and the cheapest pass is
+kept. Its cost is the energy cost over the horizon plus the demand charges on the higher of the billing
+peaks and the planned peaks.
+"""
+import time
+from datetime import datetime
+
+import numpy as np
+
+from matrix_model import create_optimization
+from time_steps import window_steps
+
+# Schedules of the storage and of the building kept for the committed time steps of each block
+SCHEDULE_KEYS = ('bess_power', 'tess_power', 'total_power', 'soc_prediction_bess', 'soc_prediction_tess',
+                 'binary', 'tess_u_ch', 'tess_u_dis', 'tess_u')
+SOC_KEYS = {'bess_soc': 'soc_prediction_bess', 'tess_soc': 'soc_prediction_tess'}
+
+
+class LongHorizonPlanner:
+    """
+    Plan the storage over a long horizon by rolling blocks linked by the SOC and the billing peaks. It is
+    used by the solve worker instead of RollingHorizonPlanner when `long_horizon_config` is set, and takes
+    the same requests.
+    """
+
+    def __init__(self, config):
+        """
+        Args:
+            config (dict): Scheduler configuration, as used by Optimization. `long_horizon_config` holds the
+                `block_length` and `lookahead` in time steps (one day each by default), the number of
+                `passes` (default 2) and the `demand_charge_share` of the monthly demand charges the
+                horizon pays (default 1, the whole billing month). `billing_peaks` holds the peaks already
+                reached in the billing month.
+        """
+        self.config = config
+        long_horizon_config = config.get('long_horizon_config', {})
+        time_step_minutes = config.get('time_step_minutes', 60)
+        self.dt = time_step_minutes / 60.
+        self.steps_per_day = int(24 * 60 / time_step_minutes)
+        self.block_length = long_horizon_config.get('block_length', self.steps_per_day)
+        # The SOC carried to the next block is the planned SOC after the block, so one step is the minimum
+        self.lookahead = max(long_horizon_config.get('lookahead', self.steps_per_day), 1)
+        self.passes = max(long_horizon_config.get('passes', 2), 1)
+        self.billing_peaks = dict(config.get('billing_peaks', {}))
+        self.block_config = dict(config, window_length=self.block_length + self.lookahead,
+                                 window_length_unit='steps',
+                                 demand_charge_share=long_horizon_config.get('demand_charge_share', 1.),
+                                 billing_peaks={})
+        # Optimizers of the block windows keyed by their length, and the one of the last block
+        self.optimizers = {}
+        self.optimizer = None
+        self.results = None
+
+    def to_steps(self, values, steps):
+        values = np.asarray(values, dtype=float)
+        if self.dt < 1 and len(values) < steps:
+            # Hourly forecast, repeated over the time steps of each hour
+            values = np.repeat(values, int(round(1 / self.dt)))
+        return values[:steps]
+
+    def block_optimizer(self, forecasts):
+        """
+        Optimizer of a block window with its forecasts set. The window of the blocks near the end of the
+        horizon ends at the horizon, so the terminal SOC of the last block is reached at the end of the
+        horizon as in a single Optimization over it; these shorter windows get an optimizer of their own.
+        """
+        window_length = len(forecasts[0])
+        optimizer = self.optimizers.get(window_length)
+        if optimizer is None:
+            optimizer = create_optimization(*forecasts, dict(self.block_config, window_length=window_length))
+            self.optimizers[window_length] = optimizer
+        else:
+            optimizer.set_forecast(*forecasts)
+        return optimizer
+
+    def demand_terms(self, hours):
+        """
+        Demand charges of the plan as (peak name, rate, window) terms, the window being 1 for the time
+        steps of the hours the peak is taken over.
+        """
+        optimizer = self.optimizer
+        if optimizer.control_type != 3:
+            return []
+        terms = [('peak_power', optimizer.demand_charge_daily, np.ones(len(hours)))]
+        if optimizer.type_of_demand_rate.lower() == 'tou':
+            peak_window, partial_peak_window = optimizer.demand_windows(hours)
+            terms += [('peak_power_during_peak_demand', optimizer.peak_demand_rate_daily, peak_window),
+                      ('peak_power_during_partial_peak_demand', optimizer.part_peak_demand_price_daily,
+                       partial_peak_window)]
+        return terms
+
+    def peaks(self, total_power, hours, floors):
+        """
+        The floors raised to the peaks of the total power over the windows of the demand charges.
+        """
+        peaks = dict(floors)
+        for name, rate, window in self.demand_terms(hours):
+            if window.any():
+                peaks[name] = max(peaks.get(name, 0.), float(np.max(total_power[window > 0])))
+        return peaks
+
+    def sweep(self, load, uncontrollable_load, price, socs, floors):
+        """
+        Solve the blocks of the horizon in turn from the SOCs and billing peak floors.
+
+        Returns:
+            dict: The schedules over the horizon and the solve time and status of each block.
+        """
+        horizon = len(load)
+        socs = dict(socs)
+        running = dict(floors)
+        schedules = {}
+        blocks = []
+        for start in range(0, horizon, self.block_length):
+            committed = min(self.block_length, horizon - start)
+            end = min(start + self.block_length + self.lookahead, horizon)
+            self.optimizer = self.block_optimizer([values[start:end]
+                                                   for values in (load, uncontrollable_load, price)])
+            self.optimizer.set_start_hour(self.horizon_hours[start])
+            self.optimizer.update(**socs)
+            self.optimizer.set_billing_peaks(**running)
+            block_start = time.perf_counter()
+            results = self.optimizer.run_opt()
+            blocks.append({'start': start, 'solve_time': time.perf_counter() - block_start,
+                           'solver': results.get('solver'), 'cost': results['cost']})
+            for key in SCHEDULE_KEYS:
+                if key in results:
+                    schedules.setdefault(key, []).extend(results[key][:committed])
+            for name, key in SOC_KEYS.items():
+                if key in results and committed < len(results[key]):
+                    socs[name] = results[key][committed]
+            running = self.peaks(np.asarray(results['total_power'][:committed]),
+                                 self.horizon_hours[start:start + committed], running)
+        schedules['blocks'] = blocks
+        schedules['peaks'] = running
+        return schedules
+
+    def cost(self, plan, price, billing_peaks):
+        """
+        Energy cost over the horizon and demand charges on the higher of the billing and planned peaks.
+        """
+        total_power = np.asarray(plan['total_power'])
+        energy_cost = float(np.sum(price * total_power * self.dt))
+        peaks = self.peaks(total_power, self.horizon_hours, billing_peaks)
+        demand_cost = sum(rate * peaks[name] for name, rate, window in self.demand_terms(self.horizon_hours)
+                          if name in peaks)
+        return energy_cost, float(demand_cost), peaks
+
+    def plan(self, load, uncontrollable_load, price, update=None, shift=0):
+        """
+        Plan the storage over the horizon of the forecasts.
+
+        Args:
+            load (list): Building load forecast over the horizon, hourly or one value per time step.
+            uncontrollable_load (list): Uncontrollable load forecast over the horizon.
+            price (list): Price forecast over the horizon.
+            update (dict): The measured `bess_soc` and `tess_soc`, the hour of the day of the first time
+                step as `_hour` (the current hour by default) and the `billing_peaks` reached so far in the
+                month.
+            shift (int): Accepted for compatibility with RollingHorizonPlanner; the blocks are not warm
+                started.
+
+        Returns:
+            dict: The schedules over the horizon, the total, energy and demand cost, the planned peaks,
+            the solve time of each block and pass, and the pass the plan comes from.
+        """
+        update = dict(update or {})
+        start = time.perf_counter()
+        start_hour = update.get('_hour')
+        if start_hour is None:
+            # The horizon starts now, as the forecasts of the agent do
+            start_hour = datetime.now().hour
+        billing_peaks = dict(self.billing_peaks, **(update.get('billing_peaks') or {}))
+        socs = {name: update[name] for name in SOC_KEYS if update.get(name) is not None}
+        steps = window_steps(self.config) if 'window_length' in self.config else len(load)
+        self.horizon_hours = (start_hour + np.arange(steps) * self.dt) % 24
+        load, uncontrollable_load, price = (self.to_steps(values, steps)
+                                            for values in (load, uncontrollable_load, price))
+
+        best = None
+        floors = billing_peaks
+        passes = []
+        for index in range(self.passes):
+            plan = self.sweep(load, uncontrollable_load, price, socs, floors)
+            energy_cost, demand_cost, peaks = self.cost(plan, price, billing_peaks)
+            passes.append({'cost': energy_cost + demand_cost,
+                           'solve_time': sum(block['solve_time'] for block in plan['blocks'])})
+            if best is None or energy_cost + demand_cost < best['cost']:
+                best = dict(plan, cost=energy_cost + demand_cost, energy_cost=energy_cost,
+                            demand_cost=demand_cost, peaks=peaks, best_pass=index)
+            if all(abs(peaks[name] - floors.get(name, 0.)) < 1e-6 for name in peaks):
+                # The peaks of the pass were all paid for from the start, another pass gives the same plan
+                break
+            floors = peaks
+        best.update(passes=passes, time_step_minutes=self.optimizer.time_step_minutes,
+                    peak_load_prediction=best['peaks'].get('peak_power'),
+                    timings={'long_horizon': time.perf_counter() - start})
+        self.results = best
+        return best
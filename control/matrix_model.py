@@ -0,0 +1,347 @@
+"""
+Matrix engine for the linear and MILP formulations of the optimization.
+
+Instead of calling a Pyomo rule per constraint and time step, the constraint matrix, bounds and objective
+are assembled directly as NumPy arrays and a SciPy sparse matrix, one vectorized block per constraint
+family, and passed to HiGHS in process through highspy. The formulation is the one of the Pyomo model:
+the BESS model, the TESS model with the piecewise-linear envelopes in incremental (INC) form and the
+demand charge terms of Optimization, so both engines give the same optimal cost. The polynomial TESS
+envelopes are nonlinear and stay on the Pyomo engine.
+"""
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from optimization import Optimization
+from model.bess import BatteryEnergyStorageSystem
+from model.tess import ThermalEnergyStorageSystem
+
+
+class SparseBuilder:
+    """
+    Collect the columns and rows of a linear program as NumPy blocks.
+    """
+
+    def __init__(self):
+        self.num_cols = 0
+        self.num_rows = 0
+        self.col_lower, self.col_upper, self.integer = [], [], []
+        self.row_lower, self.row_upper = [], []
+        self.rows, self.cols, self.values = [], [], []
+        self.cost_cols, self.cost_values = [], []
+
+    def add_vars(self, count, lower=-np.inf, upper=np.inf, integer=False):
+        """
+        Add `count` variables with the given bounds.
+
+        Returns:
+            np.ndarray: The column index of each variable.
+        """
+        index = np.arange(self.num_cols, self.num_cols + count)
+        self.num_cols += count
+        self.col_lower.append(np.broadcast_to(np.asarray(lower, dtype=float), (count,)))
+        self.col_upper.append(np.broadcast_to(np.asarray(upper, dtype=float), (count,)))
+        self.integer.append(np.full(count, integer))
+        return index
+
+    def add_rows(self, terms, lower=-np.inf, upper=np.inf):
+        """
+        Add one row per entry of the term columns: lower <= sum(coef * x[col]) <= upper.
+
+        Args:
+            terms (list): (columns, coefficients) pairs of equal length arrays, or scalar coefficients.
+            lower, upper (float or np.ndarray): Row bounds.
+
+        Returns:
+            np.ndarray: The index of each row.
+        """
+        count = len(terms[0][0])
+        index = np.arange(self.num_rows, self.num_rows + count)
+        self.num_rows += count
+        for cols, coefs in terms:
+            self.rows.append(index)
+            self.cols.append(np.asarray(cols))
+            self.values.append(np.broadcast_to(np.asarray(coefs, dtype=float), (count,)))
+        self.row_lower.append(np.broadcast_to(np.asarray(lower, dtype=float), (count,)))
+        self.row_upper.append(np.broadcast_to(np.asarray(upper, dtype=float), (count,)))
+        return index
+
+    def add_cost(self, cols, coefs):
+        cols = np.atleast_1d(cols)
+        self.cost_cols.append(cols)
+        self.cost_values.append(np.broadcast_to(np.asarray(coefs, dtype=float), cols.shape))
+
+    def matrix(self):
+        """
+        Returns:
+            tuple: The cost vector, CSC constraint matrix, row bounds, column bounds and integrality.
+        """
+        cost = np.zeros(self.num_cols)
+        np.add.at(cost, np.concatenate(self.cost_cols), np.concatenate(self.cost_values))
+        a_matrix = sp.coo_matrix((np.concatenate(self.values), (np.concatenate(self.rows), np.concatenate(self.cols))),
+                                 shape=(self.num_rows, self.num_cols)).tocsc()
+        return (cost, a_matrix, np.concatenate(self.row_lower), np.concatenate(self.row_upper),
+                np.concatenate(self.col_lower), np.concatenate(self.col_upper), np.concatenate(self.integer))
+
+
+class MatrixOptimization(Optimization):
+    """
+    Optimization assembled as a sparse matrix and solved in process with HiGHS. It has the interface of
+    Optimization (set_forecast, update, run_opt, get_results, shift_solution) and is selected with
+    `"engine": "matrix"` in the configuration.
+    """
+
+    def build_model(self, config):
+        self.model = None
+        if self.use_bess:
+            self.bess = BatteryEnergyStorageSystem(None, dict(config['bess_config'], window_length=self.window_length,
+                                                              time_step_minutes=self.time_step_minutes))
+        if self.use_tess:
+            self.tess = ThermalEnergyStorageSystem(None, dict(config['tess_config'], window_length=self.window_length,
+                                                              time_step_minutes=self.time_step_minutes))
+            if self.tess.formulation != 'piecewise':
+                raise ValueError("The matrix engine needs the piecewise TESS formulation, "
+                                 "the polynomial one is nonlinear")
+        self.set_start_hour(self.start_hour)
+        # Column blocks of the last assembled model and its solution
+        self.columns = {}
+        self.solution = None
+
+    def set_start_hour(self, start_hour):
+        self.start_hour = start_hour
+        hours = (start_hour + np.arange(self.window_length) * self.dt) % 24
+        self.peak_window = np.zeros(self.window_length)
+        self.partial_peak_window = np.zeros(self.window_length)
+        if self.control_type == 3 and self.type_of_demand_rate.lower() == 'tou':
+            self.peak_window, self.partial_peak_window = self.demand_windows(hours)
+
+    def set_forecast(self, load, uncontrollable_load, price=None):
+        with self.timer.phase('forecast'):
+            self.load = self.to_steps(load)
+            self.uncontrollable_load = self.to_steps(uncontrollable_load)
+            self.cooling_load = [a - b for a, b in zip(self.load, self.uncontrollable_load)]
+            if price is not None and self.use_price_forecast:
+                self.prices = self.price_forecast = self.to_steps(price)
+
+    def assemble(self):
+        """
+        Assemble the model for the current forecasts, SOCs and demand windows.
+
+        Returns:
+            tuple: The arrays of SparseBuilder.matrix.
+        """
+        n = self.window_length
+        steps = np.arange(n)
+        load = np.asarray(self.load[:n], dtype=float)
+        uncontrollable_load = np.asarray(self.uncontrollable_load[:n], dtype=float)
+        price = np.asarray(self.prices[:n], dtype=float)
+        builder = SparseBuilder()
+        columns = {}
+
+        columns['total_power'] = total_power = builder.add_vars(n, 0.)
+        # total_power = -bess_power + building_load + tess_power
+        total_terms = [(total_power, 1.)]
+
+        if self.use_bess:
+            bess = self.bess
+            columns['bess_discharging_power'] = discharging = builder.add_vars(n, 0., bess.rated_power_kw)
+            columns['bess_charging_power'] = charging = builder.add_vars(n, 0., bess.rated_power_kw)
+            columns['bess_power'] = power = builder.add_vars(n)
+            columns['bess_power_with_losses'] = power_with_losses = builder.add_vars(n)
+            columns['state_of_charge'] = soc = builder.add_vars(n, bess.min_soc, bess.max_soc)
+            columns['charge_status_binary'] = binary = builder.add_vars(n, 0., 1., integer=True)
+            energy_factor = bess.dt / bess.rated_energy_kwh * 100
+            builder.add_rows([(soc[:1], 1.)], bess.initial_soc, bess.initial_soc)
+            builder.add_rows([(soc[1:], 1.), (soc[:-1], -1.), (power_with_losses[:-1], energy_factor)], 0., 0.)
+            builder.add_rows([(power, 1.), (charging, 1.), (discharging, -1.)], 0., 0.)
+            builder.add_rows([(power_with_losses, 1.), (charging, bess.charging_efficiency),
+                              (discharging, -1 / bess.discharging_efficiency)], 0., 0.)
+            builder.add_rows([(total_power, 1.)], bess.min_building_power)
+            builder.add_rows([(charging, 1.), (binary, -bess.max_charging_power)], upper=0.)
+            builder.add_rows([(discharging, 1.), (binary, bess.max_discharging_power)], upper=bess.max_discharging_power)
+            builder.add_rows([(soc[-1:], 1.)], bess.target_soc, bess.target_soc)
+            builder.add_rows([(soc[-1:], 1.), (power_with_losses[-1:], -energy_factor)], bess.target_soc, bess.target_soc)
+            total_terms.append((power, 1.))
+
+        if self.use_tess:
+            tess = self.tess
+            columns['tess_state_of_charge'] = soc = builder.add_vars(n, tess.min_soc, tess.max_soc)
+            columns['tess_energy_usage'] = usage = builder.add_vars(n)
+            columns['tess_power'] = power = builder.add_vars(n)
+            columns['tess_charging'] = charging = builder.add_vars(n, 0.)
+            columns['tess_discharging'] = discharging = builder.add_vars(n, 0.)
+            columns['tess_binary'] = binary = builder.add_vars(n, 0., 1., integer=True)
+            columns['tess_charging_envelope'] = charging_envelope = builder.add_vars(n, 0.)
+            columns['tess_discharging_envelope'] = discharging_envelope = builder.add_vars(n, 0.)
+            builder.add_rows([(soc[:1], 1.)], tess.initial_soc, tess.initial_soc)
+            builder.add_rows([(soc[1:], 1.), (soc[:-1], -1.), (usage[:-1], tess.dt / tess.storage_capacity * 100)], 0., 0.)
+            builder.add_rows([(usage, 1.), (charging, 1.), (discharging, -1.)], 0., 0.)
+            builder.add_rows([(power, 1.), (usage, 1 / tess.cop)], 0., 0.)
+            builder.add_rows([(total_power, 1.)], uncontrollable_load)
+            builder.add_rows([(discharging, 1.), (binary, -(load - uncontrollable_load) * tess.cop)], upper=0.)
+            builder.add_rows([(soc[-1:], 1.)], tess.final_soc)
+
+            # Incremental (INC) piecewise-linear envelopes of the SOC; both envelopes share the SOC and its
+            # breakpoints, so they share the segment fill variables and binaries
+            soc_points = np.asarray(tess.soc_breakpoints())
+            charging_points = np.array([tess.charging_rate_limit(point) for point in soc_points])
+            discharging_points = np.array([tess.discharging_rate_limit(point) for point in soc_points])
+            segments = len(soc_points) - 1
+            columns['tess_segment_fill'] = fill = builder.add_vars(n * segments, 0., 1.).reshape(n, segments)
+            fill_terms = lambda points: [(fill[:, k], -(points[k + 1] - points[k])) for k in range(segments)]
+            builder.add_rows([(soc, 1.)] + fill_terms(soc_points), soc_points[0], soc_points[0])
+            builder.add_rows([(charging_envelope, 1.)] + fill_terms(charging_points), charging_points[0], charging_points[0])
+            builder.add_rows([(discharging_envelope, 1.)] + fill_terms(discharging_points),
+                             discharging_points[0], discharging_points[0])
+            if segments > 1:
+                columns['tess_segment_binary'] = segment_binary = builder.add_vars(
+                    n * (segments - 1), 0., 1., integer=True).reshape(n, segments - 1)
+                for k in range(segments - 1):
+                    builder.add_rows([(fill[:, k + 1], 1.), (segment_binary[:, k], -1.)], upper=0.)
+                    builder.add_rows([(segment_binary[:, k], 1.), (fill[:, k], -1.)], upper=0.)
+
+            max_charging, max_discharging = charging_points.max(), discharging_points.max()
+            builder.add_rows([(charging, 1.), (charging_envelope, -1.)], upper=0.)
+            builder.add_rows([(charging, 1.), (binary, max_charging)], upper=max_charging)
+            builder.add_rows([(discharging, 1.), (discharging_envelope, -1.)], upper=0.)
+            builder.add_rows([(discharging, 1.), (binary, -max_discharging)], upper=0.)
+            total_terms.append((power, -1.))
+
+        builder.add_rows(total_terms, load, load)
+
+        if self.control_type == 3:
+            # The billing peaks are read at each assembly, so set_billing_peaks needs no model update
+            columns['peak_power'] = peak_power = builder.add_vars(1, self.billing_peaks.get('peak_power', -np.inf))
+            builder.add_rows([(total_power, 1.), (np.repeat(peak_power, n), -1.)], upper=0.)
+            builder.add_cost(peak_power, self.demand_charge_daily)
+            if self.type_of_demand_rate.lower() == 'tou':
+                columns['peak_power_during_peak_demand'] = peak = builder.add_vars(
+                    1, max(self.billing_peaks.get('peak_power_during_peak_demand', 0.), 0.))
+                columns['peak_power_during_partial_peak_demand'] = partial_peak = builder.add_vars(
+                    1, max(self.billing_peaks.get('peak_power_during_partial_peak_demand', 0.), 0.))
+                for window, column in ((self.peak_window, peak), (self.partial_peak_window, partial_peak)):
+                    active = steps[window > 0]
+                    if len(active):
+                        builder.add_rows([(total_power[active], 1.), (np.repeat(column, len(active)), -1.)], upper=0.)
+                builder.add_cost(peak, self.peak_demand_rate_daily)
+                builder.add_cost(partial_peak, self.part_peak_demand_price_daily)
+        elif self.control_type in [1, 2]:
+            builder.add_rows([(total_power, 1.)], upper=max(load))
+        else:
+            builder.add_rows([(total_power, 1.)], upper=self.peak_demand_limit)
+        builder.add_cost(total_power, price * self.dt)
+
+        self.columns = columns
+        return builder.matrix()
+
+    def solve_matrix(self, cost, a_matrix, row_lower, row_upper, col_lower, col_upper, integer, warmstart=False):
+        """
+        Solve the assembled model with HiGHS under the time limit and MIP gap of the solver configuration.
+
+        Returns:
+            str: The model status.
+        """
+        import highspy
+
+        highs = highspy.Highs()
+        highs.setOptionValue('output_flag', bool(self.solver.tee))
+        highs.setOptionValue('time_limit', float(self.solver.time_limit))
+        highs.setOptionValue('mip_rel_gap', float(self.solver.mip_gap))
+        lp = highspy.HighsLp()
+        lp.num_col_, lp.num_row_ = a_matrix.shape[1], a_matrix.shape[0]
+        lp.col_cost_ = cost
+        lp.col_lower_, lp.col_upper_ = col_lower, col_upper
+        lp.row_lower_, lp.row_upper_ = row_lower, row_upper
+        lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+        lp.a_matrix_.start_ = a_matrix.indptr
+        lp.a_matrix_.index_ = a_matrix.indices
+        lp.a_matrix_.value_ = a_matrix.data
+        if integer.any():
+            lp.integrality_ = [highspy.HighsVarType.kInteger if flag else highspy.HighsVarType.kContinuous
+                               for flag in integer]
+        highs.passModel(lp)
+        if warmstart and self.solution is not None and len(self.solution) == lp.num_col_:
+            start = highspy.HighsSolution()
+            start.col_value = list(self.solution)
+            highs.setSolution(start)
+        highs.run()
+        status = highs.modelStatusToString(highs.getModelStatus())
+        info = highs.getInfo()
+        self.solver.attempts.append({"solver": "highs", "status": status,
+                                     "iterations": info.simplex_iteration_count,
+                                     "nodes": info.mip_node_count,
+                                     "mip_gap": info.mip_gap})
+        if info.primal_solution_status == highspy.SolutionStatus.kSolutionStatusFeasible:
+            self.solution = np.array(highs.getSolution().col_value)
+            self.objective_value = highs.getInfo().objective_function_value
+        elif status != 'Optimal':
+            raise RuntimeError(f"HiGHS could not solve the matrix model: {status}")
+        return status
+
+    def run_opt(self, warmstart=False):
+        self.solver.attempts = []
+        with self.timer.phase('assemble'):
+            arrays = self.assemble()
+        start = time.time()
+        with self.timer.phase('solve'):
+            self.solve_matrix(*arrays, warmstart=warmstart)
+        self.solver.attempts[-1]['solve_time'] = time.time() - start
+        with self.timer.phase('extract'):
+            results = self.get_results('highs')
+        results['timings'] = dict(self.timer.timings)
+        self.timer.reset()
+        return results
+
+    def values(self, name):
+        return [float(value) for value in self.solution[self.columns[name]]]
+
+    def get_results(self, solver_name=None):
+        results = {
+            'peak_load_prediction': float(self.solution[self.columns['peak_power']][0]) if self.control_type == 3 else None,
+            'total_power': self.values('total_power'),
+            'cost': self.objective_value,
+            'cooling_load': self.cooling_load,
+            'time_step_minutes': self.time_step_minutes,
+            'solver': solver_name,
+            'solve_attempts': self.solver.attempts
+        }
+        if self.use_bess:
+            results['soc_prediction_bess'] = self.values('state_of_charge')
+            results['bess_power'] = self.values('bess_power')
+        if self.use_tess:
+            results.update({
+                'soc_prediction_tess': self.values('tess_state_of_charge'),
+                'tess_power': self.values('tess_power'),
+                'binary': self.values('tess_binary'),
+                'tess_u_ch': self.values('tess_charging'),
+                'tess_u_dis': self.values('tess_discharging'),
+                'tess_u': self.values('tess_energy_usage')
+            })
+        return results
+
+    def shift_solution(self, steps=1):
+        if self.solution is None:
+            return
+        for columns in self.columns.values():
+            if columns.shape[0] != self.window_length:
+                continue
+            source = np.minimum(np.arange(self.window_length) + steps, self.window_length - 1)
+            self.solution[columns] = self.solution[columns[source]]
+
+
+def create_optimization(load, uncontrollable_load, price, config):
+    """
+    Create the optimization with the engine selected by the `engine` key of the configuration:
+    'pyomo' (default), 'matrix', 'dp' or 'portfolio'.
+    """
+    engine = config.get('engine', 'pyomo').lower()
+    if engine == 'matrix':
+        return MatrixOptimization(load, uncontrollable_load, price, config)
+    if engine == 'dp':
+        from dp_dispatch import DynamicProgrammingOptimization
+        return DynamicProgrammingOptimization(load, uncontrollable_load, price, config)
+    if engine == 'portfolio':
+        from portfolio import PortfolioOptimization
+        return PortfolioOptimization(load, uncontrollable_load, price, config)
+    return Optimization(load, uncontrollable_load, price, config)
@@ -0,0 +1,78 @@
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class PhaseTimer:
+    """
+    Record the wall-clock duration of the named phases of a planning run.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block and add its duration, in seconds, to the phase. A phase entered several
+        times, e.g. the variables of the BESS and of the TESS, accumulates.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.) + time.perf_counter() - start
+
+    def reset(self):
+        self.timings = {}
+
+
+class RollingMetrics:
+    """
+    Keep the last values of each metric and summarize them with rolling percentiles.
+    """
+
+    def __init__(self, size=100, metrics_file=None):
+        """
+        Args:
+            size (int): Number of values kept per metric.
+            metrics_file (str): File every recorded run is appended to as a JSON line, if any.
+        """
+        self.size = size
+        self.metrics_file = metrics_file
+        self.values = {}
+
+    def add(self, name, value):
+        if value is None:
+            return
+        if name not in self.values:
+            self.values[name] = deque(maxlen=self.size)
+        self.values[name].append(float(value))
+
+    def add_all(self, values, prefix=''):
+        for name, value in values.items():
+            self.add(prefix + name, value)
+
+    def summary(self):
+        """
+        Returns:
+            dict: Last value, count and 50th, 90th and 99th percentiles of each metric.
+        """
+        summary = {}
+        for name, values in self.values.items():
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            summary[name] = {'last': values[-1], 'count': len(values),
+                             'p50': float(p50), 'p90': float(p90), 'p99': float(p99)}
+        return summary
+
+    def write(self, record):
+        """
+        Append a record to the metrics file, if one is configured.
+        """
+        if self.metrics_file is None:
+            return
+        with open(self.metrics_file, 'a') as metrics_file:
+            metrics_file.write(json.dumps(record, default=str) + '\n')
@@ -17,6 +17,8 @@ class BatteryEnergyStorageSystem():
         - config (dict): Configuration parameters for the BESS.
         """
         self.window_length = config.get("window_length", 24)
+        self.time_step_minutes = config.get("time_step_minutes", 60)
+        self.dt = self.time_step_minutes / 60.
         self.rated_power_kw = config.get("rated_kw", 100.)
         self.rated_energy_kwh = config.get("rated_kwh", 200)
         self.min_building_power = config.get("building_power_min", 0.)
@@ -30,33 +32,50 @@ class BatteryEnergyStorageSystem():
         self.max_soc = config.get("max_soc", 80)
         self.time_intervals = range(0, self.window_length)
 
-        # Create Pyomo model
+        # Declare the BESS components on the shared Pyomo model, if one is given
         self.model = model
-        self.model.bess_discharging_power = pyo.Var(self.time_intervals, bounds=(0, self.rated_power_kw))
-        self.model.bess_charging_power = pyo.Var(self.time_intervals, bounds=(0, self.rated_power_kw))
-        self.model.bess_power = pyo.Var(self.time_intervals)
-        self.model.total_power_consumption = pyo.Var(self.time_intervals, bounds=(0, None))
-        self.model.state_of_charge = pyo.Var(self.time_intervals, bounds=(self.min_soc, self.max_soc))
-        self.model.charge_status_binary = pyo.Var(self.time_intervals, domain=pyo.Binary, bounds=(0, 1), initialize=0)
+        if model is not None:
+            self.set_model_variable()
 
     def set_model_variable(self):
-        self.model = pyo.ConcreteModel()
+        """
+        Declare the BESS variables, and the mutable initial and final SOC parameters, on the shared model.
+        The model is built once per configuration; re-plans only change the parameter values through update().
+        """
+        self.model.bess_initial_soc = pyo.Param(mutable=True, initialize=self.initial_soc)
+        self.model.bess_final_soc = pyo.Param(mutable=True, initialize=self.target_soc)
         self.model.bess_discharging_power = pyo.Var(self.time_intervals, bounds=(0, self.rated_power_kw))
         self.model.bess_charging_power = pyo.Var(self.time_intervals, bounds=(0, self.rated_power_kw))
         self.model.bess_power = pyo.Var(self.time_intervals)
         self.model.bess_power_with_losses = pyo.Var(self.time_intervals)
-        self.model.total_power_consumption = pyo.Var(self.time_intervals, bounds=(0, None))
         self.model.state_of_charge = pyo.Var(self.time_intervals, bounds=(self.min_soc, self.max_soc))
         self.model.charge_status_binary = pyo.Var(self.time_intervals, domain=pyo.Binary, bounds=(0, 1), initialize=0)
 
+    def update(self, initial_soc=None, final_soc=None):
+        """
+        Update the mutable SOC parameters of the model in place.
+
+        Args:
+        - initial_soc (float): Measured SOC at the start of the optimization window.
+        - final_soc (float): SOC to reach at the end of the optimization window.
+        """
+        if initial_soc is not None:
+            self.initial_soc = initial_soc
+            if self.model is not None:
+                self.model.bess_initial_soc.set_value(initial_soc)
+        if final_soc is not None:
+            self.target_soc = final_soc
+            if self.model is not None:
+                self.model.bess_final_soc.set_value(final_soc)
+
     def soc_constraint(self, model, interval):
         """
         Define the state of charge (SOC) constraint for the BESS model.
         """
         if interval == 0:
-            return model.state_of_charge[interval] == self.initial_soc
+            return model.state_of_charge[interval] == model.bess_initial_soc
         else:
-            return model.state_of_charge[interval] == model.state_of_charge[interval - 1] - (model.bess_power_with_losses[interval - 1] / self.rated_energy_kwh) * 100
+            return model.state_of_charge[interval] == model.state_of_charge[interval - 1] - (model.bess_power_with_losses[interval - 1] * self.dt / self.rated_energy_kwh) * 100
 
     def bess_power_constraint(self, model, interval):
         """
@@ -74,13 +93,7 @@ class BatteryEnergyStorageSystem():
         """
         Enforce min total power constraint.
         """
-        return model.total_power_consumption[interval] >= self.min_building_power
-
-    def max_total_power_constraint(self, model, interval):
-        """
-        Enforce max total power constraint.
-        """
-        return model.total_power_consumption[interval] <= model.peak_building_power
+        return model.total_power[interval] >= self.min_building_power
 
     def min_soc_constraint(self, model, interval):
         """
@@ -122,8 +135,8 @@ class BatteryEnergyStorageSystem():
         """
         Enforce final SOC constraint where the final SOC should equal the reference SOC.
         """
-        if interval == 23:
-            return model.state_of_charge[interval] == self.target_soc
+        if interval == self.time_intervals[-1]:
+            return model.state_of_charge[interval] == model.bess_final_soc
         else:
             return pyo.Constraint.Skip
     
@@ -131,8 +144,8 @@ class BatteryEnergyStorageSystem():
         """
         Enforce alternative final SOC constraint with power loss consideration.
         """
-        if interval == 23:
-            return model.state_of_charge[interval] - (model.bess_power_with_losses[interval] / self.rated_energy_kwh) * 100 == self.target_soc
+        if interval == self.time_intervals[-1]:
+            return model.state_of_charge[interval] - (model.bess_power_with_losses[interval] * self.dt / self.rated_energy_kwh) * 100 == model.bess_final_soc
         else:
             return pyo.Constraint.Skip
 
@@ -144,7 +157,6 @@ class BatteryEnergyStorageSystem():
         self.model.bess_power_constraint = pyo.Constraint(self.time_intervals, rule=self.bess_power_constraint)
         self.model.power_loss_constraint = pyo.Constraint(self.time_intervals, rule=self.power_loss_constraint)
         self.model.min_total_power_constraint = pyo.Constraint(self.time_intervals, rule=self.min_total_power_constraint)
-        self.model.max_total_power_constraint = pyo.Constraint(self.time_intervals, rule=self.max_total_power_constraint)
         self.model.min_soc_constraint = pyo.Constraint(self.time_intervals, rule=self.min_soc_constraint)
         self.model.max_soc_constraint = pyo.Constraint(self.time_intervals, rule=self.max_soc_constraint)
         self.model.min_bess_charging_power_constraint = pyo.Constraint(self.time_intervals, rule=self.min_bess_charging_power_constraint)
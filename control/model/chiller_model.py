@@ -35,17 +35,18 @@ class ChillerModel:
         return df
 
     def poly(self, c, x, order=2):
+        # x may be a scalar or an array; the explicit orders are evaluated element-wise
         result = None
         if isinstance(c, np.ndarray):
             arr = np.array(range(1, len(c)))
-            result = c[0] + np.sum(c[1:] * (x ** arr))
+            result = c[0] + np.sum(c[1:] * (np.asarray(x)[..., None] ** arr), axis=-1)
         elif order == 2:
             result = c[0] + c[1] * x + c[2] * x ** 2
         elif order == 6:
             result = c[0] + c[1] * x + c[2] * x ** 2 + c[3] * x ** 3 + c[4] * x ** 4 + c[5] * x ** 5 + c[6] * x ** 6
         else:
-            arr = range(1, len(c))
-            result = c[0] + np.sum(c[1:] * (x ** arr))
+            arr = np.array(range(1, len(c)))
+            result = c[0] + np.sum(np.asarray(c[1:]) * (np.asarray(x)[..., None] ** arr), axis=-1)
         return result
 
     def sigma_1(self, T_cw, t_out, coef):
@@ -71,14 +72,17 @@ class ChillerModel:
         return p_chiller
 
     def adjust_chiller_model(self, df, method):
-        df['chiller_power'] = 0
+        """
+        Convert the predicted cooling load to chiller power for the whole frame in one vectorized pass.
+        sigma_1, sigma_3, Q_avail and P_chiller accept NumPy arrays as well as scalars.
+        """
+        df['chiller_power'] = 0.
         if method == 1:
             if type(self.t_cw_norm) != str:
-                for i in range(len(df)):
-                    df['chiller_power'][i] = self.P_chiller(df['Predict'][i], (self.t_cw_norm - 32) * 5 / 9, df['OAT'][i])
+                t_cw = (self.t_cw_norm - 32) * 5 / 9
             else:
-                for i in range(len(df)):
-                    df['chiller_power'][i] = self.P_chiller(df['Predict'][i], df[self.parameters.get('t_cw_norm')][i], df['OAT'][i])
+                t_cw = df[self.parameters.get('t_cw_norm')].to_numpy(dtype=float)
+            df['chiller_power'] = self.P_chiller(df['Predict'].to_numpy(dtype=float), t_cw, df['OAT'].to_numpy(dtype=float))
         elif method == 2:
             df['chiller_power'] = df['Predict'] / self.COP
         return df
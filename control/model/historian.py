@@ -0,0 +1,149 @@
+import os
+import sqlite3
+from contextlib import closing
+import pandas as pd
+
+
+class CsvHistorian:
+    """
+    Historian backend reading the whole CSV export on every query.
+    """
+
+    def __init__(self, database_file, ts_name='Time'):
+        """
+        Args:
+            database_file (str): Path of the CSV export of the historian.
+            ts_name (str): Name of the timestamp column in the CSV file.
+        """
+        self.database_file = database_file
+        self.ts_name = ts_name
+
+    def query(self, start_utc, end_utc=None, columns=None):
+        """
+        Read the rows in [start_utc, end_utc) restricted to the given columns.
+
+        Args:
+            start_utc (datetime): Aware start of the range, inclusive.
+            end_utc (datetime): Aware end of the range, exclusive. Unbounded if None.
+            columns (list): Columns to read. All columns if None; columns absent from the file are ignored.
+
+        Returns:
+            pd.DataFrame: The rows in the range, with the timestamp column as stored.
+        """
+        usecols = None if columns is None else (lambda col: col in set(columns) | {self.ts_name})
+        df = pd.read_csv(self.database_file, usecols=usecols)
+        ts = pd.to_datetime(df[self.ts_name], utc=True)
+        mask = ts >= start_utc
+        if end_utc is not None:
+            mask &= ts < end_utc
+        return df[mask].reset_index(drop=True)
+
+
+class SQLiteHistorian:
+    """
+    Historian backend keeping the data in a local SQLite store indexed by timestamp, so a query is a
+    bounded range read of the requested columns only. The store is filled once from the CSV export
+    and ingested again only when the CSV file changes.
+    """
+    table = 'historian'
+    ts_key = '_ts'
+
+    def __init__(self, store_file, database_file=None, ts_name='Time', chunksize=100000):
+        """
+        Args:
+            store_file (str): Path of the SQLite store.
+            database_file (str): Path of the CSV export to ingest into the store, if any.
+            ts_name (str): Name of the timestamp column in the CSV file.
+            chunksize (int): Number of CSV rows ingested at a time.
+        """
+        self.store_file = store_file
+        self.database_file = database_file
+        self.ts_name = ts_name
+        self.chunksize = chunksize
+        if database_file is not None:
+            self.ingest_csv(database_file)
+
+    def connect(self):
+        return sqlite3.connect(self.store_file)
+
+    def source_signature(self, csv_file):
+        stat = os.stat(csv_file)
+        return f"{os.path.abspath(csv_file)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def ingest_csv(self, csv_file, force=False):
+        """
+        Load the CSV export into the store, unless the same file was already ingested.
+
+        Args:
+            csv_file (str): Path of the CSV export.
+            force (bool): Ingest even if the file was already ingested.
+        """
+        signature = self.source_signature(csv_file)
+        with closing(self.connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS historian_meta (key TEXT PRIMARY KEY, value TEXT)")
+            row = conn.execute("SELECT value FROM historian_meta WHERE key = 'source'").fetchone()
+            if row is not None and row[0] == signature and not force:
+                return
+            conn.execute(f"DROP TABLE IF EXISTS {self.table}")
+            for chunk in pd.read_csv(csv_file, chunksize=self.chunksize):
+                ts = pd.to_datetime(chunk[self.ts_name], utc=True)
+                chunk.insert(0, self.ts_key, ts.astype('int64') // 10 ** 9)
+                chunk.to_sql(self.table, conn, if_exists='append', index=False)
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_ts ON {self.table} ({self.ts_key})")
+            conn.execute("INSERT OR REPLACE INTO historian_meta (key, value) VALUES ('source', ?)", (signature,))
+
+    def stored_columns(self, conn):
+        return [row[1] for row in conn.execute(f"PRAGMA table_info({self.table})")]
+
+    def query(self, start_utc, end_utc=None, columns=None):
+        """
+        Read the rows in [start_utc, end_utc) restricted to the given columns.
+
+        Args:
+            start_utc (datetime): Aware start of the range, inclusive.
+            end_utc (datetime): Aware end of the range, exclusive. Unbounded if None.
+            columns (list): Columns to read. All columns if None; columns absent from the store are ignored.
+
+        Returns:
+            pd.DataFrame: The rows in the range, with the timestamp column as stored.
+        """
+        with closing(self.connect()) as conn:
+            stored = self.stored_columns(conn)
+            if columns is None:
+                selected = [col for col in stored if col != self.ts_key]
+            else:
+                wanted = set(columns) | {self.ts_name}
+                selected = [col for col in stored if col in wanted]
+            sql = "SELECT {} FROM {} WHERE {} >= ?".format(
+                ', '.join(f'"{col}"' for col in selected), self.table, self.ts_key)
+            params = [int(pd.Timestamp(start_utc).timestamp())]
+            if end_utc is not None:
+                sql += f" AND {self.ts_key} < ?"
+                params.append(int(pd.Timestamp(end_utc).timestamp()))
+            sql += f" ORDER BY {self.ts_key}"
+            return pd.read_sql_query(sql, conn, params=params)
+
+
+def make_historian(config, ts_name='Time'):
+    """
+    Create the historian backend described by the configuration.
+
+    Args:
+        config (dict): Hot5 configuration. The optional 'historian' entry selects the backend, e.g.
+            {"type": "sqlite", "store_file": "historian.sqlite"}; 'database_file' is the CSV export.
+        ts_name (str): Name of the timestamp column in the CSV file.
+
+    Returns:
+        The historian backend.
+    """
+    historian_config = config.get('historian', {})
+    historian_type = historian_config.get('type', 'csv').lower()
+    database_file = config.get('database_file')
+    if historian_type == 'sqlite':
+        store_file = historian_config.get('store_file')
+        if store_file is None:
+            if database_file is None:
+                raise ValueError("The sqlite historian needs a 'store_file' or a 'database_file' to derive it from")
+            store_file = os.path.splitext(database_file)[0] + '.sqlite'
+        return SQLiteHistorian(store_file, database_file, ts_name=ts_name)
+    return CsvHistorian(database_file, ts_name=ts_name)
@@ -1,9 +1,12 @@
+import bisect
 import pytz
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from datetime import datetime, timedelta
 from pandas.tseries.offsets import CustomBusinessDay, BDay
 from pandas.tseries.holiday import USFederalHolidayCalendar
+from model.historian import make_historian
 
 
 class Hot5:
@@ -17,6 +20,7 @@ class Hot5:
         self.results_file = self.config.get('results_file')
 
         self.point_mapping = self.config.get('point_mapping')
+        self.historian = make_historian(self.config, ts_name=self.point_mapping.get(self.ts_name, self.ts_name))
         self.units = self.config.get('units')
         self.parameters = self.config.get('parameters')
         self.COP = self.parameters.get('COP')
@@ -61,12 +65,23 @@ class Hot5:
             series = series / 1000
         return series
 
-    def call_historian(self, start_date_utc):
-        df = pd.read_csv(self.database_file)
+    def historian_columns(self):
+        """
+        Names, as stored in the historian, of the columns needed for the baseline.
+        """
+        columns = [self.ts_name, self.out_temp_name, self.power_name, 'SupplyTemp', 'ReturnTemp', 'WaterMass']
+        if type(self.t_cw_norm) == str:
+            columns.append(self.t_cw_norm)
+        return [self.point_mapping.get(col, col) for col in columns]
+
+    def call_historian(self, start_date_utc, end_date_utc=None):
+        df = self.historian.query(start_date_utc, end_date_utc, self.historian_columns())
         df = self.point_map(df)
         df = self.load_calc(df)
         df[self.ts_name] = pd.to_datetime(df[self.ts_name], utc=True)
         df = df[df[self.ts_name] >= start_date_utc]
+        if end_date_utc is not None:
+            df = df[df[self.ts_name] < end_date_utc]
         return df
 
     def load_calc(self, df):
@@ -106,8 +121,9 @@ class Hot5:
         cur_time_utc = cur_time.astimezone(pytz.utc)
         df_extension = {}
 
+        # One bounded range read covers the history and the extension of every point
+        result = self.call_historian(start_date_utc, cur_time_utc + 2 * self.bday_us)
         for point in unit_points:
-            result = self.call_historian(start_date_utc)
             if len(result) > 0:
                 df2 = pd.DataFrame(result, columns=[self.ts_name, point])
                 df2[self.ts_name] = pd.to_datetime(df2[self.ts_name], utc=True)
@@ -141,8 +157,19 @@ class Hot5:
             return 8
         return d.weekday()
 
+    def map_days(self, index):
+        """
+        Vectorized map_day: the weekday of each timestamp, or 8 for a federal holiday.
+        """
+        days = np.asarray(index.weekday)
+        if index.tz is not None:
+            index = index.tz_localize(None)
+        dates = index.values.astype('datetime64[D]')
+        holidays = np.asarray(self.bday_us.holidays, dtype='datetime64[D]')
+        return np.where(np.isin(dates, holidays), 8, days)
+
     def calculate_baseline_logic(self, dP):
-        dP['DayOfWeek'] = dP.index.map(lambda v: self.map_day(v))
+        dP['DayOfWeek'] = self.map_days(dP.index)
         if type(self.t_cw_norm) != str:
             dP.columns = [self.out_temp_name, self.power_name, "DayOfWeek"]
         else:
@@ -165,13 +192,10 @@ class Hot5:
             print('Not enough data to process')
             return None
 
+        hot5_pow_avg = self.hot5_average(df[self.out_temp_name].to_numpy(dtype=float),
+                                         df[self.power_name].to_numpy(dtype=float))
         for j in range(0, 24):
-            df['hot5_pow_avg', j] = None
-        index_ = df['hot5_pow_avg'].index
-
-        for i in range(10, df_length):
-            for j in range(0, 24):
-                df['hot5_pow_avg', j].loc[index_[i]] = df.iloc[i - 10:i - 1, :].sort_values([(self.out_temp_name, j)], ascending=False).head(5).iloc[:, (j + 0):(j + 1)].mean().iloc[0]
+            df['hot5_pow_avg', j] = hot5_pow_avg[:, j]
         self.save_4_debug(df, 'data2.csv')
 
         df = df.stack(level=['hour'])
@@ -184,10 +208,8 @@ class Hot5:
         dq = dq.drop(['year', 'month', 'day', 'hour'], axis=1)
         self.save_4_debug(dq, 'data3.csv')
 
-        dq_length = len(dq.index) - 4
-        dq["Adj2"] = 1.0
-        for i in range(0, dq_length):
-            dq['Adj2'][i + 4] = (dq[self.power_name][i:i+3].mean()) / (dq['hot5_pow_avg'][i:i+3].mean())
+        dq["Adj2"] = self.adjustment_ratio(dq[self.power_name].to_numpy(dtype=float),
+                                           dq['hot5_pow_avg'].to_numpy(dtype=float))
         self.save_4_debug(dq, 'data4.csv')
 
         dq.loc[dq['Adj2'] < 0.6, 'Adj2'] = 0.6
@@ -196,9 +218,334 @@ class Hot5:
         self.save_4_debug(dq, 'method1_result.csv')
         return dq
 
+    def hot5_average(self, oat, power, window=9, lag=10, top=5):
+        """
+        Average the power of the `top` hottest days, per hour, over a trailing window of days.
+        The window of day i covers days i - lag to i - lag + window - 1, so with the defaults the
+        9 days from i - 10 to i - 2. Ties in temperature keep the day order and days with a missing
+        temperature are ranked last, as pandas sort_values does.
+
+        Args:
+            oat (np.ndarray): Outdoor air temperature as a (days x hours) array.
+            power (np.ndarray): Power as a (days x hours) array.
+
+        Returns:
+            np.ndarray: The (days x hours) hot-5 average, NaN for the first `lag` days.
+        """
+        days, hours = power.shape
+        result = np.full((days, hours), np.nan)
+        if days <= lag:
+            return result
+        # (days - lag) x hours x window views of the trailing days, without copying
+        oat_windows = sliding_window_view(oat, window, axis=0)[:days - lag]
+        power_windows = sliding_window_view(power, window, axis=0)[:days - lag]
+        hottest = np.argsort(-oat_windows, axis=-1, kind='stable')[..., :top]
+        hottest_power = np.take_along_axis(power_windows, hottest, axis=-1)
+        valid = ~np.isnan(hottest_power)
+        count = valid.sum(axis=-1)
+        total = np.where(valid, hottest_power, 0.).sum(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[lag:] = np.where(count > 0, total / count, np.nan)
+        return result
+
+    def adjustment_ratio(self, power, hot5_pow_avg, window=3, lag=4):
+        """
+        Compute the Adj2 ratio of the actual power to the hot-5 average over a rolling window.
+        The ratio of row k uses rows k - lag to k - lag + window - 1; the first `lag` rows are 1.
+
+        Args:
+            power (np.ndarray): Actual power for each row.
+            hot5_pow_avg (np.ndarray): Hot-5 average for each row.
+
+        Returns:
+            np.ndarray: The adjustment ratio for each row.
+        """
+        ratio = np.ones(len(power))
+        if len(power) > lag:
+            power_mean = sliding_window_view(power, window).mean(axis=-1)
+            hot5_mean = sliding_window_view(hot5_pow_avg, window).mean(axis=-1)
+            ratio[lag:] = power_mean[:len(power) - lag] / hot5_mean[:len(power) - lag]
+        return ratio
+
     def save_4_debug(self, df, name):
         if self.results_file is not None:
             try:
                 df.to_csv(self.results_file + name)
             except Exception as ex:
-                print(ex)
\ No newline at end of file
+                print(ex)
+
+class IncrementalHot5(Hot5):
+    """
+    Hot5 baseline kept up to date as historian data arrives, instead of being rebuilt from the history.
+
+    The hourly values of each business day are kept as running sums in (days x points x hours) arrays,
+    the hot-5 average of each day and hour is computed once, when its day starts, and the Adj2 ratio is
+    computed once for each new row of the baseline. Adding an hour of data only touches its own cell and
+    the cells whose trailing windows contain it, so the work per hour does not grow with the history.
+    The same state is serialized with `save` and restored with `restore`.
+    """
+    window = 9
+    lag = 10
+    adjustment_window = 3
+    adjustment_lag = 4
+
+    def __init__(self, config, ts, keep_days=60):
+        """
+        Args:
+            config (dict): Hot5 configuration.
+            ts (datetime): Current time, as for Hot5.
+            keep_days (int): Business days kept in memory; older days are dropped, in batches.
+        """
+        super().__init__(config, ts)
+        self.points = [self.out_temp_name, self.power_name]
+        if type(self.t_cw_norm) == str:
+            self.points.append(self.parameters.get('t_cw_norm'))
+        self.keep_days = max(keep_days, self.lag + 2)
+        self.reset()
+
+    def reset(self):
+        points = len(self.points)
+        # Business days in the store, as day numbers since the epoch
+        self.days = np.empty(0, dtype=np.int64)
+        self.sums = np.zeros((0, points, 24))
+        self.counts = np.zeros((0, points, 24), dtype=np.int64)
+        self.hot5 = np.full((0, 24), np.nan)
+        # Rows of the baseline, keyed by day number * 24 + hour, in time order
+        self.rows = []
+        self.row_power = []
+        self.row_hot5 = []
+        self.row_adjustment = []
+        # End of the last historian read, as a UTC timestamp
+        self.last_time = None
+
+    def cell_values(self, index, hours=slice(None)):
+        counts = self.counts[index, :, hours]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, self.sums[index, :, hours] / np.maximum(counts, 1), np.nan)
+
+    def compute_hot5(self, index, hours=slice(None)):
+        """
+        Hot-5 average of a day from the `lag` days before it, with the same arithmetic as hot5_average.
+        """
+        if index < self.lag:
+            return np.nan
+        trailing = self.cell_values(slice(index - self.lag, index + 1), hours)
+        return self.hot5_average(trailing[:, 0], trailing[:, 1])[-1]
+
+    def day_index(self, day):
+        """
+        Row of the day in the store, adding it if needed. A day older than the last one is inserted and
+        the whole state recomputed, which only happens for late data of a day that had none.
+        """
+        if len(self.days) and day == self.days[-1]:
+            return len(self.days) - 1
+        if len(self.days) == 0 or day > self.days[-1]:
+            points = len(self.points)
+            self.days = np.append(self.days, day)
+            self.sums = np.concatenate([self.sums, np.zeros((1, points, 24))])
+            self.counts = np.concatenate([self.counts, np.zeros((1, points, 24), dtype=np.int64)])
+            self.hot5 = np.concatenate([self.hot5, np.full((1, 24), np.nan)])
+            index = len(self.days) - 1
+            self.hot5[index] = self.compute_hot5(index)
+            return index
+        index = int(np.searchsorted(self.days, day))
+        if self.days[index] != day:
+            points = len(self.points)
+            self.days = np.insert(self.days, index, day)
+            self.sums = np.insert(self.sums, index, np.zeros((points, 24)), axis=0)
+            self.counts = np.insert(self.counts, index, np.zeros((points, 24), dtype=np.int64), axis=0)
+            self.hot5 = np.insert(self.hot5, index, np.nan, axis=0)
+            self.rebuild()
+        return index
+
+    def rebuild(self):
+        """
+        Recompute the hot-5 averages and baseline rows of the whole store.
+        """
+        for index in range(self.lag, len(self.days)):
+            self.hot5[index] = self.compute_hot5(index)
+        self.rows, self.row_power, self.row_hot5, self.row_adjustment = [], [], [], []
+        for index in range(len(self.days)):
+            for hour in range(24):
+                self.update_row(index, hour, adjust=False)
+        self.adjust(0)
+
+    def adjust(self, start, stop=None):
+        """
+        Compute the Adj2 ratio of the baseline rows from start to stop from the rows before them.
+        """
+        stop = len(self.rows) if stop is None else min(stop, len(self.rows))
+        for row in range(start, stop):
+            if row < self.adjustment_lag:
+                self.row_adjustment[row] = 1.
+                continue
+            window = slice(row - self.adjustment_lag, row - self.adjustment_lag + self.adjustment_window)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ratio = np.mean(self.row_power[window]) / np.mean(self.row_hot5[window])
+            self.row_adjustment[row] = np.clip(ratio, 0.6, 1.4)
+
+    def update_row(self, index, hour, adjust=True):
+        """
+        Add, change or remove the baseline row of a cell after its values or hot-5 average changed.
+        A row exists when every point and the hot-5 average of the cell are known.
+        """
+        values = self.cell_values(index, hour)
+        hot5 = self.hot5[index, hour]
+        valid = not (np.isnan(values).any() or np.isnan(hot5))
+        key = int(self.days[index]) * 24 + hour
+        row = bisect.bisect_left(self.rows, key)
+        exists = row < len(self.rows) and self.rows[row] == key
+        if valid and exists:
+            self.row_power[row] = values[1]
+            self.row_hot5[row] = hot5
+            if adjust:
+                first = row + self.adjustment_lag - self.adjustment_window + 1
+                self.adjust(first, row + self.adjustment_lag + 1)
+        elif valid:
+            self.rows.insert(row, key)
+            self.row_power.insert(row, values[1])
+            self.row_hot5.insert(row, hot5)
+            self.row_adjustment.insert(row, 1.)
+            if adjust:
+                self.adjust(row)
+        elif exists:
+            for rows in (self.rows, self.row_power, self.row_hot5, self.row_adjustment):
+                del rows[row]
+            if adjust:
+                self.adjust(row)
+
+    def add(self, day, hour, values):
+        """
+        Add an aggregated sample of the points to an hour of a business day.
+
+        Args:
+            day (int): Day number since the epoch, in UTC.
+            hour (int): Hour of the day, in UTC.
+            values (array): Value of each point, NaN where missing.
+        """
+        values = np.asarray(values, dtype=float)
+        present = ~np.isnan(values)
+        if not present.any():
+            return
+        index = self.day_index(day)
+        self.sums[index, :, hour] += np.where(present, values, 0.)
+        self.counts[index, :, hour] += present
+        self.update_row(index, hour)
+        # The days whose trailing window holds this day
+        for later in range(index + self.lag - self.window + 1, min(index + self.lag + 1, len(self.days))):
+            if later >= self.lag:
+                self.hot5[later, hour] = self.compute_hot5(later, [hour])[0]
+                self.update_row(later, hour)
+        self.trim()
+
+    def trim(self):
+        # Dropped in batches of keep_days, so the copies cost a constant time per day
+        if len(self.days) < 2 * self.keep_days:
+            return
+        drop = len(self.days) - self.keep_days
+        first_row = bisect.bisect_left(self.rows, int(self.days[drop]) * 24)
+        self.days, self.sums, self.counts, self.hot5 = (self.days[drop:], self.sums[drop:], self.counts[drop:],
+                                                        self.hot5[drop:])
+        for name in ('rows', 'row_power', 'row_hot5', 'row_adjustment'):
+            setattr(self, name, getattr(self, name)[first_row:])
+
+    def ingest(self, df):
+        """
+        Add historian rows, as returned by call_historian, to the baseline. The rows are aggregated over
+        aggregate_in_min as in calculate_latest_baseline; an aggregation interval must not be split across
+        two calls.
+        """
+        if df is None or len(df) == 0:
+            return
+        frame = df.set_index(pd.to_datetime(df[self.ts_name], utc=True))
+        frame = frame[self.points].apply(pd.to_numeric)
+        frame = frame.groupby(pd.Grouper(freq=self.aggregate_freq)).mean().dropna(how='all')
+        business = self.map_days(frame.index) < 5
+        days = frame.index.values.astype('datetime64[D]').astype(np.int64)
+        hours = frame.index.hour
+        values = frame.to_numpy(dtype=float)
+        for row in np.flatnonzero(business):
+            self.add(days[row], hours[row], values[row])
+
+    def refresh(self, cur_time=None, days=11):
+        """
+        Read the historian from the end of the last read up to the last complete aggregation interval
+        before cur_time and add the new rows. The first read covers `days` business days.
+
+        Args:
+            cur_time (datetime): Aware current time. Defaults to now.
+            days (int): Business days read on the first refresh.
+        """
+        cur_time = pd.Timestamp.now(tz=pytz.utc) if cur_time is None else pd.Timestamp(cur_time).tz_convert(pytz.utc)
+        end = cur_time.floor(self.aggregate_freq)
+        start = self.last_time
+        if start is None:
+            start = (cur_time - days * self.bday_us).normalize()
+        if end <= start:
+            return
+        self.ingest(self.call_historian(start, end))
+        self.last_time = end
+
+    def baseline(self, last_rows=None):
+        """
+        The baseline rows as calculate_baseline_logic returns them.
+
+        Args:
+            last_rows (int): Number of most recent rows to return. All rows if None.
+
+        Returns:
+            pd.DataFrame: The baseline, or None with fewer than 12 business days of data.
+        """
+        if len(self.days) < 12:
+            print('Not enough data to process')
+            return None
+        first = 0 if last_rows is None else max(len(self.rows) - last_rows, 0)
+        keys = np.asarray(self.rows[first:], dtype=np.int64)
+        indices = np.searchsorted(self.days, keys // 24)
+        hours = keys % 24
+        values = (self.sums[indices, :, hours] / np.maximum(self.counts[indices, :, hours], 1))
+        times = (keys // 24).astype('datetime64[D]') + hours.astype('timedelta64[h]')
+        dq = pd.DataFrame(values, columns=self.points, index=pd.Index(times.astype('datetime64[ns]'), name='Data'))
+        dq['hot5_pow_avg'] = self.row_hot5[first:]
+        dq['Adj2'] = self.row_adjustment[first:]
+        dq['hot5_pow_adj_avg'] = dq['hot5_pow_avg'] * dq['Adj2']
+        return dq
+
+    def adjust_hot_five(self, days=11, last_rows=None):
+        """
+        Refresh the baseline with the new historian data and return it as Hot5.adjust_hot_five does.
+        """
+        self.refresh(days=days)
+        results = self.baseline(last_rows)
+        if results is None:
+            return None
+        results = results.reset_index()
+        return results.rename(columns={'Data': 'Time',
+                                       'hot5_pow_adj_avg': 'Predict',
+                                       'CoolingLoad': 'Actual'})
+
+    def save(self, path):
+        """
+        Write the state of the baseline to a compressed NumPy archive.
+        """
+        last_time = -1 if self.last_time is None else self.last_time.value
+        np.savez_compressed(path, days=self.days, sums=self.sums, counts=self.counts, hot5=self.hot5,
+                            rows=np.asarray(self.rows, dtype=np.int64), row_power=np.asarray(self.row_power),
+                            row_hot5=np.asarray(self.row_hot5), row_adjustment=np.asarray(self.row_adjustment),
+                            last_time=np.int64(last_time))
+
+    def restore(self, path):
+        """
+        Read the state written by save.
+        """
+        with np.load(path) as state:
+            self.days = state['days']
+            self.sums = state['sums']
+            self.counts = state['counts']
+            self.hot5 = state['hot5']
+            self.rows = state['rows'].tolist()
+            self.row_power = state['row_power'].tolist()
+            self.row_hot5 = state['row_hot5'].tolist()
+            self.row_adjustment = state['row_adjustment'].tolist()
+            last_time = int(state['last_time'])
+        self.last_time = None if last_time < 0 else pd.Timestamp(last_time, tz=pytz.utc)
@@ -1,8 +1,6 @@
 import pyomo.environ as pyo 
-from pyomo.environ import *
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
 
 class ThermalEnergyStorageSystem:
@@ -11,22 +9,18 @@ class ThermalEnergyStorageSystem:
     This class models a thermal energy storage system with various configurations and optimization constraints.
     """
 
-    def __init__(self, model, load, uncontrollable_load, config):
+    def __init__(self, model, config):
         """
-        Initializes the TESS model with parameters for the building load, uncontrollable load, price, and configuration.
+        Initializes the TESS model components on the shared Pyomo model.
+        The building load and uncontrollable load are read from the mutable `building_load` and `uncontrollable_load`
+        parameters of the shared model, so a re-plan only needs to change parameter values.
         
         Args:
-            load (list): The total load of the building.
-            uncontrollable_load (list): The uncontrollable portion of the building load.
-            price (list): List of prices for energy consumption.
+            model (pyo.ConcreteModel): The shared Pyomo model holding the load parameters, or None to only
+                hold the TESS parameters, e.g. for the matrix engine.
             config (dict): Configuration dictionary for the TESS system, chiller, and demand rates.
         """
-        self.load = load
-        self.uncontrollable_load = uncontrollable_load
-        self.cooling_load = [bl - ul for bl, ul in zip(load, uncontrollable_load)]
-        
         chiller_config = config['chiller_config']
-        self.time_intervals = range(0, self.optimization_window)
         
         # Chiller configuration
         self.ice_mass = chiller_config.get('ice_mass')
@@ -36,6 +30,9 @@ class ThermalEnergyStorageSystem:
 
         # TESS configuration settings
         self.optimization_window = config.get('window_length', 24)
+        self.time_step_minutes = config.get('time_step_minutes', 60)
+        self.dt = self.time_step_minutes / 60.
+        self.time_intervals = range(0, self.optimization_window)
         self.initial_soc = config.get('initial_soc', 10)
         self.final_soc = config.get('soc_final', 10)
         self.max_soc = config.get('max_soc', 90)
@@ -53,21 +50,47 @@ class ThermalEnergyStorageSystem:
         self.min_building_power = config.get('building_power_min', 40)
         self.peak_demand_limit = config.get('peak_limit')
 
-        # Create optimization model
+        # Formulation of the SOC dependent charge/discharge envelopes:
+        # 'polynomial' keeps the exact MINLP, 'piecewise' turns the problem into a MILP
+        self.formulation = config.get('formulation', 'polynomial').lower()
+        self.breakpoints = config.get('breakpoints', 11)
+        self.piecewise_repn = config.get('piecewise_repn', 'INC')
+
+        # Declare the TESS components on the shared optimization model, if one is given
         self.model = model
-        self.set_model_variable()
+        if model is not None:
+            self.set_model_variable()
         
         
     def set_model_variable(self):
-        if self.control_type == 3:
-            self.model.peak_power = pyo.Var(bounds=(None, None))
-        self.model.total_power = pyo.Var(self.time_intervals, bounds=(0, None))
-        self.model.state_of_charge = pyo.Var(self.time_intervals, bounds=(self.min_soc, self.max_soc), initialize=self.initial_soc)
+        self.model.tess_initial_soc = pyo.Param(mutable=True, initialize=self.initial_soc)
+        self.model.tess_final_soc = pyo.Param(mutable=True, initialize=self.final_soc)
+        self.model.tess_state_of_charge = pyo.Var(self.time_intervals, bounds=(self.min_soc, self.max_soc), initialize=self.initial_soc)
         self.model.tess_energy_usage = pyo.Var(self.time_intervals, bounds=(None, None), initialize=0)
         self.model.tess_power = pyo.Var(self.time_intervals, initialize=0)
         self.model.tess_charging = pyo.Var(self.time_intervals, bounds=(0, None), initialize=0)
         self.model.tess_discharging = pyo.Var(self.time_intervals, bounds=(0, None), initialize=0)
         self.model.tess_binary = pyo.Var(self.time_intervals, domain=pyo.Binary, bounds=(0, 1), initialize=0)
+        if self.formulation == 'piecewise':
+            self.model.tess_charging_envelope = pyo.Var(self.time_intervals, bounds=(0, None))
+            self.model.tess_discharging_envelope = pyo.Var(self.time_intervals, bounds=(0, None))
+
+    def update(self, initial_soc=None, final_soc=None):
+        """
+        Update the mutable SOC parameters of the model in place.
+
+        Args:
+            initial_soc (float): Measured SOC at the start of the optimization window.
+            final_soc (float): Minimum SOC at the end of the optimization window.
+        """
+        if initial_soc is not None:
+            self.initial_soc = initial_soc
+            if self.model is not None:
+                self.model.tess_initial_soc.set_value(initial_soc)
+        if final_soc is not None:
+            self.final_soc = final_soc
+            if self.model is not None:
+                self.model.tess_final_soc.set_value(final_soc)
         
     
     def poly(self, coefficients, variable, order=2):
@@ -128,6 +151,39 @@ class ThermalEnergyStorageSystem:
         """
         return self.poly(self.discharging_coefficients, load, order=order)
     
+    def charging_rate_limit(self, soc):
+        """
+        Compute the maximum charging rate of the storage at a given state of charge.
+        
+        Args:
+            soc (float): The state of charge in percent.
+        
+        Returns:
+            float: The maximum charging rate.
+        """
+        return self.upper_bound(soc / 100) * self.ice_charge_rate * (self.freezer_temp - self.chilled_water_temp) * self.cf
+
+    def discharging_rate_limit(self, soc):
+        """
+        Compute the maximum discharging rate of the storage at a given state of charge.
+        
+        Args:
+            soc (float): The state of charge in percent.
+        
+        Returns:
+            float: The maximum discharging rate.
+        """
+        return self.lower_bound(soc / 100) * self.ice_discharge_rate * (self.cooled_inlet_temp - self.freezer_temp) * self.cf
+
+    def soc_breakpoints(self):
+        """
+        Compute the SOC breakpoints of the piecewise-linear envelopes, evenly spaced between the min and max SOC.
+        
+        Returns:
+            list: The SOC breakpoints in percent.
+        """
+        return list(np.linspace(self.min_soc, self.max_soc, max(self.breakpoints, 2)))
+
     #For the following constrains 
     """
     Args:
@@ -143,10 +199,10 @@ class ThermalEnergyStorageSystem:
         Constraint for the state of charge (SOC) balance.
         """
         if interval == 0:
-            return model.state_of_charge[interval] == self.initial_soc
+            return model.tess_state_of_charge[interval] == model.tess_initial_soc
         else:
-            return model.state_of_charge[interval] == model.state_of_charge[interval - 1] - \
-                   ((model.tess_energy_usage[interval - 1]) / self.storage_capacity) * 100
+            return model.tess_state_of_charge[interval] == model.tess_state_of_charge[interval - 1] - \
+                   ((model.tess_energy_usage[interval - 1] * self.dt) / self.storage_capacity) * 100
 
     def charging_discharging_constraint(self, model, interval):
         """
@@ -156,52 +212,77 @@ class ThermalEnergyStorageSystem:
 
     def power_balance_constraint1(self, model, interval):
         """
-        First power balance constraint, ensures total power equals the cooling load and chiller power usage.
+        First power balance constraint, ensures the TESS power equals the chiller power used to charge
+        or saved by discharging the storage. The total power is then built from it in the Optimization.
         """
-        return model.total_power[interval] == (-model.tess_energy_usage[interval] / self.cop) + self.load[interval]
+        return model.tess_power[interval] == -model.tess_energy_usage[interval] / self.cop
 
     def power_balance_constraint2(self, model, interval):
         """
         Second power balance constraint, ensures total power is greater than or equal to the uncontrollable load.
         """
-        return model.total_power[interval] >= self.uncontrollable_load[interval]
+        return model.total_power[interval] >= model.uncontrollable_load[interval]
 
 
     def charging_upper_bound_constraint(self, model, interval):
         """
         Constraint to ensure that the charging power does not exceed the upper bound.
         """
-        return model.tess_charging[interval] <= (1 - model.tess_binary[interval]) * self.upper_bound(model.state_of_charge[interval] / 100) * \
-               self.ice_charge_rate * (self.freezer_temp - self.chilled_water_temp) * self.cf
+        return model.tess_charging[interval] <= (1 - model.tess_binary[interval]) * self.charging_rate_limit(model.tess_state_of_charge[interval])
 
     def discharging_upper_bound_constraint1(self, model, interval):
         """
         Constraint to ensure that the discharging power does not exceed the upper bound.
         """
-        return model.tess_discharging[interval] <= model.tess_binary[interval] * self.lower_bound(model.state_of_charge[interval] / 100) * \
-               self.ice_discharge_rate * (self.cooled_inlet_temp - self.freezer_temp) * self.cf
+        return model.tess_discharging[interval] <= model.tess_binary[interval] * self.discharging_rate_limit(model.tess_state_of_charge[interval])
                
     def discharging_upper_bound_constraint2(self, model, interval):
-        return model.tess_discharging[interval] <= model.tess_binary[interval] * (self.cooling_load[interval] * self.cop)
+        return model.tess_discharging[interval] <= model.tess_binary[interval] * ((model.building_load[interval] - model.uncontrollable_load[interval]) * self.cop)
+
+    def charging_envelope_constraint(self, model, interval):
+        """
+        Piecewise-linear form: constraint to ensure that the charging power does not exceed the upper bound.
+        """
+        return model.tess_charging[interval] <= model.tess_charging_envelope[interval]
+
+    def charging_binary_constraint(self, model, interval):
+        """
+        Piecewise-linear form: constraint to ensure that the storage is not charged while discharging.
+        """
+        return model.tess_charging[interval] <= (1 - model.tess_binary[interval]) * \
+               max(self.charging_rate_limit(soc) for soc in self.soc_breakpoints())
+
+    def discharging_envelope_constraint(self, model, interval):
+        """
+        Piecewise-linear form: constraint to ensure that the discharging power does not exceed the upper bound.
+        """
+        return model.tess_discharging[interval] <= model.tess_discharging_envelope[interval]
+
+    def discharging_binary_constraint(self, model, interval):
+        """
+        Piecewise-linear form: constraint to ensure that the storage is not discharged while charging.
+        """
+        return model.tess_discharging[interval] <= model.tess_binary[interval] * \
+               max(self.discharging_rate_limit(soc) for soc in self.soc_breakpoints())
 
     def min_soc_constraint(self, model, interval):
         """
         Constraint to ensure that the state of charge does not fall below the min SOC.
         """
-        return self.min_soc <= model.state_of_charge[interval]
+        return self.min_soc <= model.tess_state_of_charge[interval]
 
     def max_soc_constraint(self, model, interval):
         """
         Constraint to ensure that the state of charge does not exceed the max SOC.
         """
-        return model.state_of_charge[interval] <= self.max_soc
+        return model.tess_state_of_charge[interval] <= self.max_soc
 
     def end_of_day_soc_constraint(self, model, interval):
         """
         Constraint to ensure that the SOC meets the final target at the end of the optimization window.
         """
-        if interval == 23 or interval == 24:
-            return model.state_of_charge[interval] >= self.final_soc
+        if interval == self.time_intervals[-1]:
+            return model.tess_state_of_charge[interval] >= model.tess_final_soc
         else:
             return pyo.Constraint.Skip
 
@@ -209,13 +290,41 @@ class ThermalEnergyStorageSystem:
         """
         Apply all constraints for the TESS model and add them to the Pyomo model.
         """
-        self.model.soc_constraint = pyo.Constraint(self.time_intervals, rule=self.soc_constraint)
-        self.model.charging_discharging_constraint = pyo.Constraint(self.time_intervals, rule=self.charging_discharging_constraint)
-        self.model.power_balance_constraint1 = pyo.Constraint(self.time_intervals, rule=self.power_balance_constraint1)
-        self.model.power_balance_constraint2 = pyo.Constraint(self.time_intervals, rule=self.power_balance_constraint2)
-        self.model.charging_upper_bound_constraint = pyo.Constraint(self.time_intervals, rule=self.charging_upper_bound_constraint)
-        self.model.discharging_upper_bound_constraint1 = pyo.Constraint(self.time_intervals, rule=self.discharging_upper_bound_constraint1)
-        self.model.discharging_upper_bound_constraint2 = pyo.Constraint(self.time_intervals, rule=self.discharging_upper_bound_constraint2)
-        self.model.min_soc_constraint = pyo.Constraint(self.time_intervals, rule=self.min_soc_constraint)
-        self.model.max_soc_constraint = pyo.Constraint(self.time_intervals, rule=self.max_soc_constraint)
-        self.model.end_of_day_soc_constraint = pyo.Constraint(self.time_intervals, rule=self.end_of_day_soc_constraint)
+        self.model.tess_soc_constraint = pyo.Constraint(self.time_intervals, rule=self.soc_constraint)
+        self.model.tess_charging_discharging_constraint = pyo.Constraint(self.time_intervals, rule=self.charging_discharging_constraint)
+        self.model.tess_power_balance_constraint1 = pyo.Constraint(self.time_intervals, rule=self.power_balance_constraint1)
+        self.model.tess_power_balance_constraint2 = pyo.Constraint(self.time_intervals, rule=self.power_balance_constraint2)
+        if self.formulation == 'piecewise':
+            self.apply_piecewise_constraints()
+        else:
+            self.model.tess_charging_upper_bound_constraint = pyo.Constraint(self.time_intervals, rule=self.charging_upper_bound_constraint)
+            self.model.tess_discharging_upper_bound_constraint1 = pyo.Constraint(self.time_intervals, rule=self.discharging_upper_bound_constraint1)
+        self.model.tess_discharging_upper_bound_constraint2 = pyo.Constraint(self.time_intervals, rule=self.discharging_upper_bound_constraint2)
+        self.model.tess_min_soc_constraint = pyo.Constraint(self.time_intervals, rule=self.min_soc_constraint)
+        self.model.tess_max_soc_constraint = pyo.Constraint(self.time_intervals, rule=self.max_soc_constraint)
+        self.model.tess_end_of_day_soc_constraint = pyo.Constraint(self.time_intervals, rule=self.end_of_day_soc_constraint)
+
+    def apply_piecewise_constraints(self):
+        """
+        Replace the polynomial charge/discharge envelopes by piecewise-linear functions of the SOC over
+        `breakpoints` evenly spaced SOC values, so the TESS model is a MILP instead of a MINLP.
+        """
+        soc_breakpoints = self.soc_breakpoints()
+        self.model.tess_charging_envelope_pw = pyo.Piecewise(self.time_intervals,
+                                                             self.model.tess_charging_envelope,
+                                                             self.model.tess_state_of_charge,
+                                                             pw_pts=soc_breakpoints,
+                                                             pw_constr_type='EQ',
+                                                             pw_repn=self.piecewise_repn,
+                                                             f_rule=lambda model, interval, soc: self.charging_rate_limit(soc))
+        self.model.tess_discharging_envelope_pw = pyo.Piecewise(self.time_intervals,
+                                                                self.model.tess_discharging_envelope,
+                                                                self.model.tess_state_of_charge,
+                                                                pw_pts=soc_breakpoints,
+                                                                pw_constr_type='EQ',
+                                                                pw_repn=self.piecewise_repn,
+                                                                f_rule=lambda model, interval, soc: self.discharging_rate_limit(soc))
+        self.model.tess_charging_envelope_constraint = pyo.Constraint(self.time_intervals, rule=self.charging_envelope_constraint)
+        self.model.tess_charging_binary_constraint = pyo.Constraint(self.time_intervals, rule=self.charging_binary_constraint)
+        self.model.tess_discharging_envelope_constraint = pyo.Constraint(self.time_intervals, rule=self.discharging_envelope_constraint)
+        self.model.tess_discharging_binary_constraint = pyo.Constraint(self.time_intervals, rule=self.discharging_binary_constraint)
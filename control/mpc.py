@@ -0,0 +1,125 @@
+import time
+from datetime import datetime
+
+import numpy as np
+
+from matrix_model import create_optimization
+from result_cache import ResultCache
+
+# Schedules compared between consecutive plans
+PLAN_KEYS = ('bess_power', 'tess_power', 'total_power')
+
+
+def plan_change(previous, current, shift):
+    """
+    Measure how much the plan changed between two consecutive solves over the time steps they share.
+
+    Args:
+        previous (dict): Results of the previous solve.
+        current (dict): Results of the current solve.
+        shift (int): Number of time steps the horizon moved forward between the solves.
+
+    Returns:
+        dict: For each schedule, the change of the first step and the maximum and RMS change over the
+        shared steps.
+    """
+    change = {}
+    for key in PLAN_KEYS:
+        if key not in previous or key not in current:
+            continue
+        before = np.asarray(previous[key][shift:], dtype=float)
+        after = np.asarray(current[key][:len(before)], dtype=float)
+        if len(before) == 0:
+            continue
+        difference = after - before
+        change[key] = {'first_step': float(difference[0]),
+                       'max_abs': float(np.abs(difference).max()),
+                       'rms': float(np.sqrt(np.mean(difference ** 2)))}
+    return change
+
+
+class RollingHorizonPlanner:
+    """
+    Plan the storage over a rolling horizon. The optimization model is built on the first plan; every
+    following plan updates the forecasts and SOCs of the same model in place and, once the horizon moved
+    forward, seeds the solver with the previous solution shifted by the number of elapsed time steps.
+
+    With `result_cache_dir` set in the configuration, the results are also stored on disk keyed by their
+    inputs and a plan whose inputs were already solved, e.g. after a restart, is read back without
+    building the model. Cached results are not loaded into the model, so the next solve after a cache hit
+    starts cold.
+    """
+
+    def __init__(self, config):
+        """
+        Args:
+            config (dict): Scheduler configuration, as used by Optimization.
+        """
+        self.config = config
+        self.optimizer = None
+        self.results = None
+        # Whether the optimizer holds the solution of the last plan, which a cache hit does not load
+        self.solution_current = False
+        self.cache = None
+        if config.get('result_cache_dir'):
+            self.cache = ResultCache(config['result_cache_dir'],
+                                     int(config.get('result_cache_max_mb', 64) * 1024 ** 2),
+                                     config.get('result_cache_precision', 3))
+
+    def plan(self, load, uncontrollable_load, price, update=None, shift=0):
+        """
+        Solve the plan for the current horizon.
+
+        Args:
+            load (list): Building load forecast over the horizon.
+            uncontrollable_load (list): Uncontrollable load forecast over the horizon.
+            price (list): Price forecast over the horizon.
+            update (dict): Keyword arguments of Optimization.update, e.g. the measured SOCs, with the hour
+                of the day of the first time step as `_hour` (by default the current hour for forecasts
+                rotated by update, otherwise the start hour of the previous plan).
+            shift (int): Time steps elapsed since the previous plan, 0 for an unrelated solve.
+
+        Returns:
+            dict: The optimization results, with the plan change since the previous plan when warm started
+            and `cache_hit` set when they were read from the result cache.
+        """
+        update = dict(update or {})
+        if update.get('_hour') is None:
+            if 'load' in update and 'uncontrollable_load' in update:
+                # The forecasts are rotated to the current hour
+                update['_hour'] = datetime.now().hour
+            else:
+                update['_hour'] = self.optimizer.start_hour if self.optimizer is not None else 0
+        key = None
+        if self.cache is not None:
+            # The start hour places the demand charge windows, so it is part of the inputs
+            start = time.perf_counter()
+            key = self.cache.key(self.config, load, uncontrollable_load, price, update)
+            results = self.cache.get(key)
+            if results is not None:
+                results['cache_hit'] = True
+                results['timings'] = {'cache': time.perf_counter() - start}
+                if self.results is not None and shift > 0:
+                    results['plan_change'] = plan_change(self.results, results, shift)
+                self.results = results
+                # The next solve is not warm started from the older solution left in the optimizer
+                self.solution_current = False
+                return results
+        warmstart = self.optimizer is not None and self.solution_current and shift > 0
+        if self.optimizer is None:
+            self.optimizer = create_optimization(load, uncontrollable_load, price, self.config)
+        else:
+            self.optimizer.set_forecast(load, uncontrollable_load, price)
+        self.optimizer.update(**update)
+        self.optimizer.set_start_hour(update['_hour'])
+        if warmstart:
+            self.optimizer.shift_solution(shift)
+        self.solution_current = False
+        results = self.optimizer.run_opt(warmstart=warmstart)
+        self.solution_current = True
+        if self.results is not None and shift > 0:
+            results['plan_change'] = plan_change(self.results, results, shift)
+        if key is not None:
+            self.cache.put(key, {name: value for name, value in results.items() if name != 'plan_change'})
+        self.results = results
+        return results
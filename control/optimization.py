@@ -1,41 +1,49 @@
 import pyomo.environ as pyo
-from pyomo.environ import *
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
 from model.bess import BatteryEnergyStorageSystem
 from model.tess import ThermalEnergyStorageSystem
+from solver_backend import SolverBackend
+from metrics import PhaseTimer
+from time_steps import hourly_to_steps, is_hourly, window_steps
+
 
 class Optimization():
     def __init__(self, load, uncontrollable_load, price, config):
-        self.load = load
-        self.uncontrollable_load = uncontrollable_load
-        self.cooling_load = [a - b for a, b in zip(load, uncontrollable_load)]
+        # Length of a time step; window_length is a number of steps and defaults to one day
+        self.time_step_minutes = config.get('time_step_minutes', 60)
+        self.dt = self.time_step_minutes / 60.
+        self.steps_per_day = int(24 * 60 / self.time_step_minutes)
+        self.window_length = window_steps(config)
+        self.time_intervals = range(0, self.window_length)
+        self.start_hour = 0
+        self.timer = PhaseTimer()
+
+        self.load = self.to_steps(load)
+        self.uncontrollable_load = self.to_steps(uncontrollable_load)
+        self.cooling_load = [a - b for a, b in zip(self.load, self.uncontrollable_load)]
         self.energy_storage_system = config.get("energy_storage_system").lower()
+        self.use_bess = 'bess' in self.energy_storage_system or 'hybrid' in self.energy_storage_system
+        self.use_tess = 'tess' in self.energy_storage_system or 'hybrid' in self.energy_storage_system
         self.control_type = config.get("control_type", 3)
         self.peak_demand_limit = config.get("peak_demand_limit", None)
         
         demand_rate_config = config["demand_rate_config"]
+        # Share of the monthly demand charges the window pays for its peaks, a day of a 30 day month by
+        # default. Planners of a whole billing period use 1 with the peaks already reached as billing_peaks.
+        self.demand_charge_share = config.get("demand_charge_share", 1 / 30.)
+        self.billing_peaks = dict(config.get("billing_peaks", {}))
         self.demand_charge = config.get("demand_charge", 10)
-        self.demand_charge_daily = self.demand_charge/30.
+        self.demand_charge_daily = self.demand_charge * self.demand_charge_share
         self.type_of_demand_rate = demand_rate_config.get("type_of_demand_rate", 'flat')
 
-        self.prices = price if config.get('control', 3) == 3 else list(pd.read_csv('data/default_prices_sp.csv')['price'])
+        self.use_price_forecast = config.get('control', 3) == 3
+        self.prices = self.to_steps(price if self.use_price_forecast else pd.read_csv('data/default_prices_sp.csv')['price'])
+        # Daily price forecast as received; update() rotates it to the current hour into self.prices
+        self.price_forecast = self.prices
     
-        self.window_length = config.get('window_length', 24)
-        self.time_intervals = range(0, self.window_length)
-
-        self.model = pyo.ConcreteModel()
-                # Initialize BESS and TESS based on configuration
-        if 'bess' in self.energy_storage_system or 'hybrid' in self.energy_storage_system:
-            bess_config = config['bess_config']
-            self.bess = BatteryEnergyStorageSystem(self.model, bess_config)
-
-        if 'tess' in self.energy_storage_system or 'hybrid' in self.energy_storage_system:
-            tess_config = config['tess_config']
-            self.tess = ThermalEnergyStorageSystem(self.model, load, uncontrollable_load, tess_config)
-        self.set_model_variable()
+        self.solver = SolverBackend(config.get('solver_config', {}))
         
         if self.type_of_demand_rate.lower() == 'tou':
             self.peak_time_start = demand_rate_config.get("peak_time_start", 16)
@@ -53,58 +61,160 @@ class Optimization():
             #max Part-Peak Demand Summer $6.81
             part_peak_demand_price = demand_rate_config.get("part_peak_demand_price", 6.81)
             ##Converting to daily demand charge
-            self.demand_charge_daily = demand_charge/30.
-            self.peak_demand_rate_daily = peak_demand_rate/30.
-            self.part_peak_demand_price_daily = part_peak_demand_price/30.
+            self.demand_charge_daily = demand_charge * self.demand_charge_share
+            self.peak_demand_rate_daily = peak_demand_rate * self.demand_charge_share
+            self.part_peak_demand_price_daily = part_peak_demand_price * self.demand_charge_share
         else:
             self.peak_time_start = demand_rate_config.get("peak_time_start", 16)
             self.peak_time_end = demand_rate_config.get("peak_time_end", 21)
             demand_charge = demand_rate_config.get("demand_charge", 26.07)
-            self.demand_charge_daily = demand_charge/30.
-    
-    
+            self.demand_charge_daily = demand_charge * self.demand_charge_share
+
+        self.build_model(config)
+        self.set_billing_peaks()
+
+    def build_model(self, config):
+        """
+        Build the Pyomo model. The model is built once per configuration; load, uncontrollable load, price
+        and the initial and final SOC are mutable parameters that update() changes in place.
+        """
+        self.model = pyo.ConcreteModel()
+        with self.timer.phase('parameters'):
+            self.set_model_parameter()
+        # Initialize BESS and TESS based on configuration
+        with self.timer.phase('variables'):
+            if self.use_bess:
+                bess_config = dict(config['bess_config'], window_length=self.window_length,
+                                   time_step_minutes=self.time_step_minutes)
+                self.bess = BatteryEnergyStorageSystem(self.model, bess_config)
+
+            if self.use_tess:
+                tess_config = dict(config['tess_config'], window_length=self.window_length,
+                                   time_step_minutes=self.time_step_minutes)
+                self.tess = ThermalEnergyStorageSystem(self.model, tess_config)
+            self.set_model_variable()
+        with self.timer.phase('constraints'):
+            self.apply_constraints()
+        with self.timer.phase('objective'):
+            self.model.obj = pyo.Objective(rule=self.obj_rule, sense=pyo.minimize)
+
+    def to_steps(self, values):
+        """
+        Forecasts are published hourly; expand the hourly ones, shorter than the window, to the time step.
+        """
+        values = list(values)
+        if is_hourly(len(values), self.time_step_minutes) and len(values) < self.window_length:
+            return hourly_to_steps(values, self.time_step_minutes)
+        return values
+
+    def set_forecast(self, load, uncontrollable_load, price=None):
+        """
+        Set the load, uncontrollable load and price forecasts of the model in place.
+
+        Args:
+        load (list): Building load for each time interval.
+        uncontrollable_load (list): Uncontrollable portion of the building load for each time interval.
+        price (list): Price of electricity for each time interval.
+        """
+        with self.timer.phase('forecast'):
+            self.load = self.to_steps(load)
+            self.uncontrollable_load = self.to_steps(uncontrollable_load)
+            self.cooling_load = [a - b for a, b in zip(self.load, self.uncontrollable_load)]
+            if price is not None and self.use_price_forecast:
+                self.prices = self.price_forecast = self.to_steps(price)
+            for i in self.time_intervals:
+                self.model.building_load[i] = self.load[i]
+                self.model.uncontrollable_load[i] = self.uncontrollable_load[i]
+                self.model.price[i] = self.prices[i]
+            self.model.max_load.set_value(max(self.load[:self.window_length]))
+
     def update(self, load=None, uncontrollable_load=None, bess_soc=None, tess_soc=None, _hour=None):
         if _hour is None: 
             _hour = datetime.now().hour
         if load is not None and uncontrollable_load is not None:
-            ld = []
-            un_ld = []
-            pr = []
-            for ind in range(_hour, 24):
-                ld.append(load[ind])
-                un_ld.append(uncontrollable_load[ind])
-                pr.append(self.prices[ind])
-                
-            for ind in range(0, _hour):
-                ld.append(load[ind])
-                un_ld.append(uncontrollable_load[ind])
-                pr.append(self.prices[ind])
-                
-            self.load = ld
-            self.prices = pr
-            self.tess.uncontrollable_load = un_ld
-            self.tess.cooling_load = [a - b for a, b in zip(ld, un_ld)]
-        if tess_soc is not None:
-            self.tess.initial_soc = tess_soc
+            load = self.to_steps(load)
+            uncontrollable_load = self.to_steps(uncontrollable_load)
+            # Rotate the daily forecasts so the first time step is the current hour
+            _step = int(_hour * 60 / self.time_step_minutes)
+
+            def rotate(values):
+                values = list(values)
+                return values[_step % len(values):] + values[:_step % len(values)]
+
+            self.prices = rotate(self.price_forecast)
+            self.set_forecast(rotate(load), rotate(uncontrollable_load))
+            self.set_start_hour(_hour)
+        if tess_soc is not None and self.use_tess:
+            self.tess.update(initial_soc=tess_soc)
             
-        if bess_soc is not None:
-            self.bess.initial_soc = bess_soc 
+        if bess_soc is not None and self.use_bess:
+            self.bess.update(initial_soc=bess_soc)
             #self.final_soc = soc
+
+    def set_model_parameter(self):
+        self.model.building_load = pyo.Param(self.time_intervals, mutable=True,
+                                             initialize={i: self.load[i] for i in self.time_intervals})
+        self.model.uncontrollable_load = pyo.Param(self.time_intervals, mutable=True,
+                                                   initialize={i: self.uncontrollable_load[i] for i in self.time_intervals})
+        self.model.price = pyo.Param(self.time_intervals, mutable=True,
+                                     initialize={i: self.prices[i] for i in self.time_intervals})
+        self.model.max_load = pyo.Param(mutable=True, initialize=max(self.load[:self.window_length]))
+        if self.control_type == 3 and self.type_of_demand_rate.lower() == 'tou':
+            # 1 for the time steps inside the peak and partial peak windows, updated with the start hour
+            self.model.peak_window = pyo.Param(self.time_intervals, mutable=True, initialize=0)
+            self.model.partial_peak_window = pyo.Param(self.time_intervals, mutable=True, initialize=0)
+            self.set_start_hour(self.start_hour)
+
+    def set_start_hour(self, start_hour):
+        """
+        Set the hour of the day of the first time step and move the demand charge windows accordingly.
+        """
+        self.start_hour = start_hour
+        if self.control_type == 3 and self.type_of_demand_rate.lower() == 'tou':
+            for i in self.time_intervals:
+                hour = self.interval_hour(i)
+                in_peak = self.peak_time_start <= hour < self.peak_time_end
+                in_partial_peak = (self.first_partial_peak_start <= hour < self.first_partial_peak_stop or
+                                   self.second_partial_peak_start <= hour < self.second_partial_peak_stop)
+                self.model.peak_window[i] = int(in_peak)
+                self.model.partial_peak_window[i] = int(in_partial_peak and not in_peak)
         
-        self.set_model_variable()
-        
-        
+    def demand_windows(self, hours):
+        """
+        Whether each hour of the day is in the TOU peak and partial peak windows.
+
+        Args:
+        hours (np.ndarray): Hours of the day.
+
+        Returns:
+        tuple: Peak and partial peak windows, 1 for the hours inside the window and 0 elsewhere.
+        """
+        hours = np.asarray(hours) % 24
+        in_peak = (self.peak_time_start <= hours) & (hours < self.peak_time_end)
+        in_partial_peak = (((self.first_partial_peak_start <= hours) & (hours < self.first_partial_peak_stop)) |
+                           ((self.second_partial_peak_start <= hours) & (hours < self.second_partial_peak_stop)))
+        return in_peak.astype(float), (in_partial_peak & ~in_peak).astype(float)
+
+    def set_billing_peaks(self, **peaks):
+        """
+        Set the peaks already reached in the billing period, keyed by the peak variable: peak_power and, with
+        TOU demand rates, peak_power_during_peak_demand and peak_power_during_partial_peak_demand. They are
+        lower bounds of the peak variables, so the demand charges only price raising the peaks above them.
+        """
+        self.billing_peaks.update(peaks)
+        if self.model is None or self.control_type != 3:
+            return
+        for name, value in self.billing_peaks.items():
+            peak = getattr(self.model, name, None)
+            if peak is not None:
+                peak.setlb(value if name == 'peak_power' else max(value, 0))
+
     def set_model_variable(self):
-        if 'bess' in self.energy_storage_system or 'hybrid' in self.energy_storage_system:
-            self.bess.set_model_variables()
-        if 'tess' in self.energy_storage_system or 'hybrid' in self.energy_storage_system:
-            self.tess.set_model_variables()
-        
         if self.control_type == 3:
             self.model.peak_power = pyo.Var(bounds=(None, None))
-            if self.type_of_demand_rate == 'TOU':
-                self.model.peak_power_during_peak_demand = pyo.Var(bounds=(0, max(self.load)))
-                self.model.peak_power_during_partial_peak_demand = pyo.Var(bounds=(0, max(self.load)))
+            if self.type_of_demand_rate.lower() == 'tou':
+                self.model.peak_power_during_peak_demand = pyo.Var(bounds=(0, None))
+                self.model.peak_power_during_partial_peak_demand = pyo.Var(bounds=(0, None))
         self.model.total_power = pyo.Var(self.time_intervals, bounds=(0, None))
         
     def peak_limit_constraint(self, model, interval):
@@ -114,22 +224,28 @@ class Optimization():
         if self.control_type == 3:
             return model.total_power[interval] <= model.peak_power
         elif self.control_type in [1, 2]:
-            return model.total_power[interval] <= max(self.load)
+            return model.total_power[interval] <= model.max_load
         else:
             return model.total_power[interval] <= self.peak_demand_limit
         
+    def interval_hour(self, interval):
+        """
+        Hour of the day, as a float, at the start of a time step.
+        """
+        return (self.start_hour + interval * self.dt) % 24
+
     def demand_charge_constraint(self, model, interval):
         """
         Enforce demand charge constraints based on different peak periods.
+        The window parameters are 0 outside the period, which relaxes the constraint for that time step.
         """
-        if self.peak_time_start <= interval < self.peak_time_end:
-            return model.total_power_consumption[interval] <= model.peak_power_during_peak_demand
-        elif self.first_partial_peak_start <= interval < self.first_partial_peak_stop:
-            return model.total_power_consumption[interval] <= model.peak_power_during_partial_peak_demand
-        elif self.second_partial_peak_start <= interval < self.second_partial_peak_stop:
-            return model.total_power_consumption[interval] <= model.peak_power_during_partial_peak_demand
-        else:
-            return pyo.Constraint.Skip
+        return model.peak_window[interval] * model.total_power[interval] <= model.peak_power_during_peak_demand
+
+    def partial_peak_demand_charge_constraint(self, model, interval):
+        """
+        Enforce demand charge constraints for the partial peak periods.
+        """
+        return model.partial_peak_window[interval] * model.total_power[interval] <= model.peak_power_during_partial_peak_demand
         
     
     def total_power_constraint(self, model, interval):
@@ -142,31 +258,36 @@ class Optimization():
         tess_power = 0
 
         # Check the energy storage system configuration and adjust BESS and TESS power variables accordingly.
-        if 'bess' in self.energy_storage_system.lower():
+        if self.use_bess:
             bess_power = -model.bess_power[interval]  # Subtracting BESS power as it's likely providing power back to the grid or load.
-        if 'tess' in self.energy_storage_system.lower():
+        if self.use_tess:
             tess_power = model.tess_power[interval]   # Adding TESS power as it contributes to the load consumption.
 
         # The total power consumption for the given interval is the sum of building load, BESS, and TESS power contributions.
-        return model.total_power_consumption[interval] == bess_power + self.load[interval] + tess_power
+        return model.total_power[interval] == bess_power + model.building_load[interval] + tess_power
 
     
     def apply_constraints(self):
-        if 'bess' in self.energy_storage_system or 'hybrid' in self.energy_storage_system:
+        if self.use_bess:
             self.bess.apply_constraints()
-        if 'tess' in self.energy_storage_system or 'hybrid' in self.energy_storage_system:
+        if self.use_tess:
             self.tess.apply_constraints()
         self.model.total_power_constraint = pyo.Constraint(self.time_intervals, rule=self.total_power_constraint)
         self.model.peak_limit_constraint = pyo.Constraint(self.time_intervals, rule=self.peak_limit_constraint)
-        if self.type_of_demand_rate.lower() == 'tou':
+        if self.control_type == 3 and self.type_of_demand_rate.lower() == 'tou':
             self.model.demand_charge_constraint = pyo.Constraint(self.time_intervals, rule=self.demand_charge_constraint)
+            self.model.partial_peak_demand_charge_constraint = pyo.Constraint(self.time_intervals, rule=self.partial_peak_demand_charge_constraint)
         
 
     def obj_rule(self, model):
         obj_cost = 0
         if self.control_type == 3:
-            obj_cost = obj_cost + self.demand_charge_daily * model.p_peak
-        obj_cost = obj_cost + sum(self.prices[i] * (model.p_total[i]) for i in range(0, self.window_length))
+            obj_cost = obj_cost + self.demand_charge_daily * model.peak_power
+            if self.type_of_demand_rate.lower() == 'tou':
+                obj_cost = obj_cost + self.peak_demand_rate_daily * model.peak_power_during_peak_demand + \
+                           self.part_peak_demand_price_daily * model.peak_power_during_partial_peak_demand
+        # Energy cost of each time step: price per kWh times the average power over the step
+        obj_cost = obj_cost + sum(model.price[i] * (model.total_power[i]) * self.dt for i in self.time_intervals)
         return obj_cost
     
     def get_pyomo_var_values(self, pyomo_var):
@@ -183,20 +304,43 @@ class Optimization():
         return [pyo.value(pyomo_var[j]) for j in range(self.window_length)]
 
 
-    def run_opt(self):
+    def shift_solution(self, steps=1):
+        """
+        Shift the current solution by a number of time steps, so it can seed the next solve of a rolling
+        horizon. Each time indexed variable, including the binaries and the piecewise variables, takes the
+        value of the step `steps` later; the last steps repeat the last value.
+
+        Args:
+        steps (int): Number of time steps the horizon moved forward.
+        """
+        last = self.window_length - 1
+        for component in self.model.component_objects((pyo.Var, pyo.Block), descend_into=False):
+            if not component.is_indexed() or len(component) != self.window_length:
+                continue
+            for i in self.time_intervals:
+                source, target = component[min(i + steps, last)], component[i]
+                if component.ctype is pyo.Var:
+                    pairs = [(source, target)]
+                else:
+                    pairs = zip(source.component_data_objects(pyo.Var), target.component_data_objects(pyo.Var))
+                for source_var, target_var in pairs:
+                    target_var.set_value(source_var.value, skip_validation=True)
+
+    def run_opt(self, warmstart=False):
         """
         Run the optimization model and extract results using a dedicated function for retrieving Pyomo variable values.
 
+        Args:
+        warmstart (bool): Start the solver from the current variable values.
+
         Returns:
         dict: A dictionary containing all relevant optimization results.
         """
-        # Set the objective function of the model
-        self.model.obj = pyo.Objective(rule=self.obj_rule, sense=pyo.minimize)
-        solver = pyo.SolverFactory('mindtpy')
-        
-        # Attempt to solve the model using the specified solver configuration
+        # The solver backend is picked from the problem type: the polynomial TESS envelopes make the
+        # problem a MINLP, otherwise it is a MILP solved in a single pass
         try:
-            solver.solve(self.model, mip_solver='glpk', nlp_solver='ipopt', tee=True)
+            with self.timer.phase('solve'):
+                solver_name = self.solver.solve(self.model, warmstart=warmstart)
         except ValueError as ve:
             print(f"ValueError during optimization: {ve}")
             print(self.model.pprint())
@@ -205,19 +349,40 @@ class Optimization():
             print(f"Exception during optimization: {e}")
             raise
 
+        with self.timer.phase('extract'):
+            results = self.get_results(solver_name)
+        # Phases timed since the previous run: the build or forecast update, solve and extraction
+        results['timings'] = dict(self.timer.timings)
+        self.timer.reset()
+        return results
+
+    def get_results(self, solver_name=None):
+        """
+        Extract the optimization results from the solved model.
+
+        Args:
+        solver_name (str): Name of the solver backend that produced the solution.
+
+        Returns:
+        dict: A dictionary containing all relevant optimization results.
+        """
         # Initialize the results dictionary using the utility function to retrieve variable values
         results = {
-            'peak_load_prediction': pyo.value(self.model.peak_power),
+            'peak_load_prediction': pyo.value(self.model.peak_power) if self.control_type == 3 else None,
             'total_power': self.get_pyomo_var_values(self.model.total_power),
-            'cooling_load': self.cooling_load
+            'cost': pyo.value(self.model.obj),
+            'cooling_load': self.cooling_load,
+            'time_step_minutes': self.time_step_minutes,
+            'solver': solver_name,
+            'solve_attempts': self.solver.attempts
         }
         
         # Conditionally add BESS and TESS data based on the configuration
-        if 'bess' in self.energy_storage_system.lower():
+        if self.use_bess:
             results['soc_prediction_bess'] = self.get_pyomo_var_values(self.model.state_of_charge)
             results['bess_power'] = self.get_pyomo_var_values(self.model.bess_power)
 
-        if 'tess' in self.energy_storage_system.lower():
+        if self.use_tess:
             results.update({
                 'soc_prediction_tess': self.get_pyomo_var_values(self.model.tess_state_of_charge),
                 'tess_power': self.get_pyomo_var_values(self.model.tess_power),
@@ -0,0 +1,220 @@
+"""
+Precomputed dispatch policy of a building.
+
+The optimization is solved offline for every hour of the day and every SOC of a grid, with the daily
+forecasts of the building rotated to start at that hour, and the optimal setpoint of the first time step is
+kept. The table is saved as a compressed NumPy archive; the agent reads it to dispatch the storage at
+the measured SOC between two full solves, interpolating linearly between the SOC grid points:
+
+    python control/policy_table.py config --forecast forecast.csv --engine dp --output policy.npz
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fleet import normalize_config
+from time_steps import window_steps
+
+SYSTEMS = ('bess', 'tess')
+# Configuration entries the optimal setpoints depend on; a table built for other values is not used
+POLICY_CONFIG_KEYS = ('energy_storage_system', 'control_type', 'control', 'peak_demand_limit', 'demand_charge',
+                      'demand_rate_config', 'bess_config', 'tess_config', 'time_step_minutes', 'window_length',
+                      'window_length_unit', 'demand_charge_share', 'billing_peaks')
+
+
+def policy_key(config):
+    """
+    Hash of the configuration entries a policy table is built for. The configuration is normalized first,
+    so the agent configuration and the one the table was built from hash alike.
+    """
+    config = normalize_config(dict(config))
+    entries = {key: config[key] for key in POLICY_CONFIG_KEYS if key in config}
+    encoded = json.dumps(entries, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def rotate(values, hour, time_step_minutes, window_length):
+    """
+    Daily forecast over the window starting at the hour of the day, wrapping around midnight.
+    """
+    steps_per_day = 24 * 60 // time_step_minutes
+    values = np.asarray(values, dtype=float)
+    if len(values) < steps_per_day:
+        # Hourly forecast, repeated over the time steps of each hour
+        values = np.repeat(values, max(60 // time_step_minutes, 1))
+    values = values[:steps_per_day]
+    return np.resize(np.roll(values, -int(round(hour * 60 / time_step_minutes))), window_length)
+
+
+def interpolation_weights(axis, value):
+    """
+    Grid points around the value and their linear interpolation weights; values off the grid are clipped.
+    """
+    value = min(max(value, axis[0]), axis[-1])
+    upper = min(int(np.searchsorted(axis, value, side='right')), len(axis) - 1)
+    lower = max(upper - 1, 0)
+    if upper == lower:
+        return ((lower, 1.),)
+    weight = (value - axis[lower]) / (axis[upper] - axis[lower])
+    return ((lower, 1. - weight), (upper, weight))
+
+
+class PolicyTable:
+    """
+    Optimal first time step setpoints indexed by the hour of the day and the SOC of each storage.
+    """
+
+    def __init__(self, hours, socs, setpoints, key=''):
+        """
+        Args:
+            hours (array): Hours of the day of the table rows, increasing.
+            socs (dict): SOC grid of each storage of the system, keyed by 'bess' and 'tess'.
+            setpoints (dict): Arrays of setpoints keyed by 'bess_power' and 'tess_power', of shape
+                (hours, SOC grid of each storage in SYSTEMS order).
+            key (str): policy_key of the configuration the table is built for.
+        """
+        self.hours = np.asarray(hours, dtype=float)
+        self.socs = {system: np.asarray(values, dtype=float) for system, values in socs.items()}
+        self.setpoints = {name: np.asarray(values, dtype=float) for name, values in setpoints.items()}
+        self.key = key
+        self.systems = [system for system in SYSTEMS if system in self.socs]
+
+    def save(self, path):
+        arrays = {f"{system}_soc": values for system, values in self.socs.items()}
+        arrays.update(self.setpoints)
+        np.savez_compressed(path, hours=self.hours, key=np.array(self.key), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as archive:
+            socs = {system: archive[f"{system}_soc"] for system in SYSTEMS if f"{system}_soc" in archive}
+            setpoints = {f"{system}_power": archive[f"{system}_power"] for system in socs}
+            return cls(archive['hours'], socs, setpoints, str(archive['key']))
+
+    def row(self, hour):
+        # The row of the last table hour at or before the hour, wrapping around midnight
+        return (int(np.searchsorted(self.hours, hour % 24, side='right')) - 1) % len(self.hours)
+
+    def lookup(self, hour, bess_soc=None, tess_soc=None):
+        """
+        Setpoints of the storages at the hour of the day and measured SOC.
+
+        Args:
+            hour (float): Hour of the day.
+            bess_soc (float): Measured BESS SOC, if the system has a BESS.
+            tess_soc (float): Measured TESS SOC, if the system has a TESS.
+
+        Returns:
+            dict: The 'bess_power' and 'tess_power' setpoints of the storages of the system; NaN where
+            the table has no solution around the SOC.
+        """
+        measured = {'bess': bess_soc, 'tess': tess_soc}
+        row = self.row(hour)
+        corners = list(itertools.product(*(interpolation_weights(self.socs[system], measured[system])
+                                           for system in self.systems)))
+        results = {}
+        for name, values in self.setpoints.items():
+            value = 0.
+            for corner in corners:
+                weight = np.prod([point_weight for _, point_weight in corner])
+                if weight > 0:
+                    value += weight * values[(row,) + tuple(index for index, _ in corner)]
+            results[name] = float(value)
+        return results
+
+
+def build_policy_table(config, load, uncontrollable_load, price, hours=None, soc_points=9):
+    """
+    Sweep the hour of the day and the SOC of each storage with the optimization and tabulate the optimal
+    setpoints of the first time step.
+
+    Args:
+        config (dict): Scheduler configuration, as used by Optimization.
+        load (list): Daily building load forecast, hourly or one value per time step.
+        uncontrollable_load (list): Daily uncontrollable load forecast.
+        price (list): Daily price forecast.
+        hours (list): Hours of the day of the table rows. Defaults to every time step of the day.
+        soc_points (int): Number of SOC grid points of each storage, between its min and max SOC.
+
+    Returns:
+        PolicyTable: The tabulated setpoints.
+    """
+    # Imported here so the agent reads tables without loading the optimization modules
+    from matrix_model import create_optimization
+
+    time_step_minutes = config.get('time_step_minutes', 60)
+    window_length = window_steps(config)
+    if hours is None:
+        hours = np.arange(0, 24, time_step_minutes / 60)
+
+    def forecasts(hour):
+        return [rotate(values, hour, time_step_minutes, window_length)
+                for values in (load, uncontrollable_load, price)]
+
+    optimizer = create_optimization(*forecasts(hours[0]), config)
+    storages = {'bess': optimizer.bess if optimizer.use_bess else None,
+                'tess': optimizer.tess if optimizer.use_tess else None}
+    socs = {system: np.linspace(storage.min_soc, storage.max_soc, soc_points)
+            for system, storage in storages.items() if storage is not None}
+    systems = [system for system in SYSTEMS if system in socs]
+    shape = (len(hours),) + tuple(len(socs[system]) for system in systems)
+    setpoints = {f"{system}_power": np.full(shape, np.nan) for system in systems}
+
+    failed = 0
+    for row, hour in enumerate(hours):
+        optimizer.set_forecast(*forecasts(hour))
+        optimizer.set_start_hour(hour)
+        for index in itertools.product(*(range(len(socs[system])) for system in systems)):
+            optimizer.update(**{f"{system}_soc": socs[system][i] for system, i in zip(systems, index)})
+            try:
+                results = optimizer.run_opt()
+            except Exception as e:
+                failed += 1
+                print(f"No solution at hour {hour} and SOC {index}: {e}")
+                continue
+            for name, values in setpoints.items():
+                values[(row,) + index] = results[name][0]
+    if failed:
+        print(f"{failed} of {int(np.prod(shape))} table entries have no solution")
+    return PolicyTable(hours, socs, setpoints, policy_key(config))
+
+
+def main(argv=None):
+    from fleet import load_building
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', help='scheduler configuration of the building')
+    parser.add_argument('--forecast', default=None,
+                        help='CSV file with load, uncontrollable_load and price columns over a day; '
+                             'the forecast_config of the configuration otherwise')
+    parser.add_argument('--engine', default=None, help='optimization engine, the configured one by default')
+    parser.add_argument('--soc-points', type=int, default=9, help='SOC grid points of each storage')
+    parser.add_argument('--hour-step', type=float, default=None,
+                        help='hours between table rows, the time step by default')
+    parser.add_argument('--output', default='policy.npz')
+    args = parser.parse_args(argv)
+
+    building = load_building(args.config, args.forecast)
+    config = building['config']
+    if args.engine:
+        config['engine'] = args.engine
+    hours = np.arange(0, 24, args.hour_step) if args.hour_step else None
+    start = time.perf_counter()
+    table = build_policy_table(config, building['load'], building['uncontrollable_load'], building['price'],
+                               hours, args.soc_points)
+    table.save(args.output)
+    print(f"Saved a {len(table.hours)} hour x {' x '.join(str(len(table.socs[system])) for system in table.systems)} "
+          f"SOC policy table to {args.output} in {time.perf_counter() - start:.1f} s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
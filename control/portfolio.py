@@ -0,0 +1,298 @@
+"""
+Portfolio of optimization configurations solved concurrently.
+
+The solve time of the MINLP with MindtPy varies widely with its strategy and with the day, while the
+piecewise MILP of the matrix engine and the DP take a more predictable time for an approximate model. The
+portfolio engine, `"engine": "portfolio"`, solves the same plan with several configurations at once, one
+process each, and keeps the cheapest plan returned before its deadline. The members still running then
+are cancelled, so the plan time is bounded by the deadline rather than by the slowest configuration, and
+by a hard deadline when no configuration returned a plan in time.
+"""
+import time
+import traceback
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from optimization import Optimization
+from matrix_model import MatrixOptimization, create_optimization
+from model.bess import BatteryEnergyStorageSystem
+from model.tess import ThermalEnergyStorageSystem
+from solve_worker import SolveWorker, warm_up
+
+# Relative tolerance of the check of a plan against the TESS envelopes of the base model
+ENVELOPE_TOLERANCE = 1e-4
+
+
+def default_members(config, engine='pyomo'):
+    """
+    Members of the portfolio when none are configured: the configuration as it is with the base engine,
+    the other MindtPy strategies and the piecewise MILP for the polynomial TESS model, and the DP for a
+    single storage.
+    """
+    storage = config['energy_storage_system'].lower()
+    use_tess = 'tess' in storage or 'hybrid' in storage
+    hybrid = 'hybrid' in storage or ('bess' in storage and 'tess' in storage)
+    members = [{'name': engine, 'engine': engine}]
+    if use_tess and config.get('tess_config', {}).get('formulation', 'polynomial') == 'polynomial':
+        if engine == 'pyomo':
+            members += [{'name': f"mindtpy_{strategy.lower()}", 'engine': 'pyomo',
+                         'solver_config': {'mindtpy_strategy': strategy}} for strategy in ('ECP', 'GOA')]
+        members.append({'name': 'piecewise', 'engine': 'matrix', 'tess_config': {'formulation': 'piecewise'}})
+    elif engine != 'matrix':
+        members.append({'name': 'matrix', 'engine': 'matrix'})
+    if not hybrid:
+        members.append({'name': 'dp', 'engine': 'dp'})
+    return members
+
+
+def member_config(config, member):
+    """
+    Configuration of a member: the scheduler configuration with the entries of the member, dictionaries
+    such as solver_config or tess_config being updated rather than replaced.
+    """
+    merged = {key: value for key, value in config.items() if key != 'portfolio_config'}
+    for key, value in member.items():
+        if key == 'name':
+            continue
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            value = dict(config[key], **value)
+        merged[key] = value
+    return merged
+
+
+def serve_member(conn, config):
+    """
+    Solve loop of a member process. The modules and solver plugins of the member are loaded as soon as it
+    starts; the model is built on the first request and updated in place for the following ones, as in
+    the solve worker.
+
+    Args:
+        conn (Connection): Member end of the pipe to the portfolio.
+        config (dict): Configuration of the member.
+    """
+    warm_up(config)
+    optimizer = None
+    solved = False
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        try:
+            if optimizer is None:
+                optimizer = create_optimization(request['load'], request['uncontrollable_load'], request['price'],
+                                                config)
+            else:
+                optimizer.set_forecast(request['load'], request['uncontrollable_load'], request['price'])
+            optimizer.set_start_hour(request['start_hour'])
+            optimizer.set_billing_peaks(**request['billing_peaks'])
+            optimizer.update(bess_soc=request['bess_soc'], tess_soc=request['tess_soc'])
+            # Only a member that solved the previous plan has a solution to shift
+            warmstart = solved and request['shift'] > 0
+            if warmstart:
+                optimizer.shift_solution(request['shift'])
+            solved = False
+            results = optimizer.run_opt(warmstart=warmstart)
+            solved = True
+            conn.send(('ok', results))
+        except Exception as e:
+            conn.send(('error', f"{e}\n{traceback.format_exc()}"))
+
+
+class PortfolioMember(SolveWorker):
+    """
+    Process of one configuration of the portfolio. It is started ahead of the first plan and started
+    again after a cancel, so it loads its modules while the other members solve.
+    """
+
+    def __init__(self, name, config):
+        super().__init__(config)
+        self.name = name
+
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=serve_member, args=(child_conn, self.config), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def submit(self, request):
+        if self.busy:
+            raise RuntimeError("A solve is already running")
+        if not self.is_alive():
+            self.start()
+        self.conn.send(request)
+        self.busy = True
+
+
+class PortfolioOptimization(Optimization):
+    """
+    Optimization solved by a portfolio of configurations racing in separate processes. It has the
+    interface of Optimization and is selected with `"engine": "portfolio"`. Its settings are read from
+    `portfolio_config`: the `members`, a list of configuration entries each with a `name` (by default
+    from default_members), the base `engine` of the default members, the `deadline` in seconds (default
+    60), the `hard_deadline` after which the plan fails if no member returned one (default twice the
+    deadline) and `stop_on_optimal` (default true) to return as soon as a member solving the base model,
+    rather than the DP or another TESS formulation, reports an optimal plan.
+    """
+
+    # The demand windows and forecasts are plain arrays, as for the matrix engine
+    set_start_hour = MatrixOptimization.set_start_hour
+    set_forecast = MatrixOptimization.set_forecast
+
+    def build_model(self, config):
+        self.model = None
+        if self.use_bess:
+            self.bess = BatteryEnergyStorageSystem(None, dict(config['bess_config'], window_length=self.window_length,
+                                                              time_step_minutes=self.time_step_minutes))
+        if self.use_tess:
+            self.tess = ThermalEnergyStorageSystem(None, dict(config['tess_config'], window_length=self.window_length,
+                                                              time_step_minutes=self.time_step_minutes))
+        portfolio_config = config.get('portfolio_config', {})
+        self.deadline = portfolio_config.get('deadline', 60)
+        self.hard_deadline = portfolio_config.get('hard_deadline', 2 * self.deadline)
+        self.stop_on_optimal = portfolio_config.get('stop_on_optimal', True)
+        members = portfolio_config.get('members') or default_members(config, portfolio_config.get('engine', 'pyomo'))
+        self.members = [PortfolioMember(member['name'], member_config(config, member)) for member in members]
+        for member in self.members:
+            member.prewarm()
+        self.set_start_hour(self.start_hour)
+        self.pending_shift = 0
+        self.outcomes = []
+
+    def shift_solution(self, steps=1):
+        # Each member shifts its own solution with the next request
+        self.pending_shift = steps
+
+    def approximate(self, member):
+        """
+        Whether the member solves an approximation of the base model: the DP plans on a SOC grid, and a
+        TESS formulation other than the one of the base model, e.g. the piecewise envelopes of the
+        polynomial ones.
+        """
+        if member.config.get('engine', 'pyomo') == 'dp':
+            return True
+        formulation = member.config.get('tess_config', {}).get('formulation', 'polynomial').lower()
+        return self.use_tess and formulation != self.tess.formulation
+
+    def exact(self, member, results):
+        """
+        Whether the member proved its plan optimal for the base model, which no other member can then beat
+        by more than the MIP gap.
+        """
+        status = results['solve_attempts'][-1]['status'] if results.get('solve_attempts') else ''
+        return not self.approximate(member) and str(status).lower() == 'optimal'
+
+    def feasible(self, results):
+        """
+        Whether the TESS schedule of a plan stays within the polynomial envelopes of the base model at its
+        planned SOC. The other constraints are the same in every formulation.
+        """
+        if not self.use_tess or self.tess.formulation != 'polynomial':
+            return True
+        tess = self.tess
+        for soc, charging, discharging in zip(results['soc_prediction_tess'], results['tess_u_ch'],
+                                              results['tess_u_dis']):
+            for usage, limit in ((charging, tess.charging_rate_limit(soc)),
+                                 (discharging, tess.discharging_rate_limit(soc))):
+                if usage > max(limit, 0.) + ENVELOPE_TOLERANCE * max(abs(limit), 1.):
+                    return False
+        return True
+
+    def score(self, results):
+        """
+        Cost of a plan on the base model: the energy cost and the demand charges of its total power, with
+        the billing peaks already reached.
+        """
+        total = np.asarray(results['total_power'], dtype=float)
+        cost = float(np.sum(np.asarray(self.prices[:self.window_length], dtype=float) * total * self.dt))
+        if self.control_type == 3:
+            terms = [('peak_power', self.demand_charge_daily, np.ones(self.window_length))]
+            if self.type_of_demand_rate.lower() == 'tou':
+                terms += [('peak_power_during_peak_demand', self.peak_demand_rate_daily, self.peak_window),
+                          ('peak_power_during_partial_peak_demand', self.part_peak_demand_price_daily,
+                           self.partial_peak_window)]
+            for name, rate, window in terms:
+                peak = float(total[window > 0].max()) if window.any() else 0.
+                if name in self.billing_peaks:
+                    peak = max(peak, self.billing_peaks[name])
+                cost += rate * peak
+        return cost
+
+    def cancel(self, members):
+        for member in members:
+            member.cancel()
+            member.prewarm()
+
+    def run_opt(self, warmstart=False):
+        """
+        Solve the plan with every member and return the cheapest plan returned before the deadline, the
+        plans being costed and checked against the TESS envelopes of the base model. If no member returned
+        a plan by the deadline, the first plan returned before the hard deadline is used. The members still
+        running are cancelled.
+
+        Returns:
+            dict: The results of the winning member, with a `portfolio` entry giving the winner and the
+            status, solve time, cost on the base model, cost in its own model and feasibility of every
+            member.
+        """
+        start = time.perf_counter()
+        request = {'load': list(self.load), 'uncontrollable_load': list(self.uncontrollable_load),
+                   'price': list(self.prices), 'start_hour': self.start_hour,
+                   'billing_peaks': dict(self.billing_peaks),
+                   'bess_soc': self.bess.initial_soc if self.use_bess else None,
+                   'tess_soc': self.tess.initial_soc if self.use_tess else None,
+                   'shift': self.pending_shift if warmstart else 0}
+        self.pending_shift = 0
+        outcomes = {}
+        running = {}
+        for member in self.members:
+            try:
+                member.submit(request)
+                running[member.conn] = member
+            except Exception as e:
+                outcomes[member.name] = {'status': 'error', 'error': str(e)}
+        best = None
+        stop = False
+        while running and not stop:
+            remaining = self.deadline - (time.perf_counter() - start)
+            if remaining <= 0:
+                if best is not None:
+                    break
+                # Without a plan yet, wait for the first one until the hard deadline
+                remaining = self.hard_deadline - (time.perf_counter() - start)
+                if remaining <= 0:
+                    break
+            for conn in wait(list(running), remaining):
+                member = running.pop(conn)
+                elapsed = time.perf_counter() - start
+                try:
+                    results = member.collect()
+                except RuntimeError as e:
+                    outcomes[member.name] = {'status': 'error', 'solve_time': elapsed, 'error': str(e).split('\n')[0]}
+                    continue
+                # Plans of approximate members are compared on the base model, feasible plans first
+                rank = (not self.feasible(results), self.score(results))
+                outcomes[member.name] = {'status': 'ok', 'solve_time': elapsed, 'cost': rank[1],
+                                         'model_cost': results['cost'], 'feasible': not rank[0]}
+                if best is None or rank < best[2]:
+                    best = (member, results, rank)
+                stop = stop or (self.stop_on_optimal and self.exact(member, results))
+        for member in running.values():
+            outcomes[member.name] = {'status': 'cancelled', 'solve_time': time.perf_counter() - start}
+        self.cancel(running.values())
+        self.outcomes = outcomes
+        if best is None:
+            raise RuntimeError(f"No portfolio member returned a plan: {outcomes}")
+        member, results, rank = best
+        if rank[0]:
+            print(f"No portfolio plan is within the envelopes of the base model, using the {member.name} plan")
+        results['portfolio'] = {'winner': member.name, 'members': outcomes}
+        results.setdefault('timings', {})['portfolio'] = time.perf_counter() - start
+        return results
+
+    def close(self):
+        for member in self.members:
+            member.close()
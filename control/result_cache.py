@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import zlib
+
+import numpy as np
+
+# Configuration entries that change the optimization results; the rest of the agent configuration
+# (topics, actuators, schedules, ...) is left out of the key
+CONFIG_KEYS = ('energy_storage_system', 'control_type', 'control', 'peak_demand_limit', 'demand_charge',
+               'demand_rate_config', 'bess_config', 'tess_config', 'time_step_minutes', 'window_length',
+               'window_length_unit', 'engine', 'dp_config', 'solver_config', 'demand_charge_share', 'billing_peaks',
+               'portfolio_config')
+SUFFIX = '.bin'
+
+
+class ResultCache:
+    """
+    On-disk cache of optimization results keyed by a hash of the normalized inputs: the rounded forecasts,
+    the SOC and other update arguments, and the configuration entries the model is built from. Identical
+    inputs, e.g. after an agent restart or a configuration push that changed no optimization setting,
+    return the stored results without building or solving the model.
+
+    Each result is a zlib compressed pickle in its own file named after the key. Reading a result refreshes
+    its modification time and the least recently used files are removed once the cache exceeds its size.
+    """
+
+    def __init__(self, cache_dir, max_bytes=64 * 1024 ** 2, precision=3):
+        """
+        Args:
+            cache_dir (str): Directory of the cached results, created if needed.
+            max_bytes (int): Size of the cache on disk above which the least recently used results are
+                removed.
+            precision (int): Number of decimals the forecasts and SOC are rounded to in the key.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.precision = precision
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def normalize(self, values):
+        if values is None:
+            return None
+        if isinstance(values, dict):
+            return {key: self.normalize(value) for key, value in values.items()}
+        if np.ndim(values) == 0:
+            return round(float(values), self.precision) if isinstance(values, (float, np.floating)) else values
+        return np.round(np.asarray(values, dtype=float), self.precision).tolist()
+
+    def key(self, config, load, uncontrollable_load, price, update=None):
+        """
+        Hash of the inputs of a solve.
+
+        Returns:
+            str: Hex digest identifying the results of these inputs.
+        """
+        inputs = {
+            'config': {key: config[key] for key in CONFIG_KEYS if key in config},
+            'load': self.normalize(load),
+            'uncontrollable_load': self.normalize(uncontrollable_load),
+            'price': self.normalize(price),
+            'update': self.normalize(update or {})
+        }
+        encoded = json.dumps(inputs, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + SUFFIX)
+
+    def get(self, key):
+        """
+        Return the cached results of the key, or None on a miss or an unreadable entry.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                results = pickle.loads(zlib.decompress(cache_file.read()))
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Discarding unreadable cached result {path}: {e}")
+            self.remove(path)
+            return None
+        return results
+
+    def put(self, key, results):
+        """
+        Store the results of the key and evict the least recently used results over the size limit.
+        """
+        data = zlib.compress(pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL))
+        # Written to a temporary file and renamed so a concurrent reader never sees a partial result
+        handle, temporary = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as cache_file:
+                cache_file.write(data)
+            os.replace(temporary, self.path(key))
+        except Exception:
+            self.remove(temporary)
+            raise
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(SUFFIX):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(SUFFIX):
+                self.remove(entry.path)
@@ -0,0 +1,233 @@
+"""
+Batched solving of load and price forecast scenarios.
+
+A scenario set is an (N scenarios x horizon) array of load, uncontrollable load and price forecasts;
+a single vector is shared by all scenarios. The scenarios are solved either one after the other on a
+single Optimization whose forecasts are updated in place, or split over a pool of worker processes that
+each build the model once for their share of the scenarios. Either way similar scenarios are solved one
+after the other, each solve being warm started from the solution of the previous one. The two-stage option solves one model whose
+first hour of storage setpoints is shared by every scenario and minimizes the expected cost.
+"""
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyomo.environ as pyo
+
+from optimization import Optimization
+from matrix_model import create_optimization
+from solver_backend import SolverBackend
+
+
+def as_scenarios(values, num_scenarios=None):
+    """
+    Return the forecasts as a (scenarios x horizon) array, repeating a single vector for every scenario.
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    if num_scenarios is not None and values.shape[0] == 1:
+        values = np.repeat(values, num_scenarios, axis=0)
+    return values
+
+
+def scenario_result(index, results=None, error=None, solve_time=0.):
+    if error is not None:
+        return {'scenario': index, 'status': 'failed', 'error': error, 'solve_time': solve_time}
+    return {
+        'scenario': index,
+        'status': 'ok',
+        'cost': results['cost'],
+        'peak': max(results['total_power']),
+        'schedule': results,
+        'solve_time': solve_time
+    }
+
+
+def solve_sequential(config, loads, uncontrollable_loads, prices, indices=None):
+    """
+    Solve the scenarios one after the other on one model built for the first scenario, each solve starting
+    from the solution of the previous scenario.
+
+    Args:
+        config (dict): Scheduler configuration.
+        loads, uncontrollable_loads, prices (np.ndarray): (scenarios x horizon) forecasts.
+        indices (list): Scenario numbers reported in the results. Defaults to 0..N-1.
+
+    Returns:
+        list: The result of each scenario.
+    """
+    indices = range(len(loads)) if indices is None else indices
+    optimizer = None
+    # Whether the model holds the solution of the previous scenario, which a failed solve does not leave
+    solved = False
+    outcomes = []
+    for index, load, uncontrollable_load, price in zip(indices, loads, uncontrollable_loads, prices):
+        start = time.perf_counter()
+        try:
+            if optimizer is None:
+                optimizer = create_optimization(load, uncontrollable_load, price, config)
+            else:
+                optimizer.set_forecast(load, uncontrollable_load, price)
+            warmstart = solved
+            solved = False
+            results = optimizer.run_opt(warmstart=warmstart)
+            solved = True
+            outcomes.append(scenario_result(index, results, solve_time=time.perf_counter() - start))
+        except Exception as e:
+            outcomes.append(scenario_result(index, error=f"{e}\n{traceback.format_exc()}",
+                                            solve_time=time.perf_counter() - start))
+    return outcomes
+
+
+def similarity_order(loads, uncontrollable_loads, prices):
+    """
+    Order of the scenarios in which each one is followed by the most similar of the remaining ones, so a
+    solve starts from the solution of a close scenario. Each forecast is scaled by its largest value.
+    """
+    features = np.hstack([values / (np.abs(values).max() or 1.)
+                          for values in (loads, uncontrollable_loads, prices)])
+    remaining = list(range(1, len(features)))
+    order = [0]
+    while remaining:
+        distances = np.linalg.norm(features[remaining] - features[order[-1]], axis=1)
+        order.append(remaining.pop(int(np.argmin(distances))))
+    return np.array(order)
+
+
+def summarize(outcomes):
+    """
+    Summary statistics of the cost and peak over the solved scenarios.
+    """
+    solved = [outcome for outcome in outcomes if outcome['status'] == 'ok']
+    summary = {'scenarios': len(outcomes), 'solved': len(solved)}
+    for key in ('cost', 'peak'):
+        values = np.array([outcome[key] for outcome in solved], dtype=float)
+        if len(values) == 0:
+            continue
+        summary[key] = {
+            'mean': float(values.mean()),
+            'std': float(values.std()),
+            'min': float(values.min()),
+            'p5': float(np.percentile(values, 5)),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'max': float(values.max())
+        }
+    return summary
+
+
+class ScenarioSolver:
+    """
+    Solve a set of forecast scenarios of one building in batch.
+    """
+
+    def __init__(self, config):
+        """
+        Args:
+            config (dict): Scheduler configuration, as used by Optimization.
+        """
+        self.config = config
+
+    def prepare(self, loads, uncontrollable_loads, prices):
+        loads = as_scenarios(loads)
+        num_scenarios = loads.shape[0]
+        return loads, as_scenarios(uncontrollable_loads, num_scenarios), as_scenarios(prices, num_scenarios)
+
+    def solve(self, loads, uncontrollable_loads, prices, workers=1):
+        """
+        Solve every scenario independently.
+
+        Args:
+            loads (array): (scenarios x horizon) load forecasts.
+            uncontrollable_loads (array): Uncontrollable load forecasts, one per scenario or shared.
+            prices (array): Price forecasts, one per scenario or shared.
+            workers (int): Number of worker processes. With 1 the scenarios are solved sequentially in
+                this process on a single model, warm started from the most similar scenario solved before.
+
+        Returns:
+            dict: The result of each scenario, with its schedule, cost and peak, and summary statistics.
+        """
+        loads, uncontrollable_loads, prices = self.prepare(loads, uncontrollable_loads, prices)
+        # Similar scenarios are solved one after the other, in the same worker
+        order = similarity_order(loads, uncontrollable_loads, prices)
+        if workers <= 1:
+            outcomes = solve_sequential(self.config, loads[order], uncontrollable_loads[order], prices[order],
+                                        order.tolist())
+        else:
+            outcomes = []
+            chunks = [chunk for chunk in np.array_split(order, workers) if len(chunk)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(solve_sequential, self.config, loads[chunk],
+                                           uncontrollable_loads[chunk], prices[chunk], chunk.tolist())
+                           for chunk in chunks]
+                for chunk, future in zip(chunks, futures):
+                    try:
+                        outcomes.extend(future.result())
+                    except Exception as e:
+                        outcomes.extend(scenario_result(index, error=f"worker failed: {e!r}")
+                                        for index in chunk.tolist())
+        outcomes.sort(key=lambda outcome: outcome['scenario'])
+        return {'scenarios': outcomes, 'summary': summarize(outcomes)}
+
+    def solve_two_stage(self, loads, uncontrollable_loads, prices, probabilities=None, shared_hours=1):
+        """
+        Solve one model over all scenarios whose storage setpoints of the first hours are shared by every
+        scenario, minimizing the probability weighted cost.
+
+        Args:
+            loads (array): (scenarios x horizon) load forecasts.
+            uncontrollable_loads (array): Uncontrollable load forecasts, one per scenario or shared.
+            prices (array): Price forecasts, one per scenario or shared.
+            probabilities (list): Probability of each scenario. Equal probabilities if None.
+            shared_hours (float): Length of the first stage, in hours.
+
+        Returns:
+            dict: The shared first stage setpoints, the result of each scenario, the expected cost and
+            summary statistics.
+        """
+        loads, uncontrollable_loads, prices = self.prepare(loads, uncontrollable_loads, prices)
+        num_scenarios = len(loads)
+        if probabilities is None:
+            probabilities = np.full(num_scenarios, 1. / num_scenarios)
+        probabilities = np.asarray(probabilities, dtype=float) / np.sum(probabilities)
+
+        model = pyo.ConcreteModel()
+        optimizers = []
+        for index in range(num_scenarios):
+            optimizer = Optimization(loads[index], uncontrollable_loads[index], prices[index], self.config)
+            optimizer.model.obj.deactivate()
+            setattr(model, f"scenario_{index}", optimizer.model)
+            optimizers.append(optimizer)
+
+        reference = optimizers[0]
+        first_stage = range(min(max(int(shared_hours / reference.dt), 1), reference.window_length))
+        setpoints = [name for name, used in (('bess_power', reference.use_bess), ('tess_power', reference.use_tess))
+                     if used]
+        model.first_stage = pyo.ConstraintList()
+        for optimizer in optimizers[1:]:
+            for name in setpoints:
+                for i in first_stage:
+                    model.first_stage.add(getattr(optimizer.model, name)[i] == getattr(reference.model, name)[i])
+        model.obj = pyo.Objective(expr=sum(probability * optimizer.model.obj.expr
+                                           for probability, optimizer in zip(probabilities, optimizers)),
+                                  sense=pyo.minimize)
+
+        solver = SolverBackend(self.config.get('solver_config', {}))
+        start = time.perf_counter()
+        solver_name = solver.solve(model)
+        solve_time = time.perf_counter() - start
+
+        outcomes = []
+        for index, optimizer in enumerate(optimizers):
+            results = optimizer.get_results(solver_name)
+            results['cost'] = pyo.value(optimizer.model.obj.expr)
+            outcomes.append(scenario_result(index, results, solve_time=solve_time))
+        return {
+            'first_stage': {name: [pyo.value(getattr(reference.model, name)[i]) for i in first_stage]
+                            for name in setpoints},
+            'expected_cost': pyo.value(model.obj),
+            'solver': solver_name,
+            'solve_attempts': solver.attempts,
+            'scenarios': outcomes,
+            'summary': summarize(outcomes)
+        }
@@ -0,0 +1,182 @@
+import atexit
+import importlib
+import multiprocessing
+import time
+import traceback
+
+
+def warm_up(config):
+    """
+    Import the optimization modules of the configured engine and load the plugins of the configured solver
+    backends, so the first request does not pay for them.
+
+    Returns:
+        float: The warm-up time in seconds.
+    """
+    start = time.perf_counter()
+    importlib.import_module('mpc')
+    if config.get('engine') == 'dp':
+        importlib.import_module('dp_dispatch')
+    if config.get('engine') == 'portfolio':
+        importlib.import_module('portfolio')
+    if config.get('engine', 'pyomo') == 'pyomo':
+        from solver_backend import SolverBackend
+        SolverBackend(config.get('solver_config', {})).warm_up()
+    return time.perf_counter() - start
+
+
+def serve(conn, config):
+    """
+    Solve loop of the worker process. The optimization modules and solver plugins are loaded as soon as
+    the worker starts; the optimization model is built on the first request and its forecasts and SOC are
+    updated in place for the following ones; a request with a shift is warm started from the previous plan.
+
+    Args:
+        conn (Connection): Worker end of the pipe to the agent.
+        config (dict): Scheduler configuration.
+    """
+    warm_up_time = warm_up(config)
+    # Imported in the worker only, the agent process never loads Pyomo
+    if config.get('long_horizon_config') is not None:
+        from long_horizon import LongHorizonPlanner
+        planner = LongHorizonPlanner(config)
+    else:
+        from mpc import RollingHorizonPlanner
+        planner = RollingHorizonPlanner(config)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        try:
+            results = planner.plan(**request)
+            if warm_up_time is not None:
+                results.setdefault('timings', {})['warm_up'] = warm_up_time
+                warm_up_time = None
+            conn.send(('ok', results))
+        except Exception as e:
+            conn.send(('error', f"{e}\n{traceback.format_exc()}"))
+
+
+class SolveWorker:
+    """
+    Run the optimization in a separate process so the caller's event loop keeps running while the
+    model is built and solved.
+
+    A request is sent with `submit`; the caller waits until `fileno` is readable, which an event loop can
+    do without blocking, and reads the results with `collect`. A solve that runs too long is stopped with
+    `cancel`, which terminates the process; the next `submit` starts a new one.
+    """
+
+    def __init__(self, config):
+        """
+        Args:
+            config (dict): Scheduler configuration, as used by Optimization.
+        """
+        self.config = config
+        # The worker is spawned rather than forked so it does not inherit the caller's event loop state
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.conn = None
+        self.busy = False
+        self.close_at_exit = False
+
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        # A portfolio worker starts a process per member, which a daemonic process is not allowed to do
+        daemon = self.config.get('engine') != 'portfolio'
+        self.process = self.context.Process(target=serve, args=(child_conn, self.config), daemon=daemon)
+        self.process.start()
+        child_conn.close()
+        if not daemon and not self.close_at_exit:
+            # Non-daemonic processes are joined at exit, so the worker is told to stop first
+            atexit.register(self.close)
+            self.close_at_exit = True
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def prewarm(self):
+        """
+        Start the worker ahead of the first request, so it loads the optimization modules and solver plugins
+        while the caller waits for forecasts.
+        """
+        if not self.is_alive():
+            self.start()
+
+    def submit(self, load, uncontrollable_load, price, update=None, shift=0):
+        """
+        Send a solve request to the worker, starting it if needed.
+
+        Args:
+            load (list): Building load forecast.
+            uncontrollable_load (list): Uncontrollable load forecast.
+            price (list): Price forecast.
+            update (dict): Keyword arguments of Optimization.update, e.g. the current SOCs.
+            shift (int): Time steps elapsed since the previous plan, to warm start from it.
+        """
+        if self.busy:
+            raise RuntimeError("A solve is already running")
+        if not self.is_alive():
+            self.start()
+        self.conn.send({'load': list(load),
+                        'uncontrollable_load': list(uncontrollable_load),
+                        'price': list(price),
+                        'update': update or {},
+                        'shift': shift})
+        self.busy = True
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def ready(self):
+        return self.busy and self.conn.poll()
+
+    def collect(self):
+        """
+        Read the results of the submitted request.
+
+        Returns:
+            dict: The optimization results.
+        """
+        try:
+            status, payload = self.conn.recv()
+        except EOFError:
+            self.cancel()
+            raise RuntimeError("The solve worker exited before returning results")
+        finally:
+            self.busy = False
+        if status != 'ok':
+            raise RuntimeError(payload)
+        return payload
+
+    def terminate(self):
+        """
+        Terminate the worker process from outside the waiting caller, which is woken up and gets an error
+        from `collect`.
+        """
+        if self.process is not None:
+            self.process.terminate()
+
+    def cancel(self):
+        """
+        Stop the running solve by terminating the worker process and release the pipe.
+        """
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(5)
+            self.conn.close()
+        self.process = None
+        self.conn = None
+        self.busy = False
+
+    def close(self):
+        """
+        Stop the worker process, terminating the running solve if any.
+        """
+        if self.is_alive() and not self.busy:
+            self.conn.send(None)
+            self.process.join(5)
+        self.cancel()
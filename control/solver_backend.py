@@ -0,0 +1,249 @@
+import importlib.util
+import math
+import time
+import pyomo.environ as pyo
+from pyomo.opt import TerminationCondition
+
+# Backends tried in order for each problem type, unless overridden in the solver_config
+DEFAULT_BACKENDS = {
+    "lp": ["highs", "glpk", "cbc", "ipopt"],
+    "milp": ["highs", "cbc", "glpk"],
+    "nlp": ["ipopt"],
+    "minlp": ["mindtpy"]
+}
+# Backends of the in-memory mode: the LP and MILP backends run in process, without model or solution files
+IN_MEMORY_BACKENDS = dict(DEFAULT_BACKENDS, lp=["highs"], milp=["highs"])
+
+ACCEPTED_TERMINATIONS = (TerminationCondition.optimal,
+                         TerminationCondition.locallyOptimal,
+                         TerminationCondition.globallyOptimal,
+                         TerminationCondition.feasible)
+
+
+class SolverBackend:
+    """
+    Select a solver backend based on the problem type of a Pyomo model and solve it under a wall-clock
+    time limit and gap tolerance, falling back to the next backend on timeout or failure.
+    """
+
+    def __init__(self, config):
+        """
+        Initialize the solver backend from the solver configuration.
+
+        Args:
+            config (dict): Solver configuration with the optional keys time_limit (seconds), mip_gap,
+                tee, mip_solver and nlp_solver (MindtPy sub-solvers), mindtpy_strategy (the MindtPy
+                decomposition, e.g. 'OA', 'ECP' or 'GOA', OA by default), in_memory and lp, milp, nlp and minlp
+                lists giving the backends to try for each problem type. With in_memory, the solvers are
+                kept between solves and only the changed coefficients are passed to them, and MindtPy
+                solves its MIP subproblems with in-process HiGHS.
+        """
+        self.time_limit = config.get("time_limit", 300)
+        self.mip_gap = config.get("mip_gap", 0.01)
+        self.tee = config.get("tee", False)
+        self.in_memory = config.get("in_memory", False)
+        self.mip_solver = config.get("mip_solver", "appsi_highs" if self.in_memory else "glpk")
+        self.nlp_solver = config.get("nlp_solver", "ipopt")
+        self.mindtpy_strategy = config.get("mindtpy_strategy")
+        if self.in_memory and "nlp_solver" not in config and importlib.util.find_spec("cyipopt") is not None:
+            self.nlp_solver = "cyipopt"
+        self.backends = {problem_type: config.get(problem_type, backends)
+                         for problem_type, backends in (IN_MEMORY_BACKENDS if self.in_memory
+                                                        else DEFAULT_BACKENDS).items()}
+        self.attempts = []
+        # Persistent solvers and the problem type of the last model, reused by the in-memory mode
+        self.solvers = {}
+        self.last_model = None
+        self.last_problem_type = None
+
+    def problem_type(self, model):
+        """
+        Classify the model as 'lp', 'milp', 'nlp' or 'minlp'.
+
+        Args:
+            model (pyo.ConcreteModel): The Pyomo model.
+
+        Returns:
+            str: The problem type.
+        """
+        discrete = any(var.is_integer() or var.is_binary()
+                       for var in model.component_data_objects(pyo.Var, active=True) if not var.fixed)
+        nonlinear = any(con.body.polynomial_degree() not in (0, 1)
+                        for con in model.component_data_objects(pyo.Constraint, active=True))
+        nonlinear = nonlinear or any(obj.expr.polynomial_degree() not in (0, 1)
+                                     for obj in model.component_data_objects(pyo.Objective, active=True))
+        if nonlinear:
+            return "minlp" if discrete else "nlp"
+        return "milp" if discrete else "lp"
+
+    def make_solver(self, name, warmstart=False, time_limit=None):
+        """
+        Create the Pyomo solver for a backend and the keyword arguments of its solve call, applying the
+        time limit and gap tolerance in the option names the backend understands.
+
+        Args:
+            name (str): The backend name.
+            warmstart (bool): Pass the current variable values to the backend as a starting point.
+            time_limit (float): Time limit of the solve in seconds, the configured time_limit by default.
+
+        Returns:
+            tuple: The solver and the keyword arguments of its solve call.
+        """
+        time_limit = self.time_limit if time_limit is None else time_limit
+        solve_options = {"tee": self.tee, "load_solutions": False, "timelimit": time_limit}
+        if name == "highs":
+            # A kept appsi solver updates its HiGHS model with the changed parameters instead of rebuilding it
+            solver = self.solvers.get(name) or pyo.SolverFactory("appsi_highs")
+            if self.in_memory:
+                self.solvers[name] = solver
+            solver.options["mip_rel_gap"] = self.mip_gap
+        elif name == "cbc":
+            solver = pyo.SolverFactory("cbc")
+            solver.options["seconds"] = time_limit
+            solver.options["ratioGap"] = self.mip_gap
+        elif name == "glpk":
+            solver = pyo.SolverFactory("glpk")
+            # glpk takes whole seconds
+            solver.options["tmlim"] = max(int(time_limit), 1)
+            solver.options["mipgap"] = self.mip_gap
+        elif name == "ipopt":
+            solver = pyo.SolverFactory("ipopt")
+            # Wall-clock limit as for the other solvers (Ipopt 3.14 and later); max_cpu_time limits CPU time
+            solver.options["max_wall_time"] = time_limit
+        elif name == "mindtpy":
+            solver = pyo.SolverFactory("mindtpy")
+            # MindtPy loads its incumbent itself and passes the time limit on to its sub-solvers; its own
+            # time limit is in whole seconds
+            solve_options = {"tee": self.tee,
+                             "mip_solver": self.mip_solver,
+                             "nlp_solver": self.nlp_solver,
+                             "time_limit": max(int(time_limit), 1),
+                             "relative_bound_tolerance": self.mip_gap,
+                             "mip_solver_args": {"timelimit": time_limit},
+                             "nlp_solver_args": {"timelimit": time_limit}}
+            if self.mindtpy_strategy:
+                solve_options["strategy"] = self.mindtpy_strategy
+        else:
+            solver = pyo.SolverFactory(name)
+        # ipopt starts from the current values anyway; glpk takes no starting point
+        if warmstart and name in ("highs", "cbc"):
+            solve_options["warmstart"] = True
+        return solver, solve_options
+
+    def warm_up(self):
+        """
+        Load the Pyomo plugins of every configured backend and look up its executable or library.
+
+        Returns:
+            dict: Whether each backend is available, keyed by backend name.
+        """
+        available = {}
+        for backends in self.backends.values():
+            for name in backends:
+                if name not in available:
+                    try:
+                        solver, _ = self.make_solver(name)
+                        available[name] = bool(solver.available(exception_flag=False))
+                    except Exception:
+                        available[name] = False
+        return available
+
+    def solver_statistics(self, name, solver, results):
+        """
+        Iteration count, branch-and-bound nodes and MIP gap of the last solve, where the backend reports them.
+
+        Returns:
+            dict: The available statistics.
+        """
+        statistics = {}
+        try:
+            if name == "highs":
+                info = solver._solver_model.getInfo()
+                statistics = {"iterations": info.simplex_iteration_count,
+                              "nodes": info.mip_node_count,
+                              "mip_gap": info.mip_gap}
+            else:
+                branch_and_bound = results.solver.statistics.branch_and_bound
+                statistics = {"nodes": branch_and_bound.number_of_created_subproblems}
+                iterations = getattr(results.solver, "iterations", None)
+                if iterations is not None:
+                    statistics["iterations"] = iterations
+        except Exception:
+            pass
+        # Keep plain numbers only, the attempts are published and serialized
+        return {key: value for key, value in statistics.items() if isinstance(value, (int, float))}
+
+    def mindtpy_incumbent(self, model, results):
+        """
+        Whether MindtPy found a feasible solution before it stopped, e.g. on the time limit, and loaded it
+        into the model. The models are minimized, so the incumbent is the finite upper bound.
+        """
+        upper_bound = results.problem.upper_bound
+        if upper_bound is None or not math.isfinite(float(upper_bound)):
+            return False
+        return all(var.value is not None for var in model.component_data_objects(pyo.Var, active=True)
+                   if not var.fixed)
+
+    def solve(self, model, warmstart=False):
+        """
+        Solve the model with the backends configured for its problem type, in order, until one succeeds.
+        The time limit is shared by all of them: each backend gets the time left, and a time-limited
+        solution, including MindtPy's incumbent, is kept if no backend finishes. Every attempt is recorded
+        in `attempts` with its solver, status, solve time and, where the backend reports them, its
+        iteration count, nodes and MIP gap.
+
+        Args:
+            model (pyo.ConcreteModel): The Pyomo model.
+            warmstart (bool): Start from the current variable values, including binaries for MIP starts.
+
+        Returns:
+            str: The name of the backend whose solution was loaded into the model.
+        """
+        self.attempts = []
+        if self.in_memory and model is self.last_model:
+            # The structure of a persistent model does not change between solves, only its parameters
+            problem_type = self.last_problem_type
+        else:
+            problem_type = self.problem_type(model)
+            self.last_model, self.last_problem_type = model, problem_type
+        incumbent = None
+        deadline = time.time() + self.time_limit
+        for name in self.backends[problem_type]:
+            start = time.time()
+            if deadline - start <= 0:
+                self.attempts.append({"solver": name, "status": "skipped", "solve_time": 0.})
+                continue
+            try:
+                solver, solve_options = self.make_solver(name, warmstart, deadline - start)
+                if not solver.available(exception_flag=False):
+                    self.attempts.append({"solver": name, "status": "unavailable", "solve_time": 0.})
+                    continue
+                results = solver.solve(model, **solve_options)
+            except Exception as e:
+                print(f"Exception during optimization with {name}: {e}")
+                self.attempts.append({"solver": name, "status": "error", "solve_time": time.time() - start})
+                continue
+
+            termination = results.solver.termination_condition
+            self.attempts.append(dict({"solver": name, "status": str(termination), "solve_time": time.time() - start},
+                                      **self.solver_statistics(name, solver, results)))
+            if termination in ACCEPTED_TERMINATIONS:
+                if name != "mindtpy":
+                    model.solutions.load_from(results)
+                return name
+            # Keep the first time-limited solution in case none of the remaining backends does better
+            if incumbent is None:
+                if name == "mindtpy":
+                    if self.mindtpy_incumbent(model, results):
+                        # MindtPy already loaded its incumbent into the model
+                        incumbent = (name, None)
+                elif len(results.solution) > 0:
+                    incumbent = (name, results)
+
+        if incumbent is not None:
+            name, results = incumbent
+            print(f"No backend solved the {problem_type} model to optimality, using the {name} incumbent")
+            if results is not None:
+                model.solutions.load_from(results)
+            return name
+        raise RuntimeError(f"No solver backend could solve the {problem_type} model: {self.attempts}")
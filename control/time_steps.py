@@ -0,0 +1,43 @@
+"""
+Time steps of the planning window.
+
+The forecasts are published hourly while the optimizer may plan on 15 or 5 minute time steps. A forecast
+of a whole number of days of hours, shorter than a day of time steps, is hourly and is repeated over the
+time steps of each hour. `window_length` counts time steps; with sub-hourly time steps, a window_length of
+whole days of hours under a day of time steps, such as the 24 of the shipped configurations, is read as
+hours unless `window_length_unit` is set to 'steps'.
+"""
+
+
+def is_hourly(length, time_step_minutes=60):
+    """
+    Whether a forecast of the length holds hourly values to repeat over sub-hourly time steps.
+    """
+    return time_step_minutes < 60 and length % 24 == 0 and length < 24 * 60 // time_step_minutes
+
+
+def hourly_to_steps(values, time_step_minutes=60):
+    """
+    Repeat each hourly value over the time steps of its hour.
+
+    Args:
+    values (list): Hourly values.
+    time_step_minutes (int): Length of a time step in minutes.
+
+    Returns:
+    list: One value per time step.
+    """
+    steps_per_hour = max(60 // time_step_minutes, 1)
+    return [value for value in values for _ in range(steps_per_hour)]
+
+
+def window_steps(config):
+    """
+    Number of time steps of the planning window of the configuration, one day by default.
+    """
+    time_step_minutes = config.get('time_step_minutes', 60)
+    window_length = config.get('window_length', 24 * 60 // time_step_minutes)
+    unit = config.get('window_length_unit')
+    if unit == 'hours' or (unit is None and is_hourly(window_length, time_step_minutes)):
+        return int(window_length * 60 // time_step_minutes)
+    return window_length
@@ -38,6 +38,7 @@
 
 
 import logging
+import numpy as np
 import pandas as pd
 import sys
 import os
@@ -45,7 +46,12 @@ import gevent
 import json
 from datetime import datetime, timedelta, timezone
 from pandas.tseries.holiday import USFederalHolidayCalendar as hl_day
-from control.optimization import Optimization
+from control.solve_worker import SolveWorker
+from control.policy_table import PolicyTable, policy_key
+from control.forecast_buffer import ForecastBuffer
+from control.time_steps import window_steps
+from control.metrics import PhaseTimer, RollingMetrics
+from gevent.socket import wait_read
 from volttron.platform.agent import utils
 from volttron.platform.agent.utils import format_timestamp, get_aware_utc_now, parse_timestamp_string
 from volttron.platform.messaging import topics
@@ -91,7 +97,7 @@ class Optimize(Agent):
         except:
             _log.warning(
                 "Problem automatically determining timezone! - Default to UTC.")
-            self.localtz = "UTC"
+            self.localtz = timezone.utc
 
         self.config = self.default_config.copy()
         self.run_schedule = None
@@ -100,6 +106,20 @@ class Optimize(Agent):
         self.price_file = None
         self.load_file = None
         self.bess_optimizer = None
+        self.solve_worker = None
+        self.solve_timeout = 600
+        # Start the solve worker, which loads Pyomo and the solver plugins, before the first plan
+        self.prewarm_worker = True
+        # Start of the horizon of the last plan, to warm start the next one in mpc mode
+        self.plan_start = None
+        self.mpc_schedule = None
+        # Precomputed dispatch policy used when the measured SOC drifts from the plan
+        self.policy = None
+        self.policy_soc_tolerance = 2.
+        # Phase timings of the current run and rolling statistics published on the metrics topic
+        self.timer = PhaseTimer()
+        self.metrics = RollingMetrics()
+        self.metrics_topic = ""
         self.oat_point_name = "temperature"
         self.peak_load_prediction = None
         self.season = "Summer"
@@ -109,6 +129,10 @@ class Optimize(Agent):
         self.price = []
         self.load = []
         self.uncontrollable_load = []
+        # Forecasts received over pubsub, one slot per time step
+        self.price_buffer = ForecastBuffer(48)
+        self.load_buffer = ForecastBuffer(48)
+        self.uncontrollable_load_buffer = ForecastBuffer(48)
         self.soc_prediction = []
         self.setpoints = []
         self.total_power = []
@@ -123,6 +147,7 @@ class Optimize(Agent):
         self.bess_soc_topic = ""
         self.publish_topic = ""
         self.window_length = 24
+        self.time_step_minutes = 60
         self.data_source = "postgres.cetc"
         self.external_platform = "vc"
         # self.load_topic =  "PNNL/SEB/ELECTRIC_METER/WholeBuildingPower"
@@ -164,6 +189,11 @@ class Optimize(Agent):
         _log.debug("Update %s for %s", config_name, self.core.identity)
         self.config = self.default_config.copy()
         self.config.update(contents)
+        # The optimization model is built once per configuration, in the solve worker process
+        if self.solve_worker is not None:
+            self.solve_worker.close()
+            self.solve_worker = None
+        self.plan_start = None
         campus = self.config.get("campus", "")
         building = self.config.get("building", "")
         device = self.config.get("device", "")
@@ -173,6 +203,9 @@ class Optimize(Agent):
         self.season = self.config.get("season", self.season)
         self.publish_topic = "record/{}/{}/{}/{}".format(
             campus, building, device, "schedule")
+        self.metrics_topic = self.config.get("metrics_topic", "record/{}/{}/{}/{}".format(
+            campus, building, device, "metrics"))
+        self.metrics = RollingMetrics(self.config.get("metrics_window", 100), self.config.get("metrics_file"))
         # record/PNNL/SEB/BESS/schedule
         # record/PNNL/SEB/TESS/schedule
         self.bess_soc_topic = topics.RPC_DEVICE_PATH(campus=campus,
@@ -186,6 +219,10 @@ class Optimize(Agent):
             "external_platform", self.external_platform)
         self.tess_topic = self.config.get("tess_topic", self.tess_topic)
         self.soc_stale = self.config.get("soc_stale_timedelta", self.soc_stale)
+        self.solve_timeout = self.config.get("solve_timeout", self.solve_timeout)
+        self.prewarm_worker = self.config.get("prewarm_worker", self.prewarm_worker)
+        self.policy = self.load_policy(self.config.get("policy_table"))
+        self.policy_soc_tolerance = self.config.get("policy_soc_tolerance", self.policy_soc_tolerance)
         chiller_config = self.config['chiller_config']
         self.cop = chiller_config.get('COP', 3.5)
         self.hours_to_start = self.config.get(
@@ -209,6 +246,15 @@ class Optimize(Agent):
         self.method = self.config.get("method", "control")
         _log.debug(f"Method is {self.method}")
 
+        self.time_step_minutes = self.config.get("time_step_minutes", 60)
+        self.window_length = window_steps(self.config)
+        buffer_steps = self.config.get("forecast_buffer_steps", 2 * self.window_length)
+        self.mpc_schedule = self.config.get("mpc_schedule", f"*/{self.time_step_minutes} * * * *"
+                                            if self.time_step_minutes < 60 else "0 * * * *")
+        self.price_buffer = ForecastBuffer(buffer_steps, self.time_step_minutes)
+        self.load_buffer = ForecastBuffer(buffer_steps, self.time_step_minutes)
+        self.uncontrollable_load_buffer = ForecastBuffer(buffer_steps, self.time_step_minutes)
+
         if action == "NEW" or "UPDATE":
             if self.forecast_data_source == "info_agent":
                 self.vip.pubsub.subscribe(peer='pubsub',
@@ -243,12 +289,13 @@ class Optimize(Agent):
             _log.debug(f"Energy storage setpoints are {self.setpoints}")
             self.load_file = self.config.get(
                 "load_file", "optimize/data/SEB_power_profile.csv")
-            self.window_length = self.config.get("window_length", 24)
             # self.bess_optimizer_config = self.config.get('bess_optimizer_config', {})
             # self.tess_optimizer_config = self.config.get('tess_optimizer_config', {})
             # self.chiller_config = self.config.get('chiller_config', {})
             # self.demand_rate_config = self.config.get('demand_rate_config', {})
 
+            if self.method.lower() in ("control", "mpc"):
+                self.start_solve_worker()
             gevent.spawn_later(5, self.starting_base)
 
     def starting_base(self, **kwargs):
@@ -277,6 +324,11 @@ class Optimize(Agent):
             if self.hours_to_start:
                 self.core.schedule(next_run, self.run_process)
             self.core.schedule(cron(self.run_schedule), self.run_process)
+        elif self.method.lower() == "mpc":
+            # Re-plan every time step from the measured SOC, warm started from the previous plan
+            next_run = datetime.now().replace(second=0, microsecond=0) + timedelta(minutes=1)
+            self.core.schedule(next_run, self.run_process)
+            self.core.schedule(cron(self.mpc_schedule), self.run_process)
         elif self.method.lower() == "schedule":
             next_run = datetime.now().replace(
                 minute=0, second=0, microsecond=0) + timedelta(minutes=1)
@@ -289,47 +341,49 @@ class Optimize(Agent):
         else:
             pass
 
-    def process_dict_message(self, message, key_point, storage_list, topic, description):
+    def process_dict_message(self, message, key_point, storage, topic, description, timestamp):
         """
-        Process a dictionary message to extract the value for the given key_point and store it in the storage_list.
+        Process a dictionary message to extract the value for the given key_point and store it in the storage buffer.
         Prints the received value or an error message if the key_point is not found.
 
         Args:
             message (dict): The message containing the data.
             key_point (str): The key to look for in the message.
-            storage_list (list): The list to store the extracted value.
+            storage (ForecastBuffer): The buffer to store the extracted value in.
             topic (str): The topic from which the message was received.
             description (str): Description of the value being processed (e.g., 'price', 'load').
+            timestamp (datetime): Time the value applies to.
         """
         if key_point in message:
             value = message[key_point]
-            storage_list.append(value)
+            storage.put(timestamp, value)
             # print(f'Received {description}: {value} on topic: {topic}')
         else:
             _log.debug(
                 f"Not received {description} on topic {topic} with message = {message}")
 
-    def process_message(self, message, key_point, storage_list, topic, description):
+    def process_message(self, message, key_point, storage, topic, description, timestamp):
         """
-        Process the message to extract the value for the given key_point and store it in the storage_list.
+        Process the message to extract the value for the given key_point and store it in the storage buffer.
         Prints the received value or an error message if the key_point is not found.
 
         Args:
             message (dict or list): The message containing the data.
             key_point (str): The key to look for in the message.
-            storage_list (list): The list to store the extracted value.
+            storage (ForecastBuffer): The buffer to store the extracted value in.
             topic (str): The topic from which the message was received.
             description (str): Description of the value being processed (e.g., 'price', 'load').
+            timestamp (datetime): Time the value applies to.
         """
         if isinstance(message, dict):
             # If the message is a dictionary, extract the value for the given key_point
             self.process_dict_message(
-                message, key_point, storage_list, topic, description)
+                message, key_point, storage, topic, description, timestamp)
         else:
             # If the message is a list, extract the value from the first element
             message = message[0]
             self.process_dict_message(
-                message, key_point, storage_list, topic, description)
+                message, key_point, storage, topic, description, timestamp)
 
     def on_tess_data(self, peer, sender, bus, topic, headers, message):
         if isinstance(message, dict):
@@ -360,7 +414,7 @@ class Optimize(Agent):
             message (dict or list): The message containing the data.
         """
         self.process_message(message, self.price_point,
-                             self.price, topic, 'price')
+                             self.price_buffer, topic, 'price', self.message_time(headers))
 
     def on_load_forecast(self, peer, sender, bus, topic, headers, message):
         """
@@ -370,69 +424,133 @@ class Optimize(Agent):
             topic (str): The topic of the message.
             message (dict or list): The message containing the data.
         """
+        timestamp = self.message_time(headers)
         self.process_message(
-            message, self.load_forecast_point, self.load, topic, 'load')
+            message, self.load_forecast_point, self.load_buffer, topic, 'load', timestamp)
         self.process_message(message, self.uncontrollable_load_forecast_point,
-                             self.uncontrollable_load, topic, 'uncontrollable load')
+                             self.uncontrollable_load_buffer, topic, 'uncontrollable load', timestamp)
 
     def update_schedule(self, setpoints):
-        _hour = datetime.now().hour
+        # Setpoints hold one value per time step of the day
+        _step = datetime.now().hour * 60 // self.time_step_minutes
         ld = []
-        for ind in range(_hour, 24):
+        for ind in range(_step, len(setpoints)):
             ld.append(setpoints[ind])
-        for ind in range(0, _hour):
+        for ind in range(0, _step):
             ld.append(setpoints[ind])
         return ld
 
     def schedule_operations(self):
         headers = {'Date': format_timestamp(get_aware_utc_now())}
-        self.get_schedule_from_control()
+        if not self.get_schedule_from_control():
+            return
         message_dict = self.ess_results
         
-        for i in range(self.window_length):
-            sched_hour = datetime.now() + timedelta(hours=i)
-            run_time = sched_hour.replace(minute=0, second=0, microsecond=0)
+        # The first time step of the optimization starts at the plan start, whenever the solve ended
+        forecast_start = self.plan_start
+        window_start = forecast_start.astimezone(self.localtz)
+        with self.timer.phase('schedule'):
+            for i in range(self.window_length):
+                run_time = window_start + timedelta(minutes=i * self.time_step_minutes)
             
-            # Schedule actions for TESS or BESS, or hybrid
-            if self.energy_storage_system == "tess":
-                setpoints = round(self.ess_results['tess_power'][i], self.rounding_precision)
-                adjusted_setpoints = setpoints - self.cooling_load[i] * self.cop if setpoints < 0 else setpoints
-                _log.debug(f"Updated {self.energy_storage_system} setpoints are {adjusted_setpoints}")
-                self.schedule_objects.append(self.core.schedule(
-                    run_time, self.actuate_storage, adjusted_setpoints))
-            elif self.energy_storage_system == "bess":
-                setpoints = round(self.ess_results['bess_power'][i], self.rounding_precision)
-                _log.debug(f"Updated {self.energy_storage_system} setpoints are {setpoints}")
-                self.schedule_objects.append(self.core.schedule(
-                    run_time, self.actuate_storage, setpoints))
-            elif self.energy_storage_system == "hybrid":
-                tess_setpoints = round(self.ess_results['tess_power'][i], self.rounding_precision)
-                bess_setpoints = round(self.ess_results['bess_power'][i], self.rounding_precision)
-                _log.debug(f"Updated {self.energy_storage_system} setpoints: tess = {tess_setpoints}")
-                _log.debug(f"Updated {self.energy_storage_system} setpoints: bess = {bess_setpoints}")
-                self.schedule_objects.append(self.core.schedule(
-                    run_time, self.actuate_storage, (tess_setpoints, bess_setpoints)))
-            else:
-                # Default case for other systems
-                pass
-
-            forecast_time = (get_aware_utc_now() + timedelta(hours=i)
-                             ).replace(minute=0, second=0, microsecond=0)
-
-            if self.method.lower() == "control":
-                # algorithm
-                message_dict[forecast_time] = {
-                        "duration_in_second": 3600
-                    }
-            elif self.method.lower() == "schedule":
-                # configure
-                message_dict[forecast_time] ={
-                        f"{self.energy_storage_system}_setpoints": float(setpoints)
-                    }
-            else:
-                pass
+                # Schedule actions for TESS or BESS, or hybrid
+                if self.energy_storage_system == "tess":
+                    setpoints = round(self.ess_results['tess_power'][i], self.rounding_precision)
+                    adjusted_setpoints = setpoints - self.cooling_load[i] * self.cop if setpoints < 0 else setpoints
+                    _log.debug(f"Updated {self.energy_storage_system} setpoints are {adjusted_setpoints}")
+                    self.schedule_objects.append(self.core.schedule(
+                        run_time, self.dispatch, i, adjusted_setpoints))
+                elif self.energy_storage_system == "bess":
+                    setpoints = round(self.ess_results['bess_power'][i], self.rounding_precision)
+                    _log.debug(f"Updated {self.energy_storage_system} setpoints are {setpoints}")
+                    self.schedule_objects.append(self.core.schedule(
+                        run_time, self.dispatch, i, setpoints))
+                elif self.energy_storage_system == "hybrid":
+                    tess_setpoints = round(self.ess_results['tess_power'][i], self.rounding_precision)
+                    bess_setpoints = round(self.ess_results['bess_power'][i], self.rounding_precision)
+                    _log.debug(f"Updated {self.energy_storage_system} setpoints: tess = {tess_setpoints}")
+                    _log.debug(f"Updated {self.energy_storage_system} setpoints: bess = {bess_setpoints}")
+                    self.schedule_objects.append(self.core.schedule(
+                        run_time, self.dispatch, i, (tess_setpoints, bess_setpoints)))
+                else:
+                    # Default case for other systems
+                    pass
+
+                forecast_time = forecast_start + timedelta(minutes=i * self.time_step_minutes)
+
+                if self.method.lower() in ("control", "mpc"):
+                    # algorithm
+                    message_dict[forecast_time] = {
+                            "duration_in_second": self.time_step_minutes * 60
+                        }
+                elif self.method.lower() == "schedule":
+                    # configure
+                    message_dict[forecast_time] ={
+                            f"{self.energy_storage_system}_setpoints": float(setpoints)
+                        }
+                else:
+                    pass
             
-        self.publish_data(headers, message_dict)
+        with self.timer.phase('publish'):
+            self.publish_data(headers, message_dict)
+
+    def load_policy(self, path):
+        """
+        Read the dispatch policy table built by control/policy_table.py for this configuration.
+
+        Returns:
+            PolicyTable: The table, or None if none is configured or it does not match the configuration.
+        """
+        if not path:
+            return None
+        try:
+            policy = PolicyTable.load(path)
+        except Exception as e:
+            _log.error(f"Cannot read the policy table {path}: {e}")
+            return None
+        if policy.key != policy_key(self.config):
+            _log.warning(f"Policy table {path} was built for another configuration, not using it")
+            return None
+        return policy
+
+    def dispatch(self, step, value):
+        """
+        Actuate the planned setpoints of a time step of the plan. With a policy table, the setpoints are
+        looked up in the table at the measured SOC instead when it drifted from the planned SOC by more than
+        policy_soc_tolerance, without waiting for the next solve.
+        """
+        if self.policy is not None:
+            value = self.policy_setpoints(step, value)
+        self.actuate_storage(value)
+
+    def policy_setpoints(self, step, value):
+        systems = ("tess", "bess") if self.energy_storage_system == "hybrid" else (self.energy_storage_system,)
+        planned = value if isinstance(value, tuple) else (value,)
+        measured = {"bess": self.bess_soc, "tess": self.tess_soc}
+        drift = 0.
+        for system in systems:
+            prediction = self.ess_results.get(f"soc_prediction_{system}")
+            if measured[system] is None or prediction is None or step >= len(prediction):
+                return value
+            drift = max(drift, abs(measured[system] - prediction[step]))
+        if drift <= self.policy_soc_tolerance:
+            return value
+        now = datetime.now()
+        setpoints = self.policy.lookup(now.hour + now.minute / 60, bess_soc=self.bess_soc, tess_soc=self.tess_soc)
+        dispatched = []
+        for system, planned_value in zip(systems, planned):
+            setpoint = setpoints.get(f"{system}_power", np.nan)
+            if np.isnan(setpoint):
+                dispatched.append(planned_value)
+                continue
+            setpoint = round(setpoint, self.rounding_precision)
+            if self.energy_storage_system == "tess" and setpoint < 0:
+                setpoint = setpoint - self.cooling_load[step] * self.cop
+            dispatched.append(setpoint)
+        _log.debug(f"SOC is {drift:.1f} off the plan, dispatching {dispatched} from the policy table "
+                   f"instead of {list(planned)}")
+        self.metrics.add("policy.soc_drift", drift)
+        return tuple(dispatched) if self.energy_storage_system == "hybrid" else dispatched[0]
 
     def forward_fill_na(self, lst):
         if not lst:
@@ -461,6 +579,42 @@ class Optimize(Agent):
 
         return lst
 
+    def message_time(self, headers):
+        """
+        Time a forecast message applies to, from its headers, or the current time if it has none.
+        """
+        timestamp = headers.get('TimeStamp', headers.get('Date'))
+        return parse_timestamp_string(timestamp) if timestamp else get_aware_utc_now()
+
+    def current_plan_start(self):
+        """
+        Start of the planning horizon: the current time step for pubsub forecasts, the current hour for
+        the daily forecasts of the configuration, which are rotated by hour.
+        """
+        now = get_aware_utc_now()
+        minute = 0
+        if self.forecast_data_source == "info_agent" and self.time_step_minutes < 60:
+            minute = now.minute // self.time_step_minutes * self.time_step_minutes
+        return now.replace(minute=minute, second=0, microsecond=0)
+
+    def read_forecast_buffers(self):
+        """
+        Read the planning horizon from the forecast buffers, starting at the current time step.
+
+        Returns:
+            bool: False if a forecast has no value at all over the horizon.
+        """
+        start = self.current_plan_start()
+        self.load = self.load_buffer.horizon(start, self.window_length, fill='both')
+        self.uncontrollable_load = self.uncontrollable_load_buffer.horizon(start, self.window_length, fill='both')
+        self.price = self.price_buffer.horizon(start, self.window_length, fill='forward')
+        for description, values in (('load', self.load), ('uncontrollable load', self.uncontrollable_load),
+                                    ('price', self.price)):
+            if np.isnan(values).any():
+                _log.warning(f"Missing {description} forecast over the planning horizon, skipping this run")
+                return False
+        return True
+
     def clear_schedule(self):
         for sched in self.schedule_objects:
             sched.cancel()
@@ -469,20 +623,92 @@ class Optimize(Agent):
             self.get_soc()
 
     def get_schedule_from_control(self):
-        # if self.energy_storage_system == "bess":
-        self.optimizer = Optimization(self.load, self.uncontrollable_load, self.price, self.config)
+        """
+        Solve the optimization in the solve worker process and store the results in ess_results.
+        The greenlet waits for the worker without blocking the hub, so pubsub and RPC keep being served
+        during the solve. A solve running longer than solve_timeout is cancelled.
+
+        Returns:
+            bool: True if new results were stored.
+        """
+        self.start_solve_worker()
+        if self.solve_worker.busy:
+            _log.warning("Previous optimization still running, skipping this run")
+            return False
         self.clear_schedule()
-        if self.forecast_data_source == "info_agent":
-            self.optimizer.update(bess_soc=self.bess_soc, tess_soc=self.tess_soc)
-        else:
-            self.optimizer.update(self.load, bess_soc=self.bess_soc, tess_soc=self.tess_soc)
-        self.ess_results = self.optimizer.run_opt()
+        plan_start = self.current_plan_start()
+        local_start = plan_start.astimezone(self.localtz)
+        # Local hour of the first time step, which places the TOU demand charge windows
+        update = {'bess_soc': self.bess_soc, 'tess_soc': self.tess_soc,
+                  '_hour': local_start.hour + local_start.minute / 60}
+        if self.forecast_data_source != "info_agent":
+            # The daily forecasts of the configuration are rotated to the hour by the optimizer
+            update['load'] = self.load
+            update['uncontrollable_load'] = self.uncontrollable_load
+        shift = 0
+        if self.method.lower() == "mpc" and self.plan_start is not None:
+            shift = int((plan_start - self.plan_start).total_seconds() // (self.time_step_minutes * 60))
+            shift = shift if 0 < shift < self.window_length else 0
+        with self.timer.phase('optimization'):
+            self.solve_worker.submit(self.load, self.uncontrollable_load, self.price, update, shift)
+            with gevent.Timeout(self.solve_timeout, False):
+                wait_read(self.solve_worker.fileno())
+        if not self.solve_worker.ready():
+            _log.error(f"Optimization did not finish in {self.solve_timeout} seconds, cancelling it")
+            self.solve_worker.cancel()
+            self.start_solve_worker()
+            return False
+        try:
+            self.ess_results = self.solve_worker.collect()
+        except RuntimeError as e:
+            _log.error(f"Optimization failed: {e}")
+            if not self.solve_worker.is_alive():
+                # The worker exited or was terminated by cancel_optimization, start a new one
+                self.solve_worker.cancel()
+                self.start_solve_worker()
+            return False
+        self.plan_start = plan_start
+        if 'plan_change' in self.ess_results:
+            _log.debug(f"Plan change after {shift} step(s): {self.ess_results['plan_change']}")
+        return True
 
-    def run_process(self):
-        self.load = self.backward_fill_na(self.forward_fill_na(self.load))
-        self.price = self.forward_fill_na(self.price)
+    def start_solve_worker(self):
+        """
+        Create the solve worker and, with prewarm_worker, start it right away so it loads the optimization
+        modules and solver plugins before the next plan.
+        """
+        if self.solve_worker is None:
+            self.solve_worker = SolveWorker(self.config)
+        if self.prewarm_worker:
+            self.solve_worker.prewarm()
 
-        if self.method.lower() == "control":
+    @RPC.export
+    def cancel_optimization(self):
+        """
+        Cancel the running optimization, if any.
+        """
+        if self.solve_worker is not None and self.solve_worker.busy:
+            _log.debug("Cancelling the running optimization")
+            # The greenlet waiting for the results is woken up by the worker exit and cleans up
+            self.solve_worker.terminate()
+            return True
+        return False
+
+    def run_process(self):
+        self.timer.reset()
+        self.ess_results = {}
+        with self.timer.phase('forecast_preprocessing'):
+            if self.forecast_data_source == "info_agent":
+                ready = self.read_forecast_buffers()
+            else:
+                self.load = self.backward_fill_na(self.forward_fill_na(self.load))
+                self.price = self.forward_fill_na(self.price)
+                ready = True
+        if not ready:
+            self.publish_metrics()
+            return
+
+        if self.method.lower() in ("control", "mpc"):
             self.schedule_operations()
 
         elif self.method.lower() == "schedule":
@@ -492,6 +718,49 @@ class Optimize(Agent):
             self.actuate_storage(self.tess_direct_signal)
         else:
             pass
+        self.publish_metrics()
+
+    def publish_metrics(self):
+        """
+        Publish the phase timings and solver telemetry of the last run, with rolling percentiles of every
+        metric, on the metrics topic and append them to the metrics file if one is configured.
+        """
+        model_timings = self.ess_results.get('timings', {})
+        attempts = self.ess_results.get('solve_attempts', [])
+        solver = {key: value for key, value in (attempts[-1] if attempts else {}).items()
+                  if key not in ('solver', 'status')}
+        self.metrics.add_all(self.timer.timings, 'phase.')
+        self.metrics.add_all(model_timings, 'model.')
+        self.metrics.add_all(solver, 'solver.')
+        record = {
+            'timestamp': format_timestamp(get_aware_utc_now()),
+            'method': self.method,
+            'phases': self.timer.timings,
+            'model_phases': model_timings,
+            'solver': self.ess_results.get('solver'),
+            'solver_status': attempts[-1]['status'] if attempts else None,
+            'solve_attempts': attempts,
+            'plan_change': self.ess_results.get('plan_change'),
+            'portfolio': self.ess_results.get('portfolio'),
+            'percentiles': self.metrics.summary()
+        }
+        _log.debug(f"Planning run phases: {self.timer.timings}, model phases: {model_timings}")
+        self.metrics.write(record)
+        try:
+            self.vip.pubsub.publish('pubsub', self.metrics_topic,
+                                    headers={'Date': record['timestamp']}, message=record).get(timeout=25)
+        except Exception as err:
+            _log.error("In publish metrics: {}".format(str(err)))
+
+    def timed_rpc(self, name, call):
+        """
+        Run an actuation RPC and add its duration to the rolling metrics.
+        """
+        start = time.perf_counter()
+        try:
+            return call()
+        finally:
+            self.metrics.add(f"rpc.{name}", time.perf_counter() - start)
 
     def publish_data(self, headers, message):
         # publish given message in the volttron's message bus
@@ -502,96 +771,98 @@ class Optimize(Agent):
         except Exception as err:
             _log.error("In Publish: {}".format(str(err)))
             
-def actuate_storage(self, value):
-    """
-    Actuate storage for BESS (Battery Energy Storage System), TESS, or both based on the provided value.
-    The value can be a float or a tuple, where the tuple contains (tess_setpoint, bess_setpoint).
+    def actuate_storage(self, value):
+        """
+        Actuate storage for BESS (Battery Energy Storage System), TESS, or both based on the provided value.
+        The value can be a float or a tuple, where the tuple contains (tess_setpoint, bess_setpoint).
 
-    :param value: Control value for BESS or TESS actuation. It can be a float or a tuple.
-    """
+        :param value: Control value for BESS or TESS actuation. It can be a float or a tuple.
+        """
 
-    for attempt in range(10):
-        try:
-            # Initialize setpoints for TESS and BESS
-            tess_setpoint, bess_setpoint = None, None
-
-            # Handle value based on energy storage system type
-            if self.energy_storage_system == "hybrid" and isinstance(value, tuple):
-                tess_setpoint, bess_setpoint = value  # Value is a tuple with both TESS and BESS setpoints
-            elif self.energy_storage_system == "bess" and isinstance(value, (int, float)):
-                bess_setpoint = value  # Value is for BESS only
-            elif self.energy_storage_system == "tess" and isinstance(value, (int, float)):
-                tess_setpoint = value  # Value is for TESS only
-            else:
-                _log.error("Invalid value type or energy storage system type.")
-                return  # Exit if value type is invalid for the given system
-
-            # Handle charging (negative setpoints)
-            if tess_setpoint is not None and tess_setpoint < 0:
-                if self.energy_storage_system in ["tess", "hybrid"]:
-                    if self.allowed_by_soc(tess_setpoint):
-                        tess_setpoint /= self.cop  # Adjust TESS cooling value
-                        t_run_seconds = abs(tess_setpoint) / 40 * 3600 + 200
+        for attempt in range(10):
+            try:
+                # Initialize setpoints for TESS and BESS
+                tess_setpoint, bess_setpoint = None, None
+
+                # Handle value based on energy storage system type
+                if self.energy_storage_system == "hybrid" and isinstance(value, tuple):
+                    tess_setpoint, bess_setpoint = value  # Value is a tuple with both TESS and BESS setpoints
+                elif self.energy_storage_system == "bess" and isinstance(value, (int, float)):
+                    bess_setpoint = value  # Value is for BESS only
+                elif self.energy_storage_system == "tess" and isinstance(value, (int, float)):
+                    tess_setpoint = value  # Value is for TESS only
+                else:
+                    _log.error("Invalid value type or energy storage system type.")
+                    return  # Exit if value type is invalid for the given system
+
+                # Handle charging (negative setpoints)
+                if tess_setpoint is not None and tess_setpoint < 0:
+                    if self.energy_storage_system in ["tess", "hybrid"]:
+                        if self.allowed_by_soc(tess_setpoint):
+                            tess_setpoint /= self.cop  # Adjust TESS cooling value
+                            # Run times are tuned for hourly steps and scaled to the time step
+                            step_ratio = self.time_step_minutes / 60.
+                            t_run_seconds = (abs(tess_setpoint) / 40 * 3600 + 200) * step_ratio
                         
-                        self._call_tess_actuator("charge")
+                            self._call_tess_actuator("charge")
 
-                        if t_run_seconds < 3000:
-                            t_run_seconds = max(t_run_seconds, 800)
-                            _log.debug(f"Adjusted TESS run time = {t_run_seconds} seconds")
+                            if t_run_seconds < 3000 * step_ratio:
+                                t_run_seconds = max(t_run_seconds, 800 * step_ratio)
+                                _log.debug(f"Adjusted TESS run time = {t_run_seconds} seconds")
 
-                            run_time = datetime.now() + timedelta(seconds=t_run_seconds)
-                            _log.debug(f"Scheduled TESS cooling at {run_time}")
+                                run_time = datetime.now() + timedelta(seconds=t_run_seconds)
+                                _log.debug(f"Scheduled TESS cooling at {run_time}")
                             
-                            self.core.schedule(run_time, self._call_tess_actuator, "cooling")
-                    else:
-                        self._call_tess_actuator("cooling")
-
-            if bess_setpoint is not None and bess_setpoint < 0:
-                if self.energy_storage_system in ["bess", "hybrid"]:
-                    self._call_bess_actuator(bess_setpoint, "charge")
-
-            # Handle discharging (positive setpoints)
-            if tess_setpoint is not None and tess_setpoint > 0:
-                if self.energy_storage_system in ["tess", "hybrid"]:
-                    if self.allowed_by_soc(tess_setpoint):
-                        self._call_tess_actuator("discharge")
-                    else:
+                                self.core.schedule(run_time, self._call_tess_actuator, "cooling")
+                        else:
+                            self._call_tess_actuator("cooling")
+
+                if bess_setpoint is not None and bess_setpoint < 0:
+                    if self.energy_storage_system in ["bess", "hybrid"]:
+                        self._call_bess_actuator(bess_setpoint, "charge")
+
+                # Handle discharging (positive setpoints)
+                if tess_setpoint is not None and tess_setpoint > 0:
+                    if self.energy_storage_system in ["tess", "hybrid"]:
+                        if self.allowed_by_soc(tess_setpoint):
+                            self._call_tess_actuator("discharge")
+                        else:
+                            self._call_tess_actuator("cooling")
+
+                if bess_setpoint is not None and bess_setpoint > 0:
+                    if self.energy_storage_system in ["bess", "hybrid"]:
+                        self._call_bess_actuator(bess_setpoint, "discharge")
+
+                # Handle zero value (turn off or cooling)
+                if tess_setpoint == 0:
+                    if self.energy_storage_system in ["tess", "hybrid"]:
                         self._call_tess_actuator("cooling")
 
-            if bess_setpoint is not None and bess_setpoint > 0:
-                if self.energy_storage_system in ["bess", "hybrid"]:
-                    self._call_bess_actuator(bess_setpoint, "discharge")
-
-            # Handle zero value (turn off or cooling)
-            if tess_setpoint == 0:
-                if self.energy_storage_system in ["tess", "hybrid"]:
-                    self._call_tess_actuator("cooling")
+                if bess_setpoint == 0:
+                    if self.energy_storage_system in ["bess", "hybrid"]:
+                        self._call_bess_actuator(0, "off")
 
-            if bess_setpoint == 0:
-                if self.energy_storage_system in ["bess", "hybrid"]:
-                    self._call_bess_actuator(0, "off")
-
-        except (gevent.Timeout, RemoteError) as e:
-            _log.debug(f"Trial {attempt} failed: Error actuating {self.energy_storage_system} - {e}")
-            continue
+            except (gevent.Timeout, RemoteError) as e:
+                _log.debug(f"Trial {attempt} failed: Error actuating {self.energy_storage_system} - {e}")
+                continue
 
-        break  # Exit the loop if no exception occurred
+            break  # Exit the loop if no exception occurred
 
     def _call_bess_actuator(self, value, call):
         if not 'bess.rtc' in self.vip.peerlist().get():
-            self.vip.rpc.call(self.bess_actuator, call,
-                              abs(value)).get(timeout=10)
+            self.timed_rpc(f"bess_{call}", lambda: self.vip.rpc.call(self.bess_actuator, call,
+                                                                     abs(value)).get(timeout=10))
             if call == 'off':
-                self.vip.rpc.call(self.bess_actuator, call).get(timeout=10)
+                self.timed_rpc(f"bess_{call}", lambda: self.vip.rpc.call(self.bess_actuator, call).get(timeout=10))
 
     def _call_tess_actuator(self, call):
         operation = 0
-        self.vip.rpc.call("platform.rpc_relay",
-                          "relay",
-                          "tess",
-                          self.tess_actuator,
-                          call,
-                          external_platform=self.external_platform).get(timeout=10)
+        self.timed_rpc(f"tess_{call}", lambda: self.vip.rpc.call("platform.rpc_relay",
+                                                                 "relay",
+                                                                 "tess",
+                                                                 self.tess_actuator,
+                                                                 call,
+                                                                 external_platform=self.external_platform).get(timeout=10))
 
         if call == "charge":
             operation = 3
@@ -0,0 +1,48 @@
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'control'))
+
+from fleet import normalize_config
+from matrix_model import MatrixOptimization
+from time_steps import window_steps
+
+
+def quarter_hour_config():
+    with open(os.path.join(ROOT, 'config_test')) as config_file:
+        config = normalize_config(json.load(config_file))
+    config.update(energy_storage_system='bess', time_step_minutes=15, window_length=24)
+    return config
+
+
+def test_window_length_in_hours_with_quarter_hour_steps():
+    config = quarter_hour_config()
+    assert window_steps(config) == 96
+    assert window_steps(dict(config, window_length=200)) == 200
+    assert window_steps(dict(config, time_step_minutes=60)) == 24
+
+
+def test_hourly_forecasts_cover_the_day_and_rotate():
+    config = quarter_hour_config()
+    load = [100. + hour for hour in range(24)]
+    uncontrollable_load = [50. + hour for hour in range(24)]
+    price = [0.1 + hour / 100 for hour in range(24)]
+    optimizer = MatrixOptimization(load, uncontrollable_load, price, config)
+    assert optimizer.window_length == 96
+    assert len(optimizer.load) == 96 and optimizer.load[4] == load[1]
+
+    optimizer.update(load, uncontrollable_load, _hour=3)
+    assert len(optimizer.load) == 96 and len(optimizer.prices) == 96
+    assert optimizer.load[0] == load[3] and optimizer.load[-1] == load[2]
+    assert optimizer.uncontrollable_load[0] == uncontrollable_load[3]
+    assert optimizer.prices[0] == price[3]
+    assert optimizer.start_hour == 3
+
+
+def test_window_length_in_steps():
+    config = dict(quarter_hour_config(), window_length_unit='steps')
+    assert window_steps(config) == 24
+    optimizer = MatrixOptimization([100.] * 24, [50.] * 24, [0.1] * 24, config)
+    assert optimizer.window_length == 24 and len(optimizer.load) == 24